@@ -0,0 +1,1455 @@
+#!/usr/bin/env python3
+"""aiolos-rc shim benchmarks, fully offline.
+
+Starts shim.py against local TLS stand-ins for aiolos and api.anthropic.com
+(throwaway certs, generated the same way setup.sh makes them) and drives it
+from a local client. Nothing leaves 127.0.0.1 and no real credentials are
+involved.
+
+  ./bench.py keepalive [--turns N]   client TLS handshakes and wall time for a
+                                     burst of tool-call turns, with and
+                                     without RC_CLIENT_KEEPALIVE
+  ./bench.py h2 [--sessions N]       upstream connections and wall time for N
+                                     concurrent sessions, HTTP/1.1 pool vs
+                                     RC_H2 (needs the `h2` package)
+  ./bench.py loop [--concurrency N]  requests/s, p50/p99 latency and shim CPU
+                                     per request for N concurrent keep-alive
+                                     clients, asyncio loop vs RC_UVLOOP (needs
+                                     the `uvloop` package for the second row)
+  ./bench.py relay [--mb N]          throughput and shim CPU per GB through an
+                                     upgrade tunnel and a close-delimited
+                                     response, transport splice vs stream copy
+                                     (RC_SPLICE); Linux (/proc) for CPU
+  ./bench.py suite [--scale X]       the load suite: control-plane GETs, large
+                                     chunked POSTs, long SSE, 100-continue,
+                                     WebSocket tunnels and hundreds of
+                                     sessions; throughput, p50/p90/p99, peak
+                                     RSS and fds per scenario (Linux). --json
+                                     saves the figures, --baseline FILE fails
+                                     on regressions against saved ones
+  ./bench.py workers [--seconds S]   full TLS handshakes/s against the shim with
+                                     RC_WORKERS=1, 2, 4, ... up to the core
+                                     count, from several client processes
+  ./bench.py cache [--sessions N]    upstream GETs and start-up time for N
+                                     staggered session starts (--stagger 0:
+                                     all at once), with and without RC_CACHE
+  ./bench.py priority [--uploads N]  control-plane heartbeat latency while N
+                                     sessions upload large prompts, without
+                                     and with the RC_LIMITS scheduler
+  ./bench.py parse                   CPU per HTTP head (parse, routing facts,
+                                     forwarded header list), in process, for
+                                     the old multi-pass parse, the Python
+                                     parser and httptools' (if installed;
+                                     RC_HTTPTOOLS)
+  ./bench.py replay FILE [--speed X] play an RC_CAPTURE file back through the
+                                     shim: each request at its time, with its
+                                     head, body sizes and upload timing, and
+                                     stand-ins answering with the captured
+                                     status, sizes and timing (X times
+                                     faster); captured vs replayed latency
+                                     per destination
+
+A tool-call turn is one streamed /v1/messages POST (to the aiolos stand-in)
+followed by one control-plane GET (to the api.anthropic.com stand-in).
+"""
+import argparse
+import asyncio
+import collections
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.parse
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+SHIM = os.path.join(DIR, "shim.py")
+HOST = "api.anthropic.com"
+
+
+def make_certs(d):
+    """Throwaway CA + leaf as setup.sh makes them, with 127.0.0.1 added to the
+    SAN so the stand-in upstreams can present the same leaf."""
+    def run(*args):
+        subprocess.run(["openssl", *args], cwd=d, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(os.path.join(d, "leaf.cnf"), "w") as f:
+        f.write("[req]\ndistinguished_name=dn\nreq_extensions=v3\n[dn]\n[v3]\n"
+                f"subjectAltName=DNS:{HOST},IP:127.0.0.1\n")
+    run("genrsa", "-out", "ca.key", "2048")
+    run("req", "-x509", "-new", "-nodes", "-key", "ca.key", "-sha256", "-days", "2",
+        "-subj", "/CN=aiolos-rc bench CA", "-out", "ca.pem")
+    run("genrsa", "-out", "leaf.key", "2048")
+    run("req", "-new", "-key", "leaf.key", "-subj", f"/CN={HOST}",
+        "-out", "leaf.csr", "-config", "leaf.cnf")
+    run("x509", "-req", "-in", "leaf.csr", "-CA", "ca.pem", "-CAkey", "ca.key",
+        "-CAcreateserial", "-days", "2", "-sha256", "-extfile", "leaf.cnf",
+        "-extensions", "v3", "-out", "leaf.pem")
+    with open(os.path.join(d, "leaf-chain.pem"), "wb") as out:
+        for name in ("leaf.pem", "ca.pem"):
+            with open(os.path.join(d, name), "rb") as f:
+                out.write(f.read())
+    return {k: os.path.join(d, v) for k, v in
+            (("ca", "ca.pem"), ("cert", "leaf-chain.pem"), ("key", "leaf.key"))}
+
+
+# --- stand-in upstream (`bench.py standin`, one process per upstream) ---
+
+# (records, speed) when the stand-in plays back a capture (standin --replay).
+REPLAY = None
+# standin --idle-close S: HTTP/1.1 connections idle for S are closed, as a
+# server's keep-alive timeout does (None: never).
+IDLE_CLOSE = None
+# standin --drop-posts: every POST is read in full, then its connection is
+# closed unanswered, like a server that died mid-request.
+DROP_POSTS = False
+# "METHOD /path" -> requests read in full by this stand-in; GET /seen answers it.
+SEEN = collections.Counter()
+
+
+async def _read_body(r, headers):
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        n = 0
+        while True:
+            size = int((await r.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                while await r.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return n
+            await r.readexactly(size + 2)
+            n += size
+    clen = int(headers.get("content-length") or 0)
+    if clen:
+        await r.readexactly(clen)
+    return clen
+
+
+def _response(method, target, received):
+    """What a stand-in answers for `target`: (head fields, body pieces, gap s,
+    delay s before the head). /v1/messages* streams SSE in the shape of a
+    message (start, N deltas, the usage delta, stop; ?events=N&delta=BYTES&gap=MS);
+    anything else is a small JSON (?size=BYTES of padding, ?cc=Cache-Control).
+    ?delay=MS holds the answer back, like a far-away upstream. HEAD gets the
+    same head and no body."""
+    fields, pieces, gap = _content(target, received)
+    q = dict(urllib.parse.parse_qsl(target.partition("?")[2]))
+    return fields, ([] if method == "HEAD" else pieces), gap, float(q.get("delay", 0)) / 1000
+
+
+def _content(target, received):
+    path, _, qs = target.partition("?")
+    q = dict(urllib.parse.parse_qsl(qs))
+    if path.startswith("/v1/messages"):
+        delta = b"x" * int(q.get("delta", 64))
+        n = int(q.get("events", 8))
+        usage = {"input_tokens": received // 4 + 1, "cache_read_input_tokens": 0,
+                 "cache_creation_input_tokens": 0, "output_tokens": 1}
+        events = [b"event: message_start\ndata: " + json.dumps(
+            {"type": "message_start", "message": {"usage": usage}}).encode() + b"\n\n"]
+        events += [b'event: content_block_delta\ndata: {"type":"content_block_delta",'
+                   b'"delta":{"text":"' + delta + b'"}}\n\n'] * n
+        events.append(b'event: message_delta\ndata: {"type":"message_delta",'
+                      b'"usage":{"output_tokens":%d}}\n\n' % n)
+        events.append(b'event: message_stop\ndata: {"type":"message_stop"}\n\n')
+        return [("content-type", "text/event-stream")], events, float(q.get("gap", 0)) / 1000
+    if path == "/seen":
+        return [("content-type", "application/json")], [json.dumps(SEEN).encode()], 0
+    out = json.dumps({"path": path, "received": received}).encode()
+    out += b" " * int(q.get("size", 0))
+    fields = [("content-type", "application/json"), ("content-length", str(len(out)))]
+    if "cc" in q:
+        fields.append(("cache-control", q["cc"]))
+    return fields, [out], 0
+
+
+async def _bulk(w, target, headers):
+    """/bulk?bytes=N: N bytes with no framing at all, ended by closing the
+    connection -- after `101` if the request asked to upgrade, else as a
+    close-delimited 200. Exercises the shim's raw relay (tunnel / pump)."""
+    n = int(dict(urllib.parse.parse_qsl(target.partition("?")[2])).get("bytes", 1 << 20))
+    if "upgrade" in headers:
+        w.write(b"HTTP/1.1 101 Switching Protocols\r\n"
+                b"connection: Upgrade\r\nupgrade: bench\r\n\r\n")
+    else:
+        w.write(b"HTTP/1.1 200 OK\r\ncontent-type: application/octet-stream\r\n\r\n")
+    piece = b"x" * 65536
+    while n > 0:
+        w.write(piece[:n])
+        n -= len(piece)
+        await w.drain()
+
+
+async def _echo(r, w):
+    """/echo with an upgrade: `101`, then everything sent comes straight back
+    (a WebSocket peer, frames and all, as far as the shim can tell)."""
+    w.write(b"HTTP/1.1 101 Switching Protocols\r\n"
+            b"connection: Upgrade\r\nupgrade: websocket\r\n\r\n")
+    while True:
+        data = await r.read(65536)
+        if not data:
+            return
+        w.write(data)
+        await w.drain()
+
+
+async def _standin_conn(r, w):
+    if w.get_extra_info("ssl_object").selected_alpn_protocol() == "h2":
+        return await _standin_h2(r, w)
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(r.readuntil(b"\r\n\r\n"), IDLE_CLOSE)
+            except asyncio.TimeoutError:
+                break
+            lines = head.decode("latin1").split("\r\n")
+            method, target, _ = lines[0].split(" ", 2)
+            headers = {}
+            for ln in lines[1:]:
+                if ln:
+                    k, _, v = ln.partition(":")
+                    headers[k.strip().lower()] = v.strip()
+            received = await _read_body(r, headers)
+            SEEN[f"{method} {target.partition('?')[0]}"] += 1
+            if DROP_POSTS and method == "POST":
+                break
+            if REPLAY is not None and "replay=" in target:
+                if not await _replay_h1(r, w, method, target):
+                    break
+                continue
+            if target.startswith("/bulk"):
+                await _bulk(w, target, headers)
+                break
+            if target.startswith("/echo") and "upgrade" in headers:
+                await _echo(r, w)
+                break
+            close = "close" in headers.get("connection", "").lower()
+            fields, pieces, gap, delay = _response(method, target, received)
+            if delay:
+                await asyncio.sleep(delay)
+            sized = any(k == "content-length" for k, _ in fields)
+            if not sized:
+                fields.append(("transfer-encoding", "chunked"))
+            w.write(b"HTTP/1.1 200 OK\r\n" + b"".join(
+                f"{k}: {v}\r\n".encode() for k, v in fields) + b"\r\n")
+            for piece in pieces:
+                w.write(piece if sized else b"%x\r\n%s\r\n" % (len(piece), piece))
+                await w.drain()
+                if gap:
+                    await asyncio.sleep(gap)
+            if not sized:
+                w.write(b"0\r\n\r\n")
+            await w.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        w.close()
+
+
+async def _standin_h2(r, w):
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(
+        client_side=False, header_encoding="latin1"))
+    conn.initiate_connection()
+    w.write(conn.data_to_send())
+    requests = {}
+    window = asyncio.Event()
+
+    async def send(sid, piece):
+        while piece:
+            n = min(conn.local_flow_control_window(sid), len(piece),
+                    conn.max_outbound_frame_size)
+            if n <= 0:
+                window.clear()
+                await window.wait()
+                continue
+            conn.send_data(sid, piece[:n])
+            piece = piece[n:]
+            w.write(conn.data_to_send())
+            await w.drain()
+
+    async def respond(sid, method, target, received):
+        if REPLAY is not None and "replay=" in target:
+            return await replay(sid, method, target)
+        fields, pieces, gap, delay = _response(method, target, received)
+        if delay:
+            await asyncio.sleep(delay)
+        conn.send_headers(sid, [(":status", "200")] + fields)
+        for piece in pieces:
+            await send(sid, piece)
+            if gap:
+                await asyncio.sleep(gap)
+        conn.end_stream(sid)
+        w.write(conn.data_to_send())
+
+    async def replay(sid, method, target):
+        status, fields, pieces, head_at, end_at = _replay_answer(method, target)
+        t0 = time.monotonic()
+        if status is None:
+            await _until(t0 + end_at)
+            conn.reset_stream(sid)
+        else:
+            await _until(t0 + head_at)
+            conn.send_headers(sid, [(":status", str(status))] + [
+                (k.lower(), v) for k, v in fields if k.lower() not in H2_DROP])
+            for at, piece in pieces:
+                await _until(t0 + at)
+                await send(sid, piece)
+            await _until(t0 + end_at)
+            conn.end_stream(sid)
+        w.write(conn.data_to_send())
+
+    try:
+        while True:
+            data = await r.read(65536)
+            if not data:
+                break
+            for ev in conn.receive_data(data):
+                if isinstance(ev, h2.events.RequestReceived):
+                    h = dict(ev.headers)
+                    requests[ev.stream_id] = [h[":method"], h[":path"], 0]
+                elif isinstance(ev, h2.events.DataReceived):
+                    requests[ev.stream_id][2] += len(ev.data)
+                    conn.acknowledge_received_data(ev.flow_controlled_length, ev.stream_id)
+                elif isinstance(ev, h2.events.StreamEnded):
+                    method, target, received = requests.pop(ev.stream_id)
+                    SEEN[f"{method} {target.partition('?')[0]}"] += 1
+                    asyncio.get_running_loop().create_task(
+                        respond(ev.stream_id, method, target, received))
+                elif isinstance(ev, h2.events.WindowUpdated):
+                    window.set()
+            w.write(conn.data_to_send())
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        w.close()
+
+
+# --- replayed answers (standin --replay; see bench_replay()) ---
+
+# Connection-specific fields HTTP/2 forbids.
+H2_DROP = ("connection", "keep-alive", "transfer-encoding", "upgrade", "proxy-connection")
+# Framing a replayed head gets from its replayed body instead.
+REPLAY_FRAMING = ("content-length", "transfer-encoding", "connection")
+
+
+def load_capture(path):
+    """An RC_CAPTURE file's records, in the order the requests arrived (the
+    index into this list is what `?replay=N` refers to)."""
+    with open(path) as f:
+        recs = [json.loads(ln) for ln in f if ln.strip()]
+    return sorted((r for r in recs if "req" in r), key=lambda r: r["t"])
+
+
+def placeholder(fields):
+    """Captured header fields with each value that was not kept (just its
+    length) filled with as many x's."""
+    return [(k, v if isinstance(v, str) else "x" * v) for k, v in fields]
+
+
+def _sent_at(rec):
+    """When the captured request was all upstream (s after its head); for a
+    tunnel, once its head was."""
+    if rec["up_at"] and rec["status"] != 101:
+        return rec["up_at"][-1][0]
+    return rec.get("wait") or 0.0
+
+
+def _spread(total, start, end):
+    """`total` bytes as even (time, bytes) pieces from `start` to `end`, one a
+    second (2 to 64 of them): tunnel bytes are captured as totals only."""
+    k = max(2, min(64, int(end - start)))
+    step = (end - start) / k
+    return [(start + step * (j + 1), total // k + (j < total % k)) for j in range(k)
+            if total // k + (j < total % k)]
+
+
+def _sse_event(kind, size, tokens):
+    """One SSE event of `size` bytes with the captured type; message_start and
+    message_delta carry the captured token usage, the rest is padding."""
+    if kind == "message_start":
+        msg = {"type": kind, "message": {"usage": {
+            "input_tokens": tokens.get("input", 0),
+            "cache_read_input_tokens": tokens.get("cache_read", 0),
+            "cache_creation_input_tokens": tokens.get("cache_write", 0),
+            "output_tokens": 1}}}
+    elif kind == "message_delta":
+        msg = {"type": kind, "usage": {"output_tokens": tokens.get("output", 0)}}
+    else:
+        msg = {"type": kind or "ping"}
+    event = (f"event: {kind}\n" if kind else "") + "data: " + json.dumps(msg)
+    return (event + " " * (size - len(event) - 2) + "\n\n").encode()
+
+
+def _replay_answer(method, target):
+    """The captured response that replayed request `?replay=N` stands for:
+    (status, head fields, [(s, bytes)] body pieces, s to the head, s to the
+    end), timed from when the stand-in has the whole request and divided by
+    the --speed. Status None: it never got one. Bodies are x's of the
+    captured sizes; SSE is rebuilt event by event with the captured types
+    and sizes."""
+    records, speed = REPLAY
+    q = dict(urllib.parse.parse_qsl(target.partition("?")[2]))
+    rec = records[int(q["replay"])]
+    sent = _sent_at(rec)
+    head_at = max((rec["ttfb"] or 0) - sent, 0) / speed
+    end_at = max(rec["dur"] - sent, head_at * speed) / speed
+    status = rec["status"]
+    if status is None or rec["resp"] is None:
+        return None, [], [], head_at, end_at
+    fields = [(k, v) for k, v in placeholder(rec["resp"]) if k.lower() not in REPLAY_FRAMING]
+    if status == 101:
+        pieces = [(at, b"x" * n) for at, n in _spread(rec["down"], head_at, end_at)]
+        return status, fields, pieces, head_at, end_at
+    if method == "HEAD" or status in (204, 304):
+        return status, fields, [], head_at, end_at
+    if rec.get("sse"):
+        tokens = rec.get("tokens") or {}
+        pieces = [(max(t - sent, 0) / speed, _sse_event(kind, n, tokens))
+                  for t, kind, n in rec["sse"]]
+    else:
+        pieces = [(max(t - sent, 0) / speed, b"x" * n) for t, n in rec["down_at"]]
+    if any(k.lower() == "content-length" for k, _ in rec["resp"]):
+        fields.append(("content-length", str(sum(len(p) for _, p in pieces))))
+    return status, fields, pieces, head_at, end_at
+
+
+async def _until(when):
+    delay = when - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def _drain(r):
+    while await r.read(65536):
+        pass
+
+
+async def _replay_h1(r, w, method, target):
+    """Answer a replayed request with its captured response (see
+    _replay_answer()). Returns False once the connection is done with."""
+    status, fields, pieces, head_at, end_at = _replay_answer(method, target)
+    t0 = time.monotonic()
+    if status is None:
+        await _until(t0 + end_at)
+        return False
+    await _until(t0 + head_at)
+    sized = any(k == "content-length" for k, _ in fields)
+    chunked = not sized and status not in (101, 204, 304) and method != "HEAD"
+    if chunked:
+        fields.append(("transfer-encoding", "chunked"))
+    w.write(f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\n".encode()
+            + b"".join(f"{k}: {v}\r\n".encode("latin1") for k, v in fields) + b"\r\n")
+    reader = asyncio.ensure_future(_drain(r)) if status == 101 else None
+    for at, piece in pieces:
+        await _until(t0 + at)
+        w.write(b"%x\r\n%s\r\n" % (len(piece), piece) if chunked else piece)
+        await w.drain()
+    if chunked or reader is not None:
+        await _until(t0 + end_at)       # a stream may idle before it ends
+    if chunked:
+        w.write(b"0\r\n\r\n")
+    await w.drain()
+    if reader is not None:
+        reader.cancel()
+        return False
+    return True
+
+
+async def _standin(port, cert, key):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    ctx.set_alpn_protocols(["h2", "http/1.1"] if h2 else ["http/1.1"])
+    server = await asyncio.start_server(_standin_conn, "127.0.0.1", port, ssl=ctx)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+# --- rig: certs + stand-ins + shim ---
+
+class Rig:
+    """Throwaway certs, an aiolos and an api.anthropic.com stand-in, and a shim
+    pointed at both. Use as a context manager; everything is torn down on exit.
+    `standin` is extra `bench.py standin` arguments for both stand-ins."""
+
+    def __init__(self, standin=(), **shim_env):
+        self.standin_args = list(standin)
+        self.shim_env = shim_env
+        self.procs = []
+
+    def __enter__(self):
+        self.tmp = tempfile.mkdtemp(prefix="aiolos-rc-bench.")
+        self.certs = make_certs(self.tmp)
+        self.aiolos_port = self._standin()
+        self.anthropic_port = self._standin()
+        self.port = self._shim()
+        return self
+
+    def __exit__(self, *exc):
+        for p in self.procs:
+            p.kill()
+            p.wait()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _standin(self):
+        p = subprocess.Popen(
+            [sys.executable, __file__, "standin",
+             "--cert", self.certs["cert"], "--key", self.certs["key"], *self.standin_args],
+            stdout=subprocess.PIPE)
+        self.procs.append(p)
+        return int(p.stdout.readline())
+
+    def _shim(self):
+        portfile = os.path.join(self.tmp, "port")
+        env = dict(os.environ,
+                   RC_PORT="0", RC_PORTFILE=portfile,
+                   RC_CERT=self.certs["cert"], RC_KEY=self.certs["key"],
+                   RC_AIOLOS_URL=f"https://127.0.0.1:{self.aiolos_port}",
+                   RC_ANTHROPIC_URL=f"https://127.0.0.1:{self.anthropic_port}",
+                   RC_UPSTREAM_CA=self.certs["ca"])
+        env.pop("RC_DEBUG", None)
+        env.update(self.shim_env)
+        self.log = os.path.join(self.tmp, "shim.log")
+        with open(self.log, "wb") as log:
+            p = subprocess.Popen([sys.executable, SHIM], env=env, stderr=log)
+        self.procs.append(p)
+        self.shim = p
+        for _ in range(200):
+            if os.path.exists(portfile) and os.path.getsize(portfile):
+                with open(portfile) as f:
+                    return int(f.read().split()[0])
+            if p.poll() is not None:
+                break
+            time.sleep(0.025)
+        raise RuntimeError("shim failed to start")
+
+    def client(self):
+        return Client(self.port, self.certs["ca"])
+
+    def connect(self):
+        """A raw TLS socket to the shim (SNI api.anthropic.com)."""
+        ctx = ssl.create_default_context(cafile=self.certs["ca"])
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return ctx.wrap_socket(sock, server_hostname=HOST)
+
+    def cpu(self):
+        """CPU seconds (user + system) the shim has used so far (Linux)."""
+        with open(f"/proc/{self.shim.pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def stats(self):
+        """The shim's counters, via its SIGUSR1 `stats {...}` log line."""
+        before = os.path.getsize(self.log)
+        self.shim.send_signal(signal.SIGUSR1)
+        for _ in range(100):
+            time.sleep(0.01)
+            with open(self.log, "rb") as f:
+                f.seek(before)
+                for line in f:
+                    if line.startswith(b"[shim] stats "):
+                        return json.loads(line[len(b"[shim] stats "):])
+        raise RuntimeError("shim did not report stats")
+
+
+class Client(http.client.HTTPSConnection):
+    """A blocking keep-alive client to the shim, presenting SNI api.anthropic.com
+    the way Claude does, that counts the TLS handshakes it performs."""
+
+    def __init__(self, port, ca):
+        super().__init__(HOST, port, context=ssl.create_default_context(cafile=ca))
+        self.handshakes = 0
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = self._context.wrap_socket(sock, server_hostname=HOST)
+        self.handshakes += 1
+
+    def call(self, method, path, body=None, headers=None):
+        self.request(method, path, body=body, headers=headers or {})
+        resp = self.getresponse()
+        data = resp.read()
+        if resp.will_close:
+            self.close()
+        return resp.status, data
+
+
+def download(rig, head):
+    """Send a raw request head to the shim and read everything back until it
+    closes; returns the byte count."""
+    with rig.connect() as sock:
+        sock.sendall(head)
+        n = 0
+        buf = bytearray(1 << 20)
+        while True:
+            got = sock.recv_into(buf)
+            if not got:
+                return n
+            n += got
+
+
+def turn(client, prompt):
+    client.call("POST", "/v1/messages?events=16", prompt,
+                {"content-type": "application/json"})
+    client.call("GET", "/v1/sessions/bench/events")
+
+
+# --- scenarios ---
+
+def bench_keepalive(args):
+    prompt = json.dumps({"messages": ["x" * 200] * 100}).encode()
+    print(f"{args.turns} tool-call turns (streamed /v1/messages + control-plane GET)")
+    print(f"{'mode':<12}{'handshakes':>12}{'wall ms':>10}{'ms/turn':>10}")
+    for mode in ("0", "1"):
+        with Rig(RC_CLIENT_KEEPALIVE=mode) as rig:
+            client = rig.client()
+            turn(client, prompt)            # warm the upstream pools
+            client.close()
+            client.handshakes = 0
+            t0 = time.perf_counter()
+            for _ in range(args.turns):
+                turn(client, prompt)
+            wall = (time.perf_counter() - t0) * 1000
+            client.close()
+            label = "keep-alive" if mode == "1" else "close"
+            print(f"{label:<12}{client.handshakes:>12}{wall:>10.1f}{wall / args.turns:>10.2f}")
+
+
+def bench_h2(args):
+    if h2 is None:
+        sys.exit("bench.py h2: needs the `h2` package (pip install h2)")
+    prompt = json.dumps({"messages": ["x" * 200] * 100}).encode()
+    print(f"{args.sessions} concurrent sessions x {args.turns} tool-call turns")
+    print(f"{'upstream':<12}{'connections':>13}{'wall ms':>10}")
+    for mode in ("0", "1"):
+        with Rig(RC_H2=mode) as rig:
+            def session():
+                client = rig.client()
+                for _ in range(args.turns):
+                    turn(client, prompt)
+                client.close()
+            threads = [threading.Thread(target=session) for _ in range(args.sessions)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = (time.perf_counter() - t0) * 1000
+            st = rig.stats()
+            opened = st.get("pool_opened", 0) + st.get("h2_opened", 0)
+            label = "http/2" if mode == "1" else "http/1.1"
+            print(f"{label:<12}{opened:>13}{wall:>10.1f}")
+
+
+def bench_loop(args):
+    prompt = json.dumps({"messages": ["x" * 200] * 100}).encode()
+    loops = ["asyncio"] + (["uvloop"] if uvloop else [])
+    if not uvloop:
+        print("(uvloop not installed: measuring the asyncio loop only)")
+    per = args.requests // args.concurrency
+    print(f"{args.concurrency} keep-alive clients x {per} requests "
+          "(streamed /v1/messages and control-plane GETs, alternating)")
+    print(f"{'loop':<10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'cpu ms/req':>12}")
+    for name in loops:
+        with Rig(RC_UVLOOP="1" if name == "uvloop" else "0",
+                 RC_CLIENT_KEEPALIVE="1") as rig:
+            if rig.stats().get("loop") != name:
+                sys.exit(f"bench.py loop: shim is not running on {name}")
+            latencies = []
+
+            def client_loop(client):
+                for i in range(per):
+                    t0 = time.perf_counter()
+                    if i % 2:
+                        client.call("GET", "/v1/sessions/bench/events")
+                    else:
+                        client.call("POST", "/v1/messages?events=16", prompt,
+                                    {"content-type": "application/json"})
+                    latencies.append(time.perf_counter() - t0)
+
+            clients = [rig.client() for _ in range(args.concurrency)]
+            for client in clients:
+                turn(client, prompt)        # connect and warm the upstream pools
+            threads = [threading.Thread(target=client_loop, args=(c,)) for c in clients]
+            cpu0, t0 = rig.cpu(), time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall, cpu = time.perf_counter() - t0, rig.cpu() - cpu0
+            for client in clients:
+                client.close()
+        latencies.sort()
+        n = len(latencies)
+        print(f"{name:<10}{n / wall:>9.0f}{latencies[n // 2] * 1000:>9.2f}"
+              f"{latencies[min(n - 1, n * 99 // 100)] * 1000:>9.2f}"
+              f"{cpu * 1000 / n:>12.3f}")
+
+
+async def _replay_one(port, ctx, i, rec, speed):
+    """Send captured request `i` through the shim: its head (uncaptured values
+    as x's, `?replay=i` added for the stand-in), then its body pieces at
+    their captured times, and read the whole answer. Returns (ttfb, duration,
+    status) in seconds, or the error's name."""
+    fields = placeholder(rec["req"])
+    chunked = any(k.lower() == "transfer-encoding" and "chunked" in v.lower()
+                  for k, v in fields)
+    expect = any(k.lower() == "expect" for k, _ in fields)
+    upgrade = rec["status"] == 101
+    if upgrade:
+        up = _spread(rec["up"], (rec["ttfb"] or 0) / speed, rec["dur"] / speed)
+    else:
+        up = [(t / speed, n) for t, n in rec["up_at"]]
+    fields = [(k, v) for k, v in fields if k.lower() != "content-length"]
+    if not chunked and not upgrade and (up or rec["method"] in ("POST", "PUT", "PATCH")):
+        fields.append(("Content-Length", str(sum(n for _, n in up))))
+    head = (f"{rec['method']} {rec['path']}?replay={i} HTTP/1.1\r\n"
+            + "".join(f"{k}: {v}\r\n" for k, v in fields) + "\r\n").encode("latin1")
+    try:
+        r, w = await asyncio.open_connection("127.0.0.1", port, ssl=ctx,
+                                             server_hostname=HOST)
+    except (OSError, ssl.SSLError) as e:
+        return type(e).__name__
+    try:
+        t0 = time.monotonic()
+        w.write(head)
+        if expect:
+            await r.readuntil(b"\r\n\r\n")      # the shim's own 100 Continue
+        ttfb = None
+        if upgrade:
+            resp = await r.readuntil(b"\r\n\r\n")
+            ttfb = time.monotonic() - t0
+        for at, n in up:
+            await _until(t0 + at)
+            w.write(b"%x\r\n%s\r\n" % (n, b"x" * n) if chunked else b"x" * n)
+            await w.drain()
+        if chunked:
+            w.write(b"0\r\n\r\n")
+        if upgrade:
+            await _drain(r)
+            return ttfb, time.monotonic() - t0, int(resp.split(b" ", 2)[1])
+        while True:
+            resp = await r.readuntil(b"\r\n\r\n")
+            if ttfb is None:
+                ttfb = time.monotonic() - t0
+            status = int(resp.split(b" ", 2)[1])
+            if not 100 <= status < 200:
+                break
+        lines = resp.decode("latin1").lower().split("\r\n")
+        hdrs = dict(ln.partition(":")[::2] for ln in lines[1:] if ln)
+        if rec["method"] == "HEAD" or status in (204, 304):
+            pass
+        elif "chunked" in hdrs.get("transfer-encoding", ""):
+            await _read_body(r, {"transfer-encoding": "chunked"})
+        elif "content-length" in hdrs:
+            await r.readexactly(int(hdrs["content-length"]))
+        else:
+            await _drain(r)
+        return ttfb, time.monotonic() - t0, status
+    except (OSError, ssl.SSLError, asyncio.IncompleteReadError, ValueError) as e:
+        return type(e).__name__
+    finally:
+        w.close()
+
+
+async def _replay(port, ca, records, speed):
+    """Every captured request at its captured time (divided by `speed`),
+    concurrently; their results in the same order."""
+    ctx = ssl.create_default_context(cafile=ca)
+    t0, first = time.monotonic(), records[0]["t"]
+
+    async def one(i, rec):
+        await _until(t0 + (rec["t"] - first) / speed)
+        return await _replay_one(port, ctx, i, rec, speed)
+    return await asyncio.gather(*(one(i, rec) for i, rec in enumerate(records)))
+
+
+def bench_replay(args):
+    records = load_capture(args.capture)
+    if not records:
+        sys.exit(f"bench.py replay: no RC_CAPTURE records in {args.capture}")
+    first = records[0]["t"]
+    span = max(r["t"] + r["dur"] for r in records) - first
+    print(f"{len(records)} requests over {span:.1f}s from {args.capture}, at "
+          f"{args.speed:g}x" + (f", shim env {' '.join(args.env)}" if args.env else ""))
+    env = dict(kv.split("=", 1) for kv in args.env)
+    with Rig(standin=["--replay", args.capture, "--speed", str(args.speed)], **env) as rig:
+        cpu0, t0 = rig.cpu(), time.perf_counter()
+        results = asyncio.run(_replay(rig.port, rig.certs["ca"], records, args.speed))
+        wall, cpu = time.perf_counter() - t0, rig.cpu() - cpu0
+    by_dest = {}
+    errors = mismatched = 0
+    for rec, res in zip(records, results):
+        row = by_dest.setdefault(rec["dest"], ([], [], [], []))
+        if isinstance(res, str):
+            errors += 1
+            continue
+        ttfb, dur, status = res
+        mismatched += status != (rec["status"] or 502)
+        if rec["ttfb"] is not None and ttfb is not None:
+            row[0].append(rec["ttfb"] / args.speed)
+            row[1].append(ttfb)
+        row[2].append(rec["dur"] / args.speed)
+        row[3].append(dur)
+    print("latency in ms, captured (divided by the speed) / replayed")
+    print(f"{'dest':<18}{'n':>6}{'ttfb p50':>18}{'dur p50':>20}{'dur p99':>20}")
+    for dest, (cap_ttfb, rep_ttfb, cap_dur, rep_dur) in sorted(by_dest.items()):
+        def pair(cap, rep, q):
+            if not rep:
+                return "-"
+            return (f"{percentile(sorted(cap), q) * 1000:.1f} / "
+                    f"{percentile(sorted(rep), q) * 1000:.1f}")
+        print(f"{dest:<18}{len(cap_dur):>6}{pair(cap_ttfb, rep_ttfb, 0.5):>18}"
+              f"{pair(cap_dur, rep_dur, 0.5):>20}{pair(cap_dur, rep_dur, 0.99):>20}")
+    print(f"wall {wall:.1f}s (captured {span / args.speed:.1f}s), shim CPU {cpu:.2f}s, "
+          f"{errors} failed, {mismatched} with another status")
+
+
+def bench_relay(args):
+    size = args.mb << 20
+    heads = {
+        "tunnel": (f"GET /bulk?bytes={size} HTTP/1.1\r\nHost: {HOST}\r\n"
+                   "Connection: Upgrade\r\nUpgrade: bench\r\n\r\n"),
+        "close-delim": f"GET /bulk?bytes={size} HTTP/1.1\r\nHost: {HOST}\r\n\r\n",
+    }
+    print(f"{args.mb} MiB downstream through the shim, best of {args.runs}")
+    print(f"{'path':<13}{'relay':<8}{'MiB/s':>9}{'cpu s/GiB':>11}")
+    for name, head in heads.items():
+        for mode in ("0", "1"):
+            with Rig(RC_SPLICE=mode) as rig:
+                best = None
+                for _ in range(args.runs):
+                    cpu0, t0 = rig.cpu(), time.perf_counter()
+                    got = download(rig, head.encode())
+                    wall, cpu = time.perf_counter() - t0, rig.cpu() - cpu0
+                    if got < size:
+                        sys.exit(f"bench.py relay: short read ({got} < {size})")
+                    if best is None or wall < best[0]:
+                        best = (wall, cpu)
+            label = "splice" if mode == "1" else "stream"
+            wall, cpu = best
+            print(f"{name:<13}{label:<8}{args.mb / wall:>9.0f}"
+                  f"{cpu / (size / (1 << 30)):>11.2f}")
+
+
+# Heads as Claude and the upstreams send them (values shortened, same shape).
+HEADS = {
+    "inference POST": (
+        "POST /v1/messages?beta=true HTTP/1.1\r\nhost: api.anthropic.com\r\n"
+        "connection: keep-alive\r\nAccept: application/json\r\n"
+        "X-Stainless-Retry-Count: 0\r\nX-Stainless-Timeout: 600\r\n"
+        "X-Stainless-Lang: js\r\nX-Stainless-Package-Version: 0.60.0\r\n"
+        "X-Stainless-OS: Linux\r\nX-Stainless-Arch: x64\r\nX-Stainless-Runtime: node\r\n"
+        "X-Stainless-Runtime-Version: v22.17.0\r\n"
+        "anthropic-dangerous-direct-browser-access: true\r\n"
+        "anthropic-version: 2023-06-01\r\nauthorization: Bearer " + "x" * 100 + "\r\n"
+        "x-app: cli\r\nUser-Agent: claude-cli/2.0.0 (external, cli)\r\n"
+        "content-type: application/json\r\n"
+        "anthropic-beta: oauth-2025-04-20,interleaved-thinking-2025-05-14\r\n"
+        "x-stainless-helper-method: stream\r\naccept-language: *\r\n"
+        "sec-fetch-mode: cors\r\naccept-encoding: gzip, deflate\r\n"
+        "content-length: 182734\r\n\r\n"),
+    "control GET": (
+        "GET /api/oauth/profile HTTP/1.1\r\nhost: api.anthropic.com\r\n"
+        "Accept: application/json, text/plain, */*\r\n"
+        "Authorization: Bearer " + "x" * 100 + "\r\nContent-Type: application/json\r\n"
+        "User-Agent: claude-cli/2.0.0\r\nanthropic-beta: oauth-2025-04-20\r\n"
+        "Accept-Encoding: gzip, compress, deflate, br\r\nConnection: keep-alive\r\n\r\n"),
+    "SSE response": (
+        "HTTP/1.1 200 OK\r\nDate: Mon, 01 Jan 2029 00:00:00 GMT\r\n"
+        "Content-Type: text/event-stream; charset=utf-8\r\n"
+        "Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n"
+        "Cache-Control: no-cache\r\nrequest-id: req_0123456789abcdef\r\n"
+        "anthropic-organization-id: 00000000-0000-0000-0000-000000000000\r\n"
+        "via: 1.1 google\r\nx-envoy-upstream-service-time: 512\r\n\r\n"),
+}
+
+
+def parse_multipass(head, hop_by_hop):
+    """The shim's parse before Head: split the head into pairs, then scan them
+    again for each thing routing and framing ask (the `before` column)."""
+    lines = head.split(b"\r\n")
+    headers = []
+    for ln in lines[1:]:
+        if ln:
+            k, _, v = ln.partition(b":")
+            headers.append((k.decode("latin1").strip(), v.decode("latin1").strip()))
+    start = lines[0].decode("latin1")
+    if start.startswith("HTTP/"):
+        clen, chunked, keep_alive, out = None, False, start.startswith("HTTP/1.1"), []
+        for k, v in headers:
+            kl = k.lower()
+            if kl == "content-length":
+                clen = int(v)
+            elif kl == "transfer-encoding" and "chunked" in v.lower():
+                chunked = True
+            elif kl == "connection":
+                keep_alive = keep_alive and "close" not in v.lower()
+                continue
+            elif kl in ("keep-alive", "proxy-connection"):
+                continue
+            out.append(f"{k}: {v}")
+        sse = any(k.lower() == "content-type" and "text/event-stream" in v.lower()
+                  for k, v in headers)
+        return clen, chunked, keep_alive, sse, out
+    upgrade = any((k.lower() == "upgrade" and v.strip())
+                  or (k.lower() == "connection" and "upgrade" in v.lower())
+                  for k, v in headers)
+    clen, chunked, expect = 0, False, False
+    for k, v in headers:
+        kl = k.lower()
+        if kl == "content-length":
+            clen = int(v)
+        elif kl == "transfer-encoding" and "chunked" in v.lower():
+            chunked = True
+        elif kl == "expect" and "100-continue" in v.lower():
+            expect = True
+    close = any(k.lower() == "connection" and "close" in v.lower() for k, v in headers)
+    fwd = [(k, v) for k, v in headers if k.lower() not in hop_by_hop and k.lower() != "expect"]
+    return upgrade, clen, chunked, expect, close, fwd
+
+
+def bench_parse(args):
+    tmp = tempfile.mkdtemp(prefix="aiolos-rc-bench.")
+    try:
+        certs = make_certs(tmp)
+        os.environ.update(RC_CERT=certs["cert"], RC_KEY=certs["key"])
+        sys.path.insert(0, DIR)
+        import shim
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    parsers = [("before", lambda head, drop: parse_multipass(head, shim.HOP_BY_HOP)),
+               ("python", lambda head, drop: shim.parse_head_py(head).without(drop))]
+    if shim.httptools is not None:
+        parsers.append(("httptools",
+                        lambda head, drop: shim.parse_head_httptools(head).without(drop)))
+    else:
+        print("(httptools not installed: measuring the Python parsers only)")
+    print(f"us per head, best of {args.runs} x {args.number}")
+    print(f"{'head':<16}{'fields':>7}" + "".join(f"{name:>11}" for name, _ in parsers))
+    for label, text in HEADS.items():
+        head = text.encode("latin1")
+        drop = shim.RESPONSE_DROP if head.startswith(b"HTTP/") else shim.HOP_BY_HOP_REQUEST
+        row = f"{label:<16}{len(shim.parse_head_py(head)):>7}"
+        for _, parse in parsers:
+            t = min(timeit.repeat(lambda: parse(head, drop),
+                                  number=args.number, repeat=args.runs))
+            row += f"{t / args.number * 1e6:>11.2f}"
+        print(row)
+
+
+# Control-plane GETs a session makes as it starts (stand-in paths; ?delay
+# is the upstream round trip the cache saves).
+STARTUP_GETS = ("/api/oauth/profile", "/api/oauth/roles", "/api/features",
+                "/api/settings")
+
+
+def bench_cache(args):
+    gets = [f"{p}?delay={args.rtt}" for p in STARTUP_GETS]
+    print(f"{args.sessions} sessions starting {args.stagger:g} ms apart, "
+          f"{len(gets)} control-plane GETs each ({args.rtt} ms upstream)")
+    print(f"{'cache':<8}{'upstream GETs':>15}{'coalesced':>11}{'p50 ms':>9}{'max ms':>9}")
+    for mode in ("off", "on"):
+        env = {"RC_CACHE": ",".join(STARTUP_GETS)} if mode == "on" else {}
+        with Rig(**env) as rig:
+            times = []
+
+            def session(_):
+                client = rig.client()
+                t0 = time.perf_counter()
+                for path in gets:
+                    client.call("GET", path, headers={"authorization": "Bearer bench"})
+                times.append(time.perf_counter() - t0)
+                client.close()
+
+            threads = []
+            for i in range(args.sessions):
+                threads.append(threading.Thread(target=session, args=(i,)))
+                threads[-1].start()
+                time.sleep(args.stagger / 1000)
+            for t in threads:
+                t.join()
+            st = rig.stats()
+            saved = st.get("cache_hit", 0) + st.get("cache_coalesced", 0)
+        times.sort()
+        print(f"{mode:<8}{args.sessions * len(gets) - saved:>15}"
+              f"{st.get('cache_coalesced', 0):>11}{times[len(times) // 2] * 1000:>9.1f}"
+              f"{times[-1] * 1000:>9.1f}")
+
+
+def _uploads(port, ca, kb, seconds):
+    """Back-to-back /v1/messages POSTs of a `kb` KiB prompt over one keep-alive
+    connection for `seconds` (runs in a client process); returns the count."""
+    client = Client(port, ca)
+    prompt = b"x" * (kb << 10)
+    n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        client.call("POST", "/v1/messages?events=1", prompt,
+                    {"content-type": "application/json"})
+        n += 1
+    client.close()
+    return n
+
+
+def bench_priority(args):
+    print(f"{args.uploads} sessions uploading {args.kb} KiB prompts for {args.seconds:g}s, "
+          f"one heartbeat GET every {args.every} ms")
+    print(f"{'limits':<10}{'uploads/s':>10}{'MiB/s':>8}{'beat p50':>10}{'p99 ms':>8}"
+          f"{'max ms':>8}{'waited':>8}")
+    with multiprocessing.get_context("fork").Pool(args.uploads) as procs:
+        for mode in ("off", "on"):
+            env = {"RC_LIMITS": "inference=0,total=0"} if mode == "off" else {}
+            with Rig(**env) as rig:
+                t0 = time.perf_counter()
+                pending = procs.starmap_async(
+                    _uploads, [(rig.port, rig.certs["ca"], args.kb, args.seconds)]
+                    * args.uploads)
+                beats = []
+                while time.perf_counter() - t0 < args.seconds:
+                    client = rig.client()
+                    t1 = time.perf_counter()
+                    client.call("GET", "/v1/sessions/bench/events")
+                    beats.append(time.perf_counter() - t1)
+                    client.close()
+                    time.sleep(args.every / 1000)
+                uploads = sum(pending.get())
+                wall = time.perf_counter() - t0
+                waited = rig.stats().get("sched_inference_waited", 0)
+            beats.sort()
+            print(f"{mode:<10}{uploads / wall:>10.1f}{uploads * args.kb / 1024 / wall:>8.1f}"
+                  f"{percentile(beats, 0.5) * 1000:>10.1f}{percentile(beats, 0.99) * 1000:>8.1f}"
+                  f"{beats[-1] * 1000:>8.1f}{waited:>8}")
+
+
+def _handshakes(port, ca, seconds):
+    """Full TLS handshakes with the shim, one connection each, for `seconds`
+    (runs in a client process)."""
+    ctx = ssl.create_default_context(cafile=ca)
+    n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sock = socket.create_connection(("127.0.0.1", port))
+        ctx.wrap_socket(sock, server_hostname=HOST).close()
+        n += 1
+    return n
+
+
+def bench_workers(args):
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= max(cores, 2):
+        counts.append(counts[-1] * 2)
+    clients = args.clients or 2 * counts[-1]
+    print(f"full TLS handshakes/s, {clients} client processes for {args.seconds:g}s "
+          f"({cores} cores; clients share them)")
+    print(f"{'workers':<10}{'handshakes/s':>14}{'speedup':>9}")
+    base = None
+    with multiprocessing.get_context("fork").Pool(clients) as procs:
+        for n in counts:
+            with Rig(RC_WORKERS=str(n)) as rig:
+                _handshakes(rig.port, rig.certs["ca"], 0.2)         # warm up
+                got = procs.starmap(_handshakes, [(rig.port, rig.certs["ca"], args.seconds)]
+                                    * clients)
+            rate = sum(got) / args.seconds
+            base = base or rate
+            print(f"{n:<10}{rate:>14.0f}{rate / base:>8.2f}x")
+
+
+# --- suite: real-use scenarios, with resource peaks and a regression check ---
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def read_until_close(sock):
+    n = 0
+    buf = bytearray(1 << 16)
+    while True:
+        got = sock.recv_into(buf)
+        if not got:
+            return n
+        n += got
+
+
+def recv_head(sock):
+    head = b""
+    while b"\r\n\r\n" not in head:
+        data = sock.recv(1)
+        if not data:
+            raise ConnectionError("closed before the response head")
+        head += data
+    return head
+
+
+def parallel(n, fn):
+    """Run fn(i) on n threads; returns their results and the wall time."""
+    results = [None] * n
+    errors = []
+
+    def run(i):
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    if errors:
+        raise errors[0]
+    return results, wall
+
+
+def sc_control(rig, scale):
+    """Small control-plane GETs (to the api.anthropic.com stand-in)."""
+    per = max(1, int(50 * scale))
+
+    def client(_):
+        c = rig.client()
+        out = []
+        for _ in range(per):
+            t0 = time.perf_counter()
+            _, data = c.call("GET", "/v1/sessions/bench/events?size=512")
+            out.append((time.perf_counter() - t0, len(data)))
+        c.close()
+        return out
+    return parallel(8, client)
+
+
+def sc_chunked_post(rig, scale):
+    """Large chunked /v1/messages POSTs (a long conversation being uploaded)."""
+    size = max(1, int(8 * scale)) << 20
+    piece = b"x" * 65536
+
+    def body():
+        for _ in range(size // len(piece)):
+            yield piece
+
+    def client(_):
+        c = rig.client()
+        out = []
+        for _ in range(2):
+            t0 = time.perf_counter()
+            c.request("POST", "/v1/messages", body=body(), encode_chunked=True,
+                      headers={"content-type": "application/json"})
+            c.getresponse().read()
+            c.close()
+            out.append((time.perf_counter() - t0, size))
+        return out
+    return parallel(4, client)
+
+
+def sc_sse(rig, scale):
+    """Long SSE responses (a long streamed generation)."""
+    events = max(1, int(4000 * scale))
+
+    def client(_):
+        c = rig.client()
+        out = []
+        for _ in range(2):
+            t0 = time.perf_counter()
+            _, data = c.call("POST", f"/v1/messages?events={events}&delta=256", b"{}",
+                             {"content-type": "application/json"})
+            out.append((time.perf_counter() - t0, len(data)))
+        c.close()
+        return out
+    return parallel(4, client)
+
+
+def sc_expect(rig, scale):
+    """POSTs sent with `Expect: 100-continue`, body only after the 100."""
+    per = max(1, int(25 * scale))
+    body = b"x" * 65536
+    head = (f"POST /v1/messages HTTP/1.1\r\nHost: {HOST}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            "Expect: 100-continue\r\n\r\n").encode()
+
+    def client(_):
+        out = []
+        for _ in range(per):
+            t0 = time.perf_counter()
+            with rig.connect() as sock:
+                sock.sendall(head)
+                if b" 100 " not in recv_head(sock).split(b"\r\n", 1)[0]:
+                    raise RuntimeError("no 100 Continue")
+                sock.sendall(body)
+                n = read_until_close(sock)
+            out.append((time.perf_counter() - t0, n))
+        return out
+    return parallel(4, client)
+
+
+def sc_websocket(rig, scale):
+    """WebSocket-style upgrades through tunnel(): 1 KiB echo round trips."""
+    per = max(1, int(500 * scale))
+    msg = b"x" * 1024
+    head = (f"GET /echo HTTP/1.1\r\nHost: {HOST}\r\n"
+            "Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n").encode()
+
+    def client(_):
+        out = []
+        with rig.connect() as sock:
+            sock.sendall(head)
+            recv_head(sock)
+            for _ in range(per):
+                t0 = time.perf_counter()
+                sock.sendall(msg)
+                got = 0
+                while got < len(msg):
+                    data = sock.recv(len(msg) - got)
+                    if not data:
+                        raise ConnectionError("tunnel closed")
+                    got += len(data)
+                out.append((time.perf_counter() - t0, 2 * len(msg)))
+        return out
+    return parallel(8, client)
+
+
+def sc_sessions(rig, scale):
+    """Hundreds of concurrent sessions, each doing tool-call turns."""
+    prompt = json.dumps({"messages": ["x" * 200] * 20}).encode()
+
+    def session(_):
+        c = rig.client()
+        out = []
+        for _ in range(2):
+            for method, path, body in (("POST", "/v1/messages?events=16", prompt),
+                                       ("GET", "/v1/sessions/bench/events", None)):
+                t0 = time.perf_counter()
+                _, data = c.call(method, path, body)
+                out.append((time.perf_counter() - t0, len(data)))
+        c.close()
+        return out
+    return parallel(max(1, int(200 * scale)), session)
+
+
+SCENARIOS = {
+    "control-get": sc_control,
+    "chunked-post": sc_chunked_post,
+    "sse-long": sc_sse,
+    "expect-100": sc_expect,
+    "websocket": sc_websocket,
+    "sessions": sc_sessions,
+}
+# Which way is better, per reported figure, for --baseline comparisons.
+HIGHER_BETTER = ("ops_s", "mib_s")
+LOWER_BETTER = ("p50_ms", "p90_ms", "p99_ms", "rss_mib", "fds")
+
+
+class FdSampler(threading.Thread):
+    """Polls how many fds the shim has open, keeping the peak."""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.path = f"/proc/{pid}/fd"
+        self.peak = 0
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                self.peak = max(self.peak, len(os.listdir(self.path)))
+            except OSError:
+                pass
+            self.stop.wait(0.005)
+
+
+def run_scenario(name, args):
+    """Median figures over --runs measured runs (after one warm-up run) on a
+    fresh rig, so scenarios don't inherit each other's pools or peaks."""
+    env = dict(kv.split("=", 1) for kv in args.env)
+    fn = SCENARIOS[name]
+    runs = []
+    with Rig(**env) as rig:
+        fn(rig, args.scale / 4)                 # warm-up: pools, DNS, tickets
+        sampler = FdSampler(rig.shim.pid)
+        sampler.start()
+        for _ in range(args.runs):
+            results, wall = fn(rig, args.scale)
+            samples = sorted(t for r in results for t, _ in r)
+            moved = sum(n for r in results for _, n in r)
+            runs.append({
+                "ops_s": len(samples) / wall,
+                "mib_s": moved / wall / (1 << 20),
+                "p50_ms": percentile(samples, 0.50) * 1000,
+                "p90_ms": percentile(samples, 0.90) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+            })
+        sampler.stop.set()
+        sampler.join()
+        with open(f"/proc/{rig.shim.pid}/status") as f:
+            hwm = next(int(ln.split()[1]) for ln in f if ln.startswith("VmHWM:"))
+    out = {k: sorted(r[k] for r in runs)[len(runs) // 2] for k in runs[0]}
+    out.update(rss_mib=hwm / 1024, fds=sampler.peak)
+    return out
+
+
+def regressions(results, baseline, tolerance):
+    """Figures worse than the baseline by more than `tolerance` (relative).
+    Tiny absolute differences (under 1 ms, 0.5 MiB/s, 2 MiB RSS, 4 fds) are
+    noise."""
+    floor = {"p50_ms": 1, "p90_ms": 1, "p99_ms": 1, "mib_s": 0.5, "rss_mib": 2, "fds": 4}
+    found = []
+    for name, now in results.items():
+        then = baseline.get(name)
+        if not then:
+            continue
+        for k in HIGHER_BETTER + LOWER_BETTER:
+            if k not in then or not then[k]:
+                continue
+            worse = then[k] - now[k] if k in HIGHER_BETTER else now[k] - then[k]
+            if worse > floor.get(k, 0) and worse / then[k] > tolerance:
+                found.append(f"{name} {k}: {then[k]:.1f} -> {now[k]:.1f}")
+    return found
+
+
+def bench_suite(args):
+    names = args.only or list(SCENARIOS)
+    print(f"scale {args.scale}, median of {args.runs} runs"
+          + (f", shim env {' '.join(args.env)}" if args.env else ""))
+    print(f"{'scenario':<14}{'ops/s':>9}{'MiB/s':>9}{'p50 ms':>9}{'p90 ms':>9}"
+          f"{'p99 ms':>9}{'rss MiB':>9}{'fds':>6}")
+    results = {}
+    for name in names:
+        r = results[name] = run_scenario(name, args)
+        print(f"{name:<14}{r['ops_s']:>9.1f}{r['mib_s']:>9.1f}{r['p50_ms']:>9.2f}"
+              f"{r['p90_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['rss_mib']:>9.1f}{r['fds']:>6}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "env": args.env,
+                       "scale": args.scale, "runs": args.runs, "results": results},
+                      f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        if (base.get("scale"), base.get("runs")) != (args.scale, args.runs):
+            sys.exit(f"bench.py suite: {args.baseline} was taken with --scale "
+                     f"{base.get('scale')} --runs {base.get('runs')}; use the same")
+        found = regressions(results, base["results"], args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sp = sub.add_parser("standin", help="run one stand-in upstream (internal)")
+    sp.add_argument("--port", type=int, default=0)
+    sp.add_argument("--cert", required=True)
+    sp.add_argument("--key", required=True)
+    sp.add_argument("--replay", metavar="FILE", help="answer ?replay=N from this capture")
+    sp.add_argument("--speed", type=float, default=1.0)
+    sp.add_argument("--idle-close", type=float, metavar="S",
+                    help="close HTTP/1.1 connections idle this long")
+    sp.add_argument("--drop-posts", action="store_true",
+                    help="read each POST in full, then close without answering")
+    sp = sub.add_parser("keepalive", help="client keep-alive vs close")
+    sp.add_argument("--turns", type=int, default=200)
+    sp = sub.add_parser("h2", help="HTTP/1.1 upstream pool vs RC_H2")
+    sp.add_argument("--sessions", type=int, default=16)
+    sp.add_argument("--turns", type=int, default=20)
+    sp = sub.add_parser("loop", help="asyncio event loop vs RC_UVLOOP")
+    sp.add_argument("--concurrency", type=int, default=16)
+    sp.add_argument("--requests", type=int, default=4000)
+    sp = sub.add_parser("suite", help="load suite with a regression check")
+    sp.add_argument("--scale", type=float, default=1.0,
+                    help="multiply every scenario's size (0.2 for a quick run)")
+    sp.add_argument("--runs", type=int, default=3)
+    sp.add_argument("--only", action="append", choices=list(SCENARIOS))
+    sp.add_argument("--env", action="append", default=[], metavar="RC_X=V",
+                    help="extra shim environment, e.g. --env RC_H2=1")
+    sp.add_argument("--json", metavar="FILE", help="write the figures here")
+    sp.add_argument("--baseline", metavar="FILE", help="compare with a --json file")
+    sp.add_argument("--tolerance", type=float, default=0.25)
+    sp = sub.add_parser("cache", help="session start-up GETs without and with RC_CACHE")
+    sp.add_argument("--sessions", type=int, default=32)
+    sp.add_argument("--stagger", type=float, default=20)
+    sp.add_argument("--rtt", type=int, default=50)
+    sp = sub.add_parser("workers", help="TLS handshake throughput vs RC_WORKERS")
+    sp.add_argument("--seconds", type=float, default=5)
+    sp.add_argument("--clients", type=int, default=0, help="default: 2x the most workers")
+    sp = sub.add_parser("relay", help="transport splice vs stream copy relay")
+    sp.add_argument("--mb", type=int, default=512)
+    sp.add_argument("--runs", type=int, default=3)
+    sp = sub.add_parser("priority", help="heartbeat latency under uploads vs RC_LIMITS")
+    sp.add_argument("--uploads", type=int, default=32)
+    sp.add_argument("--kb", type=int, default=2048)
+    sp.add_argument("--seconds", type=float, default=10)
+    sp.add_argument("--every", type=int, default=50)
+    sp = sub.add_parser("replay", help="play an RC_CAPTURE file back through the shim")
+    sp.add_argument("capture", metavar="FILE")
+    sp.add_argument("--speed", type=float, default=1.0,
+                    help="play back this many times faster")
+    sp.add_argument("--env", action="append", default=[], metavar="RC_X=V",
+                    help="extra shim environment, e.g. --env RC_H2=1")
+    sp = sub.add_parser("parse", help="HTTP head parsing CPU: multi-pass, one pass, httptools")
+    sp.add_argument("--number", type=int, default=20000)
+    sp.add_argument("--runs", type=int, default=7)
+    args = ap.parse_args()
+    if args.cmd == "standin":
+        global REPLAY, IDLE_CLOSE, DROP_POSTS
+        if args.replay:
+            REPLAY = (load_capture(args.replay), args.speed)
+        IDLE_CLOSE = args.idle_close
+        DROP_POSTS = args.drop_posts
+        try:
+            asyncio.run(_standin(args.port, args.cert, args.key))
+        except KeyboardInterrupt:
+            pass
+    elif args.cmd == "keepalive":
+        bench_keepalive(args)
+    elif args.cmd == "h2":
+        bench_h2(args)
+    elif args.cmd == "loop":
+        bench_loop(args)
+    elif args.cmd == "suite":
+        bench_suite(args)
+    elif args.cmd == "relay":
+        bench_relay(args)
+    elif args.cmd == "cache":
+        bench_cache(args)
+    elif args.cmd == "workers":
+        bench_workers(args)
+    elif args.cmd == "parse":
+        bench_parse(args)
+    elif args.cmd == "priority":
+        bench_priority(args)
+    elif args.cmd == "replay":
+        bench_replay(args)
+
+
+if __name__ == "__main__":
+    main()
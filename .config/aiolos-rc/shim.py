@@ -19,288 +19,3438 @@ Config via env:
   RC_CERT        cert chain (leaf+CA) PEM for TLS termination
   RC_KEY         private key PEM
   RC_AIOLOS_URL  aiolos base URL, e.g. https://host[:port]  (never logged)
-  RC_ACCOUNT_ID  aiolos account id X for the inference leg
+  RC_ACCOUNT_ID  aiolos account id X for the inference leg; a comma-separated
+                 list spreads inference over those accounts, each request
+                 pinned to the one expected to answer first (see Account)
+  RC_CONFIG      file of RC_AIOLOS_URL=... / RC_ACCOUNT_ID=... lines that
+                 override those two, read at startup and again on SIGHUP
+  RC_DAEMON      control socket path: run as a shared daemon serving many
+                 sessions instead (RC_AIOLOS_URL/RC_ACCOUNT_ID/RC_PORT then
+                 come per session over the socket; see serve_control())
   RC_DEBUG       if set, log one line per request (method, path, upstream)
+  RC_STREAM_BODY "0" buffers each request body whole before connecting
+                 upstream (the old behaviour); default streams it through
+  RC_BODY_MEM    bytes of such buffered bodies held in memory at once, across
+                 all requests (default 64 MiB); RC_BODY_SPILL the size past
+                 which one goes to an unlinked temp file instead (default 1 MiB)
+  RC_POOL_MAX    idle keep-alive connections kept per upstream (default 8)
+  RC_POOL_IDLE   seconds an idle upstream connection is kept (default 30;
+                 0 disables pooling and sends `Connection: close` upstream)
+  RC_CLIENT_KEEPALIVE  "1" keeps the client connection open and classifies
+                 every request on it separately (default: one per connection)
+  RC_ANTHROPIC_URL, RC_UPSTREAM_CA  point the control-plane leg at another
+                 https origin / trust another CA (local stand-ins, bench.py)
+  RC_TLS_TICKETS TLS 1.3 session tickets issued per client handshake (default 2)
+  RC_H2          "1" multiplexes all requests for one upstream + pin over a
+                 single HTTP/2 connection (TLS upstreams; needs the `h2`
+                 package, else HTTP/1.1). The client side stays HTTP/1.1.
+
+  RC_DNS_TTL     seconds an upstream's resolved addresses are reused (default
+                 60); RC_DNS_STALE how long past that the last good answer is
+                 still used while lookups fail (default 300)
+  RC_UVLOOP      "1" runs on uvloop if it is installed (else asyncio's own
+                 loop; `bench.py loop` compares the two)
+  RC_SPLICE      "0" relays upgrade tunnels and close-delimited responses
+                 through the stream layer instead of transport to transport
+  RC_HTTPTOOLS   "1" parses HTTP heads with httptools' C parser if it is
+                 installed (else in Python). Not faster as measured so far;
+                 `bench.py parse` compares the two
+  RC_CACHE       comma-separated control-plane GET paths (a trailing `*`
+                 makes a prefix) whose responses are cached in memory, per
+                 login, honouring Cache-Control; RC_CACHE_TTL caps how long
+                 (default 60s), RC_CACHE_MAX the total size (default 8 MiB)
+  RC_METRICS     unix socket path serving per-destination counters, latency
+                 histograms and token usage over HTTP (see serve_metrics());
+                 under RC_WORKERS each worker N serves its own, with `.N`
+                 before the extension (metrics.sock -> metrics.N.sock)
+  RC_PREWARM     idle connections opened to each of a session's upstreams
+                 at startup, before the port is reported (default 2; one h2
+                 connection under RC_H2; 0 disables); RC_PREWARM_WAIT caps
+                 the wait for them (default 3s)
+  RC_WORKERS     number of worker processes terminating TLS for the one
+                 listener (default 1; see run_workers()). Not for RC_DAEMON
+  RC_LIMITS      concurrent upstream sends, as class=N pairs: `inference`
+                 per aiolos destination (default 8), `control` for
+                 api.anthropic.com and `upgrade` for tunnel handshakes (default
+                 0, no cap), `total` across all inference (default 32; control
+                 and upgrade sends are outside it); requests over a cap queue
+                 by class and session (see Scheduler)
+  RC_TIMEOUTS    connection timeouts in seconds, as name=N pairs (0: none):
+                 `head` to get a request head on a new or kept-alive client
+                 connection (default 60); `idle` with no bytes either way
+                 during a request, not counting time queued for a Scheduler
+                 slot (default 600, the client's own timeout), and `total`
+                 for all of it (default 3600). SSE responses get
+                 `stream` instead (idle only, default 300), upgrade tunnels
+                 `tunnel` (idle only, default 0; TCP keepalive finds upstreams
+                 that went away). See Lifecycle
+  RC_FD_BUDGET   sockets held at most; past it, the longest-idle pooled
+                 connections are closed and new requests answered 503, and
+                 prewarming stops short of it (default: the open-file limit
+                 less 64; 0: none)
+  RC_TRACE       finished requests kept in the in-memory trace ring (default
+                 1024; 0 disables; see Trace); RC_TRACE_FILE an NDJSON file
+                 they are also appended to, about once a second
+  RC_CAPTURE     NDJSON file every finished request is also appended to with
+                 its timing shape: header names, body and SSE event sizes and
+                 times, never bodies or credential values (see Capture).
+                 `bench.py replay` plays such a file back offline
+
+SIGUSR1 writes one `stats {...}` JSON line (counters only) to stderr, SIGUSR2
+one `trace {...}` line per request in the trace ring. SIGHUP reloads the certs
+and RC_CONFIG without dropping anything in flight (see reload()).
 
 No request/response bodies or tokens are ever logged.
 """
 import asyncio
+import bisect
+import collections
+import functools
+import hashlib
+import itertools
+import json
 import os
+import resource
+import signal
+import socket
 import ssl
 import sys
+import tempfile
+import time
 import urllib.parse
+from http import HTTPStatus
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:             # optional: RC_H2 falls back to HTTP/1.1
+    h2 = None
+
+try:
+    import uvloop
+except ImportError:             # optional: RC_UVLOOP falls back to asyncio's loop
+    uvloop = None
+
+try:
+    import httptools
+except ImportError:             # optional: RC_HTTPTOOLS falls back to the Python parser
+    httptools = None
+
+SOCK = os.environ.get("RC_SOCK")           # unix-socket mode (legacy)
+LISTEN_PORT = os.environ.get("RC_PORT")    # TCP mode on 127.0.0.1 (preload redirect)
+DAEMON_SOCK = os.environ.get("RC_DAEMON")  # shared multi-session daemon mode
+METRICS_SOCK = os.environ.get("RC_METRICS")  # metrics endpoint (unix socket)
+CONFIG_FILE = os.environ.get("RC_CONFIG")  # routing, re-read on SIGHUP
+CERT = os.environ["RC_CERT"]
+KEY = os.environ["RC_KEY"]
+DEBUG = bool(os.environ.get("RC_DEBUG"))
+# How long a daemon with no sessions left keeps running (and its upstream pools
+# warm) for the next one.
+DAEMON_LINGER = float(os.environ.get("RC_DAEMON_LINGER") or 600)
+# Stream request bodies upstream as they arrive (route on the head alone) rather
+# than buffering them whole; "0" restores buffering for upstreams that cannot
+# take a chunked request body.
+STREAM_BODY = os.environ.get("RC_STREAM_BODY", "1") != "0"
+# Buffered bodies: total kept in memory, and the size past which one is spilled
+# to disk (see read_full_body()).
+BODY_MEM = int(os.environ.get("RC_BODY_MEM") or 64 << 20)
+BODY_SPILL = int(os.environ.get("RC_BODY_SPILL") or 1 << 20)
+# How much of a streamed body is kept to send again on a fresh connection when
+# a pooled one turns out dead (see StreamedBody).
+RETRY_KEEP = 256 << 10
+POOL_MAX = int(os.environ.get("RC_POOL_MAX") or 8)
+POOL_IDLE = float(os.environ.get("RC_POOL_IDLE") or 30)
+CLIENT_KEEPALIVE = os.environ.get("RC_CLIENT_KEEPALIVE") == "1"
+H2 = os.environ.get("RC_H2") == "1" and h2 is not None
+# RC_H2 receive windows: per stream, what one slow client can leave buffered
+# for it; per connection, credited as data arrives (see H2Upstream).
+H2_STREAM_WINDOW = 1 << 20
+H2_CONN_WINDOW = 16 << 20
+# Upstream name resolution: answers are cached this long, and the last good one
+# is still used this much longer while lookups fail (see Resolver).
+DNS_TTL = float(os.environ.get("RC_DNS_TTL") or 60)
+DNS_STALE = float(os.environ.get("RC_DNS_STALE") or 300)
+HAPPY_DELAY = 0.25              # RFC 8305's recommended connection attempt delay
+# uvloop.run() arrived in uvloop 0.18; anything older counts as not installed.
+UVLOOP = os.environ.get("RC_UVLOOP") == "1" and hasattr(uvloop, "run")
+# Relay tunnels and close-delimited responses transport to transport (Splice);
+# "0" falls back to the StreamReader copy loop (bench.py relay compares them).
+SPLICE = os.environ.get("RC_SPLICE", "1") != "0"
+# Parse heads with httptools' C parser (see parse_head_httptools()).
+HTTPTOOLS = os.environ.get("RC_HTTPTOOLS") == "1" and httptools is not None
+WORKERS = int(os.environ.get("RC_WORKERS") or 1)
+# Warm connections per upstream before the shim reports ready (see prewarm()).
+PREWARM = int(os.environ.get("RC_PREWARM") or 2)
+PREWARM_WAIT = float(os.environ.get("RC_PREWARM_WAIT") or 3)
+WORKER = None                   # this process's number under RC_WORKERS
+# Control-plane GETs answered from memory (see ResponseCache); empty = no cache.
+CACHE_PATHS = [p.strip() for p in (os.environ.get("RC_CACHE") or "").split(",") if p.strip()]
+CACHE_TTL = float(os.environ.get("RC_CACHE_TTL") or 60)
+CACHE_MAX = int(os.environ.get("RC_CACHE_MAX") or 8 << 20)
+# Concurrent upstream sends per class and in total (see Scheduler); 0 = no cap.
+LIMITS = {"inference": 8, "control": 0, "upgrade": 0, "total": 32}
+LIMITS.update((k.strip(), int(v)) for k, _, v in (
+    p.partition("=") for p in (os.environ.get("RC_LIMITS") or "").split(",") if p.strip()))
+# Connection timeouts (see Lifecycle); 0 = none.
+TIMEOUTS = {"head": 60, "idle": 600, "total": 3600, "stream": 300, "tunnel": 0}
+TIMEOUTS.update((k.strip(), float(v)) for k, _, v in (
+    p.partition("=") for p in (os.environ.get("RC_TIMEOUTS") or "").split(",") if p.strip()))
+# Sockets held at most before requests are shed (see Lifecycle), leaving room
+# under the open-file limit for listeners, logs and spooled bodies.
+_nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+FD_BUDGET = int(os.environ.get("RC_FD_BUDGET") or (
+    0 if _nofile == resource.RLIM_INFINITY else max(_nofile - 64, 64)))
+# Routing over a set of accounts (see Account): how long a throttled account is
+# held off without a Retry-After, and the circuit breaker for failing ones.
+ACCOUNT_HOLD = 10.0
+BREAKER_FAILS = 3
+BREAKER_OPEN = 30.0
+BREAKER_MAX = 300.0
+TTFB_ALPHA = 0.3                # weight of the newest time to first byte
+# Always-on ring of recent request records (see Trace).
+TRACE_SIZE = int(os.environ.get("RC_TRACE") or 1024)
+TRACE_FILE = os.environ.get("RC_TRACE_FILE") or None
+TRACE_FLUSH = 1.0               # seconds between RC_TRACE_FILE batches
+# Traffic capture for `bench.py replay` (see Capture); off unless set.
+CAPTURE_FILE = os.environ.get("RC_CAPTURE") or None
+
+_an = urllib.parse.urlparse(os.environ.get("RC_ANTHROPIC_URL") or "https://api.anthropic.com")
+ANTHROPIC_HOST = _an.hostname
+ANTHROPIC_PORT = _an.port or 443
+
+
+# Process-wide counters; never bodies, headers or tokens. Dumped on SIGUSR1.
+stats = collections.Counter()
+
+# Upper bounds (seconds) of the latency histogram buckets; the last is +Inf.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(BUCKETS, v)] += 1
+        self.sum += v
+
+
+class DestMetrics:
+    """Per-destination latency histograms and counters: only timings, sizes,
+    status classes and error classes — never bodies, headers or tokens."""
+
+    HISTOGRAMS = ("dns", "connect", "tls_handshake", "ttfb", "duration",
+                  "ttft", "event_gap", "stream")
+
+    def __init__(self):
+        self.hist = {name: Histogram() for name in self.HISTOGRAMS}
+        self.requests = collections.Counter()   # status class ("2xx", "none") -> n
+        self.errors = collections.Counter()     # error class -> n
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.inflight = 0
+        self.tokens = collections.Counter()     # model token kind -> n (SSE usage)
+
+
+# dest (`aiolos[<acct>]` / `aiolos[lb]` / `anthropic` / `upgrade` / `cache` /
+# `coalesced`) -> DestMetrics
+metrics = collections.defaultdict(DestMetrics)
+
+# Session name -> model token kind -> n. Kept after a daemon session closes, so
+# the totals cover the shim's whole life.
+session_tokens = collections.defaultdict(collections.Counter)
+
+# `usage` fields of message_start / message_delta -> token kind. The values are
+# running totals for the message, so only increases are counted.
+USAGE_FIELDS = (("input_tokens", "input"), ("output_tokens", "output"),
+                ("cache_read_input_tokens", "cache_read"),
+                ("cache_creation_input_tokens", "cache_write"))
+USAGE_EVENTS = (b"message_start", b"message_delta")
+
+
+def error_class(e):
+    if isinstance(e, ssl.SSLError):
+        return "tls"
+    if isinstance(e, socket.gaierror):
+        return "dns"
+    if isinstance(e, ConnectionRefusedError):
+        return "refused"
+    if isinstance(e, (asyncio.IncompleteReadError, ConnectionResetError,
+                      BrokenPipeError)):
+        return "reset"
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(e, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(e, OSError):
+        return "os"
+    return "protocol"
+
+
+class Exchange:
+    """Timing record of one request (or upgrade tunnel), folded into `metrics`
+    when it finishes. Times are seconds since the request head arrived; byte
+    counts are body bytes as relayed (everything, for a tunnel). For an SSE
+    response, SSEWatch adds the event count, time to first token (the first
+    content_block_delta), the longest gap between events, how long the stream
+    ran and the message's token usage. `conn` is how the upstream was reached:
+    "new", "pooled" or "h2"; `wait` how long the send queued (see Scheduler);
+    `retry_after` the seconds a 429/503/529 response asked for;
+    `client_error` whether `error` came from the client's side (it hung up or
+    stalled while sending its body), which says nothing of the upstream.
+    Under RC_CAPTURE, `shape` collects the request's Shape from its `head` on."""
+    __slots__ = ("dest", "start", "status", "ttfb", "bytes_up", "bytes_down", "error",
+                 "client_error", "events", "ttft", "max_gap", "stream", "tokens",
+                 "session", "method", "path", "conn", "wait", "retry_after", "shape")
+
+    def __init__(self, dest, start, session=None, method=None, path=None, head=None):
+        self.dest = dest
+        self.start = start
+        self.session = session
+        self.method = method
+        self.path = path
+        self.conn = None
+        self.wait = None
+        self.retry_after = None
+        self.status = None
+        self.ttfb = None
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.error = None
+        self.client_error = False
+        self.events = 0
+        self.ttft = None
+        self.max_gap = 0.0
+        self.stream = None
+        self.tokens = None
+        self.shape = Shape(start, head) if capture.path and head is not None else None
+        metrics[dest].inflight += 1
+
+    def failure(self):
+        """The class of `error` (see error_class()), or `client`."""
+        return "client" if self.client_error else error_class(self.error)
+
+    def first_byte(self):
+        if self.ttfb is None:
+            self.ttfb = time.monotonic() - self.start
+
+    def timings(self):
+        def s(v):
+            return "-" if v is None else f"{v:.3f}s"
+        out = (f"first byte {s(self.ttfb)}, first token {s(self.ttft)}, "
+               f"longest gap {s(self.max_gap)}, stream {s(self.stream)}")
+        if self.tokens:
+            out += "; tokens " + " ".join(f"{k}={n}" for k, n in self.tokens.items())
+        return out
+
+    def finish(self):
+        m = metrics[self.dest]
+        m.inflight -= 1
+        m.hist["duration"].observe(time.monotonic() - self.start)
+        if self.ttfb is not None:
+            m.hist["ttfb"].observe(self.ttfb)
+        if self.ttft is not None:
+            m.hist["ttft"].observe(self.ttft)
+        if self.stream is not None:
+            m.hist["stream"].observe(self.stream)
+        m.requests[f"{self.status // 100}xx" if self.status else "none"] += 1
+        if self.error is not None:
+            m.errors[self.failure()] += 1
+        m.bytes_up += self.bytes_up
+        m.bytes_down += self.bytes_down
+        trace.add(self)
+        if self.shape is not None:
+            capture.add(self)
+
+
+class Trace:
+    """Fixed-size ring of the last RC_TRACE finished requests, always on: one
+    flat dict each, built when the request finishes, with no I/O on the
+    request path. A record holds when the request head arrived (`t`, Unix
+    time), session, method, path without its query string, destination,
+    status, how the upstream was reached, body bytes each way, the phase
+    timings of its Exchange and the error class, if any; never headers,
+    bodies or credentials. Read back with SIGUSR2 (stderr) or `/trace` on the
+    metrics socket. With RC_TRACE_FILE the records are also appended to that
+    file as NDJSON by flush_loop(), a batch at a time, so a crash loses at
+    most the last TRACE_FLUSH seconds."""
+
+    PENDING_MAX = 8192          # records held for RC_TRACE_FILE; beyond, dropped
+    KIND = "trace"              # names its stats counters
+
+    def __init__(self, size, path=None):
+        self.ring = collections.deque(maxlen=size)
+        self.path = path
+        self.pending = []
+
+    def add(self, rec):
+        if not self.ring.maxlen and not self.path:
+            return
+        out = self.record(rec, time.monotonic())
+        self.ring.append(out)
+        if self.path:
+            if len(self.pending) < self.PENDING_MAX:
+                self.pending.append(out)
+            else:
+                stats[f"{self.KIND}_dropped"] += 1
+
+    def record(self, rec, now):
+        def r(v):
+            return None if v is None else round(v, 4)
+
+        out = {"t": round(time.time() - (now - rec.start), 3), "session": rec.session,
+               "method": rec.method, "path": rec.path and rec.path.partition("?")[0],
+               "dest": rec.dest, "status": rec.status, "conn": rec.conn, "wait": r(rec.wait),
+               "up": rec.bytes_up, "down": rec.bytes_down, "ttfb": r(rec.ttfb),
+               "dur": r(now - rec.start)}
+        if rec.events:
+            out.update(events=rec.events, ttft=r(rec.ttft), max_gap=r(rec.max_gap),
+                       stream=r(rec.stream))
+        if rec.tokens:
+            out["tokens"] = dict(rec.tokens)
+        if rec.error is not None:
+            out["error"] = rec.failure()
+        if WORKER is not None:
+            out["worker"] = WORKER
+        return out
+
+    def records(self, n=None):
+        """The ring's records, oldest first; only the last `n` if given."""
+        recs = list(self.ring)
+        return recs[-n:] if n else recs
+
+    async def flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(TRACE_FLUSH)
+            if not self.pending:
+                continue
+            batch, self.pending = self.pending, []
+            data = "".join(json.dumps(r) + "\n" for r in batch).encode()
+            try:
+                await loop.run_in_executor(None, self._append, data)
+                stats[f"{self.KIND}_written"] += len(batch)
+            except OSError as e:
+                stats[f"{self.KIND}_dropped"] += len(batch)
+                log(f"{self.KIND} file {self.path}: {e}")
+
+    def _append(self, data):
+        # One O_APPEND write per batch: workers sharing the file don't interleave.
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+trace = Trace(TRACE_SIZE, TRACE_FILE)
+
+# Header values a capture keeps as sent (they frame the message or say what
+# it is); any other value is recorded as its length only.
+CAPTURE_VALUES = frozenset((
+    "host", "content-type", "content-length", "transfer-encoding", "content-encoding",
+    "connection", "upgrade", "expect", "accept", "accept-encoding", "cache-control",
+    "anthropic-version", "anthropic-beta", "retry-after"))
+
+
+class Shape:
+    """What RC_CAPTURE keeps of one request beyond its trace record: the header
+    fields each way, as [name, value] with the value only for CAPTURE_VALUES
+    names and otherwise its length; when body bytes went by each way, as
+    [seconds since the head, bytes] pieces; and each SSE event as [seconds,
+    type, bytes]. Enough to play the request back with the same sizes and
+    timing (`bench.py replay`), and nothing of what it said."""
+    __slots__ = ("start", "req", "resp", "up_at", "down_at", "sse")
+
+    def __init__(self, start, head):
+        self.start = start
+        self.req = self.fields(head)
+        self.resp = None
+        self.up_at = []
+        self.down_at = []
+        self.sse = []
+
+    @staticmethod
+    def fields(head):
+        return [[k, v if k.lower() in CAPTURE_VALUES else len(v)]
+                for k, v in head if not k.startswith(":")]
+
+    def response(self, head):
+        self.resp = self.fields(head)
+
+    def up(self, n):
+        self._piece(self.up_at, n)
+
+    def down(self, n):
+        self._piece(self.down_at, n)
+
+    def _piece(self, pieces, n):
+        t = round(time.monotonic() - self.start, 3)
+        if pieces and pieces[-1][0] == t:
+            pieces[-1][1] += n          # same millisecond: one piece
+        else:
+            pieces.append([t, n])
+
+    def event(self, kind, size):
+        self.sse.append([round(time.monotonic() - self.start, 4),
+                         kind.decode("latin1"), size])
+
+    def record(self, rec, dur):
+        """The capture's own fields. Bytes no piece accounts for (relayed
+        transport to transport: tunnels, close-delimited bodies) are put at
+        the end."""
+        for pieces, total in ((self.up_at, rec.bytes_up), (self.down_at, rec.bytes_down)):
+            rest = total - sum(n for _, n in pieces)
+            if rest > 0:
+                pieces.append([round(dur, 3), rest])
+        out = {"req": self.req, "resp": self.resp, "up_at": self.up_at,
+               "down_at": self.down_at}
+        if self.sse:
+            out["sse"] = self.sse
+        return out
+
+
+class Capture(Trace):
+    """RC_CAPTURE: each finished request's trace record with its Shape added,
+    appended to a file as NDJSON in the same batches as RC_TRACE_FILE (so a
+    crash loses at most the last TRACE_FLUSH seconds). Nothing is kept in
+    memory beyond the pending batch. A capture holds no prompts, completions
+    or credentials, so it can be passed around to reproduce a slow session
+    against local stand-ins."""
+
+    KIND = "capture"
+
+    def __init__(self, path):
+        super().__init__(0, path)
+
+    def record(self, rec, now):
+        out = super().record(rec, now)
+        out.update(rec.shape.record(rec, now - rec.start))
+        return out
+
+
+capture = Capture(CAPTURE_FILE)
+
+
+class SSEWatch:
+    """Follows an SSE response body as it is relayed, without holding it back
+    or changing it: finds each event's boundary, notes its `event:` type, and
+    records event timings on the request's Exchange. The `usage` of
+    message_start / message_delta events is added to the destination's and the
+    session's token counters as it arrives. Only the current event is buffered,
+    and only up to its first KiB (enough for the type line) unless it is one of
+    those two."""
+    __slots__ = ("rec", "hist", "tally", "buf", "kind", "dropped", "crlf", "opened",
+                 "last")
+
+    def __init__(self, rec, tokens):
+        self.rec = rec
+        self.hist = metrics[rec.dest].hist["event_gap"]
+        self.tally = (metrics[rec.dest].tokens, tokens)
+        self.buf = b""          # the current event so far (capped)
+        self.kind = None        # type of a long event whose start was dropped
+        self.dropped = 0        # how much of it was
+        self.crlf = False       # seen a CR: boundaries may be CRLF CRLF too
+        self.opened = time.monotonic()
+        self.last = None
+
+    def feed(self, data):
+        """Returns how many events `data` completed."""
+        if self.buf:
+            data = self.buf + data
+        self.crlf = self.crlf or b"\r" in data
+        pos = n = 0
+        while True:
+            end = data.find(b"\n\n", pos)
+            if self.crlf:
+                j = data.find(b"\n\r\n", pos)
+                if 0 <= j and (end < 0 or j < end):
+                    end = j + 1
+            if end < 0:
+                break
+            size = self.dropped + end + 2 - pos
+            if self.kind is not None:
+                self._event(self.kind, size)    # head dropped, so no usage to read
+            else:
+                kind = self._kind(data, pos)
+                self._event(kind, size)
+                if kind in USAGE_EVENTS:
+                    self._usage(data[pos:end])
+            self.kind = None
+            self.dropped = 0
+            pos = end + 2
+            n += 1
+        if len(data) - pos > 1024:
+            if self.kind is None:
+                kind = self._kind(data, pos)
+                if kind in USAGE_EVENTS and len(data) - pos <= 65536:
+                    self.buf = data[pos:]
+                    return n
+                self.kind = kind
+            self.dropped += len(data) - 2 - pos
+            pos = len(data) - 2     # keep enough to spot a boundary split across reads
+        self.buf = data[pos:]
+        return n
+
+    @staticmethod
+    def _kind(data, pos):
+        if not data.startswith(b"event:", pos):
+            return b""
+        nl = data.find(b"\n", pos)
+        return data[pos + 6:nl if nl >= 0 else None].strip()
+
+    def _event(self, kind, size):
+        now = time.monotonic()
+        rec = self.rec
+        if rec.shape is not None:
+            rec.shape.event(kind, size)
+        if self.last is not None:
+            gap = now - self.last
+            self.hist.observe(gap)
+            rec.max_gap = max(rec.max_gap, gap)
+        self.last = now
+        rec.events += 1
+        if kind == b"content_block_delta" and rec.ttft is None:
+            rec.ttft = now - rec.start
+
+    def _usage(self, event):
+        try:
+            msg = json.loads(b"\n".join(
+                line[6:] if line.startswith(b"data: ") else line[5:]
+                for line in event.splitlines() if line.startswith(b"data:")))
+            usage = dict(msg.get("usage") or msg["message"]["usage"])
+        except (ValueError, LookupError, TypeError, AttributeError):
+            stats["sse_usage_unparsed"] += 1
+            return
+        seen = self.rec.tokens
+        if seen is None:
+            seen = self.rec.tokens = {}
+        for field, kind in USAGE_FIELDS:
+            n = usage.get(field)
+            if type(n) is int and n > seen.get(kind, 0):
+                for counter in self.tally:
+                    counter[kind] += n - seen.get(kind, 0)
+                seen[kind] = n
+
+    def close(self):
+        if self.last is not None:
+            self.rec.stream = self.last - self.opened
+
+
+def is_sse(headers):
+    return any(k.lower() == "content-type" and v.lower().startswith("text/event-stream")
+               for k, v in headers)
+
+
+def retry_after(values):
+    """Seconds a Retry-After asks for (its delay-seconds form), or None."""
+    for v in values:
+        try:
+            return max(float(v), 0.0)
+        except ValueError:
+            pass
+    return None
+
+
+class ResumingContext(ssl.SSLContext):
+    """Client context that offers the last TLS session seen for a host when
+    wrapping a new connection. asyncio has no way to pass `session=` through
+    open_connection, but every connection it makes goes through wrap_bio.
+    Sessions are kept per context: OpenSSL refuses one from another context
+    (client_ctx and h2_ctx may well talk to the same host)."""
+
+    sessions = {}               # (context, host) -> ssl.SSLSession
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get((self, server_hostname))
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+
+def remember_session(writer):
+    """Keep the upstream's latest session (TLS 1.3 tickets arrive after the
+    handshake, so call this once the connection has carried a response)."""
+    sslobj = writer.get_extra_info("ssl_object")
+    if sslobj is not None and sslobj.session is not None:
+        ResumingContext.sessions[(sslobj.context, sslobj.server_hostname)] = sslobj.session
+
+
+def make_server_ctx():
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certfile=CERT, keyfile=KEY)
+    # Resumable sessions for the local client: a ticket lets a reconnect skip the
+    # certificate exchange and key signature. Tickets are on by default in OpenSSL;
+    # pin that down so a reconnect from Claude can resume.
+    ctx.options &= ~ssl.OP_NO_TICKET
+    ctx.num_tickets = int(os.environ.get("RC_TLS_TICKETS") or 2)
+    return ctx
+
+
+server_ctx = make_server_ctx()
+
+
+def make_client_ctx(alpn=None):
+    ctx = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if os.environ.get("RC_UPSTREAM_CA"):
+        ctx.load_verify_locations(cafile=os.environ["RC_UPSTREAM_CA"])
+    else:
+        ctx.load_default_certs()
+    if alpn:
+        ctx.set_alpn_protocols(alpn)
+    return ctx
+
+
+client_ctx = make_client_ctx()
+# Separate context for RC_H2: offering h2 via ALPN on the HTTP/1.1 pool's
+# connections would let a server switch them to a protocol we then don't speak.
+h2_ctx = make_client_ctx(["h2", "http/1.1"])
+
+
+def load_tls():
+    """Fresh TLS contexts from RC_CERT, RC_KEY and RC_UPSTREAM_CA as they are
+    on disk now (rotated certs, say), for use_tls(). Raises on a bad cert, key
+    or CA, before anything in use has changed."""
+    return make_server_ctx(), make_client_ctx(), make_client_ctx(["h2", "http/1.1"])
+
+
+def use_tls(fresh):
+    """Switch to contexts from load_tls(). Every listener holds server_ctx, so
+    it is reloaded in place: handshakes from now on present the new chain,
+    connections already up keep theirs. The client contexts are swapped, and
+    their sessions dropped with them; pooled upstream connections stay in use
+    (they were verified when they were opened)."""
+    global client_ctx, h2_ctx
+    _, client_ctx, h2_ctx = fresh
+    server_ctx.load_cert_chain(certfile=CERT, keyfile=KEY)
+    ResumingContext.sessions.clear()
+
+
+# Methods a stale pooled connection may send again after the whole request
+# went out (RFC 9110 9.2.2); anything else is only retried if sending failed.
+IDEMPOTENT = frozenset(("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"))
+
+HOP_BY_HOP = {
+    "host", "connection", "proxy-connection", "keep-alive",
+    "transfer-encoding", "upgrade", "te", "trailer",
+    # We re-frame the body (re-chunk, or dechunk + buffer) and append our own
+    # Content-Length / Transfer-Encoding below, so the shim must own framing
+    # exclusively. Forwarding the client's Content-Length too would emit a
+    # duplicate header, which RFC 9110 forbids and strict upstream parsers
+    # reject as smuggling.
+    "content-length",
+    # never let the client smuggle its own pin
+    "x-aiolos-account-id", "x-aiolos-force-account-strict",
+}
+# Request headers not forwarded: the above, and Expect (the shim answers it).
+HOP_BY_HOP_REQUEST = HOP_BY_HOP | {"expect"}
+# Request headers not forwarded through an upgrade tunnel.
+UPGRADE_DROP = frozenset(("host", "x-aiolos-account-id", "x-aiolos-force-account-strict"))
+# Upstream response headers not relayed: the shim decides the client
+# connection's fate itself.
+RESPONSE_DROP = frozenset(("connection", "keep-alive", "proxy-connection"))
+
+
+def log(msg):
+    if DEBUG:
+        sys.stderr.write(f"[shim] {msg}\n")
+        sys.stderr.flush()
+
+
+def host_header(host, port):
+    return host if port in (443, 80) else f"{host}:{port}"
+
+
+def is_inference(path):
+    return path.split("?", 1)[0].startswith("/v1/messages")
+
+
+class Account:
+    """What the shim has seen of one aiolos account, shared by every session
+    routing over it (see AccountSet): requests in flight, a moving average of
+    time to first byte, and whether it is held off.
+
+    A 429, 503 or 529 holds the account off for its Retry-After, else for
+    ACCOUNT_HOLD seconds, doubling while they repeat; being throttled is an
+    answer, not a failure. Failures (no response at all, or any other 5xx)
+    feed a circuit breaker, unless the client hung up or stalled on its
+    upload (Exchange.client_error): BREAKER_FAILS in a row open it for
+    BREAKER_OPEN seconds, doubling up to BREAKER_MAX while it keeps failing.
+    Once that passes, one trial request goes through (half-open), and its
+    outcome closes the breaker or opens it again."""
+
+    __slots__ = ("id", "dest", "inflight", "ttfb", "last", "held_until", "holds",
+                 "fails", "open_until", "backoff", "trial")
+
+    THROTTLE = (429, 503, 529)
+
+    def __init__(self, account_id):
+        self.id = account_id
+        self.dest = "aiolos[" + account_id + "]"
+        self.inflight = 0
+        self.ttfb = None            # seconds, moving average of successes
+        self.last = 0.0             # when it was last picked
+        self.held_until = 0.0
+        self.holds = 0              # throttling responses in a row
+        self.fails = 0              # failures in a row
+        self.open_until = 0.0
+        self.backoff = 0.0
+        self.trial = False          # a half-open trial is in flight
+
+    def ready_at(self, now):
+        """When the account can next take a request (<= now: at once)."""
+        at = self.held_until
+        if self.fails >= BREAKER_FAILS:
+            at = max(at, self.open_until if not self.trial else now + BREAKER_OPEN)
+        return at
+
+    def begin(self):
+        now = time.monotonic()
+        self.inflight += 1
+        self.last = now
+        if self.fails >= BREAKER_FAILS and self.open_until <= now:
+            self.trial = True
+
+    def end(self, rec):
+        self.inflight -= 1
+        trial, self.trial = self.trial, False
+        now = time.monotonic()
+        status = rec.status
+        throttled = status in self.THROTTLE
+        if throttled:
+            self.holds += 1
+            hold = rec.retry_after or ACCOUNT_HOLD * 2 ** (self.holds - 1)
+            self.held_until = now + min(hold, BREAKER_MAX)
+            stats["account_held"] += 1
+            log(f"account {self.id}: {status}; held off {min(hold, BREAKER_MAX):.0f}s")
+        if status is None or (status >= 500 and not throttled):
+            if status is None and (rec.error is None or rec.client_error
+                                   or isinstance(rec.error, asyncio.CancelledError)):
+                return              # the client went away; says nothing of the account
+            self.fails += 1
+            if self.fails >= BREAKER_FAILS:
+                self.backoff = min(self.backoff * 2 or BREAKER_OPEN, BREAKER_MAX)
+                self.open_until = now + self.backoff
+                stats["breaker_opened"] += 1
+                log(f"account {self.id}: {self.fails} failures; breaker open "
+                    f"{self.backoff:.0f}s")
+            return
+        if not throttled:
+            self.holds = 0
+        if self.fails >= BREAKER_FAILS or trial:
+            stats["breaker_closed"] += 1
+            log(f"account {self.id}: breaker closed")
+        self.fails = 0
+        self.backoff = 0.0
+        if rec.ttfb is not None and not throttled:
+            self.ttfb = rec.ttfb if self.ttfb is None else (
+                self.ttfb + TTFB_ALPHA * (rec.ttfb - self.ttfb))
+
+    def state(self, now):
+        if self.fails >= BREAKER_FAILS:
+            return "open" if self.ready_at(now) > now else "half-open"
+        return "held" if self.held_until > now else "ok"
+
+
+# Account id -> Account, for every account a session routes over.
+accounts = {}
+
+
+class AccountSet:
+    """Per-request choice among a session's accounts: the one with the least
+    expected wait, (in flight + 1) x average time to first byte, among those
+    not held off (see Account). An account not measured yet counts as the
+    average of the others, so it gets tried. Ties go to the least recently
+    picked. If every account is held off, the first to be free again is
+    used: a request is never refused here."""
+
+    def __init__(self, ids):
+        self.members = [accounts.setdefault(i, Account(i)) for i in ids]
+
+    def pick(self):
+        now = time.monotonic()
+        ready = [a for a in self.members if a.ready_at(now) <= now]
+        if not ready:
+            stats["account_none_ready"] += 1
+            return min(self.members, key=lambda a: a.ready_at(now))
+        known = [a.ttfb for a in ready if a.ttfb is not None]
+        guess = sum(known) / len(known) if known else 1.0
+        return min(ready, key=lambda a: ((a.inflight + 1) * (a.ttfb or guess),
+                                         a.inflight, a.last))
+
+
+class Session:
+    """Routing config and log for one Claude session. A standalone shim has
+    exactly one; a shared daemon one per registered session, each on its own
+    listener, while the upstream pools are shared by all of them (keyed by
+    dest, so pins never mix)."""
+
+    def __init__(self, aiolos_url, account_id="", name="", logfile=None, debug=DEBUG):
+        self.configure(aiolos_url, account_id)
+        self.name = name
+        self.tokens = session_tokens[name]      # model token kind -> n
+        self.debug = debug
+        self.out = open(logfile, "a") if logfile else sys.stderr
+        self.server = None
+
+    def configure(self, aiolos_url, account_id=""):
+        """Set where the session routes; again on a reload (see reload()).
+        Requests already routed carry on where they were sent. A bad URL
+        raises before anything has changed."""
+        au = urllib.parse.urlparse(aiolos_url or "")
+        tls = au.scheme == "https"
+        port = au.port or (443 if tls else 80)
+        if not au.hostname:
+            raise ValueError("no aiolos host in the aiolos URL")
+        # Empty -> no-pin mode: forward inference to aiolos with no account header,
+        # so aiolos load-balances across all accounts as it normally does.
+        account_id = account_id or ""
+        ids = [a.strip() for a in account_id.split(",") if a.strip()]
+        self.aiolos_url = aiolos_url
+        self.aiolos_host, self.aiolos_port, self.aiolos_tls = au.hostname, port, tls
+        self.account_id = account_id
+        self.accounts = AccountSet(ids) if len(ids) > 1 else None
+
+    def log(self, msg):
+        if self.debug:
+            try:
+                self.out.write(f"[shim] {msg}\n")
+                self.out.flush()
+            except Exception:
+                pass
+
+    def route(self, path):
+        """(host, port, tls, extra headers, dest) for a non-upgrade request."""
+        if not is_inference(path):
+            return ANTHROPIC_HOST, ANTHROPIC_PORT, True, [], "anthropic"
+        return self._aiolos(self.accounts.pick().id if self.accounts else self.account_id)
+
+    def _aiolos(self, account_id):
+        if account_id:
+            extra = [("x-aiolos-account-id", account_id),
+                     ("x-aiolos-force-account-strict", "true")]
+            dest = "aiolos[" + account_id + "]"
+        else:
+            extra = []                # no pin -> aiolos load-balances
+            dest = "aiolos[lb]"
+        return self.aiolos_host, self.aiolos_port, self.aiolos_tls, extra, dest
+
+    def routes(self):
+        """Every route this session can take: the control plane, and the aiolos
+        pin (each of them, for a set of accounts)."""
+        ids = [a.id for a in self.accounts.members] if self.accounts else [self.account_id]
+        return [self.route("/")] + [self._aiolos(i) for i in ids]
+
+    def mode(self):
+        if self.accounts:
+            return "accounts:" + self.account_id
+        return "pinned:" + self.account_id if self.account_id else "load-balanced"
+
+    def describe(self):
+        acct = self.account_id if self.account_id else "(load-balanced)"
+        return (f"inference->aiolos({self.aiolos_host}:{self.aiolos_port}) "
+                f"acct={acct}  rest->{ANTHROPIC_HOST}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()     # stop accepting; in-flight requests finish
+        if self.out is not sys.stderr:
+            self.out.close()
+
+
+class Head:
+    """One parsed HTTP head. Iterates as its (name, value) fields, in order and
+    as sent; `names` holds the same names lowercased, so nothing downstream
+    lowercases them again. The facts routing and framing need are read off in
+    the same pass:
+
+      clen      Content-Length (None if absent, -1 if not a number)
+      chunked   Transfer-Encoding includes chunked
+      expect    Expect: 100-continue
+      upgrade   a real protocol upgrade (WebSocket): `Upgrade: <proto>` and/or
+                `Connection: Upgrade`; only this turns a connection into a
+                raw tunnel
+      close     Connection: close
+      sse       Content-Type: text/event-stream"""
+    __slots__ = ("start", "fields", "names", "clen", "chunked", "expect", "upgrade",
+                 "close", "sse")
+
+    def __init__(self, start, fields):
+        self.start = start
+        self.fields = fields
+        self.names = names = [k.lower() for k, _ in fields]
+        self.clen = None
+        self.chunked = self.expect = self.upgrade = self.close = self.sse = False
+        for (_, v), kl in zip(fields, names):
+            if kl in HEAD_FACTS:
+                self._note(kl, v)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def values(self, name):
+        """Every value of the (lowercase) header `name`, in order."""
+        return [f[1] for f, n in zip(self.fields, self.names) if n == name]
+
+    def without(self, names):
+        """The fields whose (lowercase) name is not in `names`."""
+        return [f for f, n in zip(self.fields, self.names) if n not in names]
+
+    def _note(self, kl, value):
+        vl = value.lower()
+        if kl == "content-length":
+            try:
+                self.clen = int(value)
+            except ValueError:
+                self.clen = -1
+        elif kl == "transfer-encoding":
+            self.chunked = self.chunked or "chunked" in vl
+        elif kl == "connection":
+            self.upgrade = self.upgrade or "upgrade" in vl
+            self.close = self.close or "close" in vl
+        elif kl == "upgrade":
+            self.upgrade = self.upgrade or bool(value)
+        elif kl == "expect":
+            self.expect = self.expect or "100-continue" in vl
+        elif kl == "content-type":
+            self.sse = vl.startswith("text/event-stream")
+
+
+HEAD_FACTS = frozenset(("content-length", "transfer-encoding", "connection", "upgrade",
+                        "expect", "content-type"))
+
+
+def parse_head_py(head):
+    """Parse a raw HTTP head (request or response, up to its blank line) into a
+    Head; lenient about what it does not need."""
+    lines = head.split(b"\r\n")
+    return Head(lines[0].decode("latin1"),
+                [(k.decode("latin1").strip(), v.decode("latin1").strip())
+                 for k, _, v in [ln.partition(b":") for ln in lines[1:] if ln]])
+
+
+class _HeadFields:
+    """httptools parser callbacks: collects the header fields."""
+    __slots__ = ("fields",)
+
+    def __init__(self):
+        self.fields = []
+
+    def on_header(self, name, value):
+        self.fields.append((name, value))
+
+
+def parse_head_httptools(head):
+    """parse_head_py() on httptools' C parser. A head it rejects (it is strict
+    where the Python parser is lenient) is parsed in Python after all."""
+    cb = _HeadFields()
+    try:
+        (httptools.HttpResponseParser if head.startswith(b"HTTP/")
+         else httptools.HttpRequestParser)(cb).feed_data(head)
+    except httptools.HttpParserUpgrade:
+        pass
+    except httptools.HttpParserError:
+        stats["parse_fallback"] += 1
+        return parse_head_py(head)
+    return Head(head[:head.index(b"\r\n")].decode("latin1"),
+                [(k.decode("latin1"), v.decode("latin1")) for k, v in cb.fields])
+
+
+parse_head = parse_head_httptools if HTTPTOOLS else parse_head_py
+
+
+async def read_headers(reader):
+    return parse_head(await reader.readuntil(b"\r\n\r\n"))
+
+
+async def read_chunks(reader):
+    """Yield the payload of a chunked body piece by piece (at most 64 KiB each),
+    consuming the terminating chunk and any trailers (which are dropped)."""
+    while True:
+        size_line = await reader.readuntil(b"\r\n")
+        size = int(size_line.strip().split(b";")[0] or b"0", 16)
+        if size == 0:
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass            # trailer field; never forwarded
+            return
+        while size:
+            data = await reader.readexactly(min(size, 65536))
+            size -= len(data)
+            yield data
+        await reader.readexactly(2)
+
+
+async def read_sized(reader, clen):
+    """Yield a Content-Length body piece by piece (at most 64 KiB each)."""
+    while clen:
+        data = await reader.read(min(clen, 65536))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", clen)
+        clen -= len(data)
+        yield data
+
+
+class BodyBudget:
+    """Bytes of buffered request bodies held in memory, across all requests.
+    A body waits for room before it starts buffering (so its client is not
+    read meanwhile); one that already holds memory never waits, it spills
+    instead, so bodies can never hold up each other for good."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiters = []
+
+    def try_take(self, n):
+        if self.used and self.used + n > self.limit:
+            return False
+        self.used += n
+        return True
+
+    async def take(self, n):
+        while not self.try_take(n):
+            stats["body_mem_waits"] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def give(self, n):
+        if n:
+            self.used -= n
+            for waiter in self.waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.waiters.clear()
+
+
+body_budget = BodyBudget(BODY_MEM)
+
+
+class Slot:
+    """One admitted upstream send (see Scheduler); release() is idempotent."""
+    __slots__ = ("sched", "cls", "dest", "wait")
+
+    def __init__(self, sched, cls, dest, wait):
+        self.sched = sched
+        self.cls = cls
+        self.dest = dest
+        self.wait = wait
+
+    def release(self):
+        if self.sched is not None:
+            self.sched.release(self.cls, self.dest)
+            self.sched = None
+
+
+class Scheduler:
+    """Admission of upstream sends: the request head and body, from before the
+    upstream connection is taken until the body is out (for an upgrade, the
+    handshake up to the tunnel). A class's destinations are capped at
+    RC_LIMITS[class] each (inference per aiolos pin), and inference sends
+    together at RC_LIMITS["total"]; control and upgrade sends neither count
+    towards `total` nor wait for it, so a remote-control heartbeat never
+    queues behind bulk uploads. A request over a cap waits, without reading
+    its body, until a slot frees; waiters are admitted upgrade first, then
+    control, then inference. Within a class, sessions take turns (round robin), so on a shared
+    daemon one busy session cannot starve the others. Waiting never blocks a
+    request whose own caps have room."""
+
+    CLASSES = ("upgrade", "control", "inference")      # highest priority first
+    UNTOTALLED = ("upgrade", "control")                 # outside RC_LIMITS["total"]
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.busy = collections.Counter()       # dest -> admitted sends
+        self.total = 0
+        # class -> session -> deque of (dest, future), sessions in turn order
+        self.queues = {c: collections.OrderedDict() for c in self.CLASSES}
+        self.queued = collections.Counter()     # class -> waiting now
+        self.waits = {c: Histogram() for c in self.CLASSES}
+
+    def _room(self, cls, dest):
+        cap, total = self.limits.get(cls, 0), self.limits.get("total", 0)
+        return ((not cap or self.busy[dest] < cap) and
+                (not total or cls in self.UNTOTALLED or self.total < total))
+
+    def _take(self, cls, dest):
+        self.busy[dest] += 1
+        if cls not in self.UNTOTALLED:
+            self.total += 1
+
+    async def acquire(self, cls, dest, session):
+        """Wait for a send slot for `dest`, of class `cls`, on behalf of
+        `session` (its name); returns the Slot."""
+        if self._room(cls, dest):
+            self._take(cls, dest)
+            self.waits[cls].observe(0.0)
+            return Slot(self, cls, dest, 0.0)
+        t0 = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self.queues[cls].setdefault(session, collections.deque()).append((dest, fut))
+        self.queued[cls] += 1
+        stats[f"sched_{cls}_waited"] += 1
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release(cls, dest)     # admitted as it was cancelled
+            else:
+                self._forget(cls, session, dest, fut)
+            raise
+        wait = time.monotonic() - t0
+        self.waits[cls].observe(wait)
+        return Slot(self, cls, dest, wait)
+
+    def _forget(self, cls, session, dest, fut):
+        q = self.queues[cls]
+        waiting = q.get(session)
+        if waiting is not None and (dest, fut) in waiting:
+            waiting.remove((dest, fut))
+            self.queued[cls] -= 1
+            if not waiting:
+                del q[session]
+
+    def release(self, cls, dest):
+        self.busy[dest] -= 1
+        if not self.busy[dest]:
+            del self.busy[dest]
+        if cls not in self.UNTOTALLED:
+            self.total -= 1
+        self._admit()
+
+    def _admit(self):
+        for cls in self.CLASSES:
+            q = self.queues[cls]
+            progress = True
+            while progress and q:
+                progress = False
+                for session in list(q):
+                    waiting = q[session]
+                    for entry in waiting:
+                        dest, fut = entry
+                        if not fut.cancelled() and self._room(cls, dest):
+                            break
+                    else:
+                        continue
+                    waiting.remove(entry)
+                    self.queued[cls] -= 1
+                    if waiting:
+                        q.move_to_end(session)      # its turn is over
+                    else:
+                        del q[session]
+                    self._take(cls, dest)
+                    fut.set_result(None)
+                    progress = True
+
+
+scheduler = Scheduler(LIMITS)
+
+
+class Tracked:
+    """One socket the shim holds (see Lifecycle): which side it is on, its
+    state and since when, and when bytes last arrived on it. A client
+    connection also has the task serving it and, while a request has one,
+    its HTTP/1.1 upstream connection (`peer`)."""
+    __slots__ = ("side", "state", "since", "last", "transport", "task", "peer", "expired")
+
+    def __init__(self, side, state, transport, task=None):
+        self.side = side
+        self.state = state
+        self.since = self.last = time.monotonic()
+        self.transport = transport
+        self.task = task
+        self.peer = None
+        self.expired = None         # the timeout that closed it
+
+    def touch(self):
+        self.last = time.monotonic()
+
+    def timeout(self):
+        """What a request on this connection ended with, if it timed out."""
+        return TimeoutError(f"{self.expired} timeout") if self.expired else None
+
+
+class Watched(asyncio.Protocol):
+    """Stands in front of a tracked connection's stream protocol: notes when
+    bytes arrive and forgets the connection once it is closed."""
+
+    def __init__(self, proto, tracked):
+        self.proto = proto
+        self.tracked = tracked
+
+    def connection_made(self, transport):
+        self.proto.connection_made(transport)
+
+    def data_received(self, data):
+        self.tracked.last = time.monotonic()
+        self.proto.data_received(data)
+
+    def eof_received(self):
+        return self.proto.eof_received()
+
+    def connection_lost(self, exc):
+        lifecycle.forget(self.tracked)
+        self.proto.connection_lost(exc)
+
+    def pause_writing(self):
+        self.proto.pause_writing()
+
+    def resume_writing(self):
+        self.proto.resume_writing()
+
+
+class Lifecycle:
+    """Every client and upstream connection, from accept (or connect) until
+    the socket is closed, by state:
+
+      client    head (waiting for a request head), request, queued (a
+                request waiting for a Scheduler slot), stream (an SSE
+                response), tunnel (after an upgrade)
+      upstream  busy (carrying a request), idle (pooled), h2
+
+    A watchdog closes client connections past their state's RC_TIMEOUTS
+    deadline, along with the upstream connection of the request and the task
+    serving it, so a stalled upstream or a half-open client never holds two
+    sockets and a task for ever. Idle time counts from the last bytes that
+    arrived on either of the two (or, for h2, that the stream delivered); a
+    queued request is not idle, so only its total timeout runs.
+
+    Past RC_FD_BUDGET sockets, the longest-idle pooled connections are closed
+    first, as many as it takes; if that is not enough, a new client
+    connection gets a 503 with Retry-After instead of a request served (see
+    shed()). Prewarming opens no more than the budget has room for."""
+
+    TICK = 2.0                  # seconds between watchdog passes
+
+    def __init__(self):
+        self.tracked = {}       # transport -> Tracked
+
+    def track(self, writer, side, state, task=None):
+        transport = writer.transport
+        t = self.tracked[transport] = Tracked(side, state, transport, task)
+        transport.set_protocol(Watched(transport.get_protocol(), t))
+        return t
+
+    def forget(self, t):
+        if t is not None and self.tracked.get(t.transport) is t:
+            del self.tracked[t.transport]
+
+    def of(self, writer):
+        return self.tracked.get(writer.transport)
+
+    def enter(self, writer, state):
+        t = self.tracked.get(writer.transport)
+        if t is not None:
+            t.state = state
+            t.since = t.last = time.monotonic()
+
+    async def queued(self, writer, wait):
+        """Await `wait` (a Scheduler slot) with `writer`'s connection queued,
+        then put it back in the state it was in."""
+        t = self.tracked.get(writer.transport)
+        if t is None:
+            return await wait
+        state, t.state = t.state, "queued"
+        try:
+            return await wait
+        finally:
+            t.state = state
+            t.touch()
+
+    def pair(self, cw, uw):
+        """Tie the upstream connection `uw` (None: none any more) to the
+        request on client connection `cw`."""
+        t = self.tracked.get(cw.transport)
+        if t is not None:
+            t.peer = self.tracked.get(uw.transport) if uw is not None else None
+
+    def counts(self):
+        out = collections.Counter((t.side, t.state) for t in self.tracked.values())
+        return dict(sorted(out.items()))
+
+    def held(self):
+        return sum(not t.transport.is_closing() for t in self.tracked.values())
+
+    def room(self):
+        """Sockets that can still be opened within RC_FD_BUDGET (None: no budget)."""
+        return None if FD_BUDGET <= 0 else max(FD_BUDGET - self.held(), 0)
+
+    def over_budget(self):
+        if FD_BUDGET <= 0 or len(self.tracked) <= FD_BUDGET:
+            return False
+        held = self.held()
+        if held > FD_BUDGET:
+            held -= pool.shrink(held - FD_BUDGET)   # idle pooled connections go first
+        return held > FD_BUDGET
+
+    def overdue(self, t, now):
+        """The timeout client connection `t` is past, if any."""
+        if t.state == "head":
+            return "head" if 0 < TIMEOUTS["head"] < now - t.since else None
+        if t.state != "queued":
+            last = max(t.last, t.peer.last) if t.peer is not None else t.last
+            idle = {"request": "idle"}.get(t.state, t.state)
+            if 0 < TIMEOUTS[idle] < now - last:
+                return idle
+        if t.state in ("request", "queued") and 0 < TIMEOUTS["total"] < now - t.since:
+            return "total"
+        return None
+
+    def expire(self, t, why):
+        t.expired = why
+        stats["timeout_" + why] += 1
+        log(f"{why} timeout: closing a {t.state} connection")
+        if why == "head":
+            t.transport.close()     # nothing in flight: a clean close will do
+        else:
+            t.transport.abort()
+            if t.peer is not None:
+                t.peer.transport.abort()
+        t.task.cancel()
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.TICK)
+            now = time.monotonic()
+            for t in list(self.tracked.values()):
+                if t.task is not None and t.expired is None:
+                    why = self.overdue(t, now)
+                    if why is not None:
+                        self.expire(t, why)
+
+
+lifecycle = Lifecycle()
+
+# Answer to a request shed over RC_FD_BUDGET; clients back off and retry.
+SHED = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n"
+        b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+
+def keepalive(sock):
+    """TCP keepalive, so the kernel notices an upstream that went away without
+    a word (a dropped NAT mapping, a sleeping laptop) within about two minutes
+    of silence, even on a tunnel with no idle timeout."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, v in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), v)
+
+
+class SpooledBody:
+    """A buffered request body kept in an unlinked temp file rather than in
+    memory, and sent from it: with sendfile(2) to a plain-TCP upstream, else
+    in pread pieces (TLS has to see the bytes)."""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(prefix="aiolos-rc-body.")
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def pieces(self, n=1 << 18):
+        self.file.flush()
+        for off in range(0, self.size, n):
+            yield os.pread(self.file.fileno(), n, off)
+
+    async def send(self, writer):
+        if UVLOOP or writer.get_extra_info("sslcontext") is not None:
+            for piece in self.pieces():
+                writer.write(piece)
+                await writer.drain()
+            return
+        self.file.flush()
+        await asyncio.get_running_loop().sendfile(writer.transport, self.file, 0, self.size)
+
+    def close(self):
+        self.file.close()
+
+
+async def read_full_body(reader, clen, chunked):
+    """Read a whole request body (RC_STREAM_BODY=0). Up to RC_BODY_SPILL it is
+    kept in memory, within body_budget; past that, or once the budget is
+    used up, it goes to a SpooledBody. Release it with release_body()."""
+    buf = bytearray()           # amortised append; `bytes +=` is quadratic
+    spool = None
+    try:
+        async for data in (read_chunks(reader) if chunked else read_sized(reader, clen)):
+            if spool is None and (len(buf) + len(data) > BODY_SPILL or
+                                  (buf and not body_budget.try_take(len(data)))):
+                spool = SpooledBody()
+                spool.write(buf)
+                body_budget.give(len(buf))
+                buf = None
+                stats["body_spilled"] += 1
+            if spool is not None:
+                spool.write(data)
+                continue
+            if not buf:
+                await body_budget.take(len(data))
+            buf += data
+    except BaseException:
+        if spool is not None:
+            spool.close()
+        elif buf:
+            body_budget.give(len(buf))
+        raise
+    return buf if spool is None else spool
+
+
+def release_body(body):
+    if isinstance(body, SpooledBody):
+        body.close()
+    elif body:
+        body_budget.give(len(body))
+
+
+def body_pieces(body):
+    return body.pieces() if isinstance(body, SpooledBody) else (body,)
+
+
+async def write_body(writer, body):
+    if isinstance(body, SpooledBody):
+        await body.send(writer)
+    else:
+        writer.write(body)
+    await writer.drain()
+
+
+class StreamedBody:
+    """The client's body, forwarded upstream as it arrives (RC_STREAM_BODY). A
+    chunked body is re-chunked (our own framing, extensions and trailers
+    dropped); a sized one is copied through under the original
+    Content-Length. Its first `keep` bytes are kept, so a send that a pooled
+    connection turned out dead for can be made again from the start on a
+    fresh one (`replayable` until more than that has gone out, or reading
+    from the client failed). Each piece is also noted on `rec`'s shape, and a
+    failure to read one marks `rec.client_error`."""
+    __slots__ = ("pieces", "chunked", "keep", "kept", "size", "rec")
+
+    def __init__(self, reader, clen, chunked, rec, keep=RETRY_KEEP):
+        self.pieces = read_chunks(reader) if chunked else read_sized(reader, clen)
+        self.chunked = chunked
+        self.keep = keep
+        self.kept = []
+        self.size = 0
+        self.rec = rec
+
+    @property
+    def replayable(self):
+        return self.kept is not None
+
+    async def read(self):
+        """Yield the body's pieces still to come from the client."""
+        while True:
+            try:
+                data = await self.pieces.__anext__()
+            except StopAsyncIteration:
+                return
+            except BaseException:
+                self.kept = None    # the client's side failed: nothing to send again
+                self.rec.client_error = True
+                raise
+            self.size += len(data)
+            if self.kept is not None:
+                if self.size <= self.keep:
+                    self.kept.append(data)
+                else:
+                    self.kept = None
+            if self.rec.shape is not None:
+                self.rec.shape.up(len(data))
+            yield data
+
+    async def send(self, writer):
+        """Send the whole body to `writer` (what was read so far again, then
+        the rest as it arrives). Returns the number of payload bytes sent."""
+        for data in self.kept:
+            self._write(writer, data)
+        await writer.drain()
+        async for data in self.read():
+            self._write(writer, data)
+            await writer.drain()
+        if self.chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return self.size
+
+    def _write(self, writer, data):
+        if self.chunked:
+            writer.write(b"%x\r\n" % len(data))
+            writer.write(data)
+            writer.write(b"\r\n")
+        else:
+            writer.write(data)
+
+
+async def pump(src, dst):
+    n = 0
+    try:
+        while True:
+            b = await src.read(65536)
+            if not b:
+                break
+            n += len(b)
+            dst.write(b)
+            await dst.drain()
+    except Exception:
+        pass
+    return n
+
+
+class Splice(asyncio.Protocol):
+    """Protocol that takes over one transport of a raw relay (see splice()):
+    every buffer received is handed straight to the peer transport, with no
+    StreamReader buffer in between and no drain() round trip per chunk.
+    Backpressure is the transports' own: when this transport's write buffer
+    fills, reading from the peer pauses until it has drained.
+
+    A plain Protocol rather than a BufferedProtocol: transports may queue the
+    object they are given to write, so a reused receive buffer would have to be
+    copied anyway."""
+
+    def __init__(self, peer, forward=True, on_first=None):
+        self.peer = peer
+        self.forward = forward
+        self.on_first = on_first
+        self.count = 0
+        self.done = asyncio.get_running_loop().create_future()
+        self.tracked = None     # the transport's, see Lifecycle
+
+    def data_received(self, data):
+        if self.tracked is not None:
+            self.tracked.last = time.monotonic()
+        if not self.forward:
+            return              # the client may not talk during a pumped response
+        if self.on_first is not None:
+            self.on_first(data)
+            self.on_first = None
+        self.count += len(data)
+        self.peer.write(data)
+
+    def eof_received(self):
+        return False            # close; connection_lost() tears down the peer
+
+    def connection_lost(self, exc):
+        lifecycle.forget(self.tracked)
+        self.peer.close()       # flushes what it still buffers first
+        if not self.done.done():
+            self.done.set_result(self.count)
+
+    def pause_writing(self):
+        self.peer.pause_reading()
+
+    def resume_writing(self):
+        self.peer.resume_reading()
+
+
+def spliceable(*readers):
+    """Whether splice() can take over from these StreamReaders (None: no
+    reader). It has to move the bytes a stream already read off its socket,
+    and asyncio has no public way to take them without awaiting read(), so it
+    uses the private `StreamReader._buffer`. Where that is missing (another
+    Python or loop), the stream relay is used instead, as with RC_SPLICE=0."""
+    return all(r is None or isinstance(getattr(r, "_buffer", None), bytearray)
+               for r in readers)
+
+
+async def splice(cr, cw, ur, uw, duplex=True, on_first=None):
+    """Relay raw bytes between client and upstream at the transport level until
+    both are closed, in place of the stream copies in tunnel() and pump().
+    With duplex=False only upstream -> client flows (a close-delimited
+    response) and anything the client sends is dropped; `cr` may then be None.
+    The readers must be spliceable(). Returns (bytes up, bytes down)."""
+    ct, ut = cw.transport, uw.transport
+    try:
+        await cw.drain()
+        await uw.drain()
+    except ConnectionError:
+        ct.close()
+        ut.close()
+        return 0, 0
+    down = Splice(ct, on_first=on_first)      # installed on the upstream transport
+    up = Splice(ut, forward=duplex)           # installed on the client transport
+    sides = ((ut, down, ur), (ct, up, cr))
+    for transport, proto, _ in sides:
+        proto.tracked = lifecycle.tracked.get(transport)
+        transport.set_protocol(proto)
+    for transport, proto, reader in sides:
+        if reader is not None:
+            # Whatever the stream already read off the socket goes first. There
+            # is no public way to take it without a read(), hence _buffer (see
+            # spliceable()).
+            buffered = reader._buffer
+            if buffered:
+                proto.data_received(bytes(buffered))
+                buffered.clear()
+            if reader.at_eof() or reader.exception() is not None:
+                transport.close()
+        if transport.is_closing():
+            proto.connection_lost(None)     # may already have gone to the stream
+        else:
+            transport.resume_reading()      # the stream may have paused it
+    try:
+        await asyncio.gather(down.done, up.done)
+    finally:
+        ct.close()
+        ut.close()
+    return up.count, down.count
+
+
+async def tunnel(cr, cw, ur, uw, rec=None):
+    """Full-duplex byte relay between client and upstream. Closing one side's
+    writer on EOF tears down the peer half, so WebSocket upgrades, SSE, long-poll,
+    keep-alive and bidirectional streams all pass through transparently.
+    Returns (bytes up, bytes down)."""
+    def first(data):
+        if rec is not None:
+            rec.first_byte()
+            if data[:5] == b"HTTP/" and data[9:12].isdigit():
+                rec.status = int(data[9:12])
+                end = data.find(b"\r\n\r\n")
+                if rec.shape is not None and end > 0:
+                    rec.shape.response(parse_head(data[:end + 4]))
+
+    if SPLICE and spliceable(cr, ur):
+        return await splice(cr, cw, ur, uw, on_first=first)
+
+    async def half(src, dst, down):
+        n = 0
+        try:
+            while True:
+                data = await src.read(65536)
+                if not data:
+                    break
+                if down and not n:
+                    first(data)
+                n += len(data)
+                dst.write(data)
+                await dst.drain()
+        except Exception:
+            pass
+        finally:
+            try:
+                dst.close()
+            except Exception:
+                pass
+        return n
+    return tuple(await asyncio.gather(half(cr, uw, False), half(ur, cw, True)))
+
+
+def numeric_addr(host, port):
+    """getaddrinfo() for an address literal (no lookup involved), else None."""
+    try:
+        return socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                  flags=socket.AI_NUMERICHOST)
+    except socket.gaierror:
+        return None
+
+
+class Resolver:
+    """Cached getaddrinfo() per (host, port), so an upstream connect normally
+    never waits on the resolver. An answer is used for RC_DNS_TTL seconds and
+    refreshed in the background once three quarters of that have passed. If
+    refreshing fails, the last good answer stays in use for up to RC_DNS_STALE
+    seconds past its TTL. Concurrent lookups of one name share a single
+    getaddrinfo() call."""
+
+    def __init__(self):
+        self._cache = {}        # (host, port) -> (resolved at, addrinfos)
+        self._inflight = {}     # (host, port) -> lookup task
+
+    async def resolve(self, host, port):
+        infos = numeric_addr(host, port)
+        if infos is not None:
+            return infos
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < DNS_TTL + DNS_STALE:
+                if age >= DNS_TTL * 0.75:
+                    self._lookup(key)
+                stats["dns_hit" if age < DNS_TTL else "dns_stale"] += 1
+                return entry[1]
+            del self._cache[key]
+        stats["dns_miss"] += 1
+        return await asyncio.shield(self._lookup(key))
+
+    def prefetch(self, host, port):
+        """Resolve a known upstream now rather than on its first request."""
+        if numeric_addr(host, port) is None and (host, port) not in self._cache:
+            self._lookup((host, port))
+
+    def _lookup(self, key):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._getaddrinfo(key))
+            # A failed background refresh has no awaiter; don't warn about it.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _getaddrinfo(self, key):
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                *key, type=socket.SOCK_STREAM)
+        except OSError as e:
+            stats["dns_error"] += 1
+            log(f"resolving {key[0]}: {e}")
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._cache[key] = (time.monotonic(), infos)
+        return infos
+
+
+resolver = Resolver()
+
+
+async def connect_happy(infos):
+    """Happy Eyeballs (RFC 8305) over resolved addresses: address families are
+    interleaved, a new attempt starts every HAPPY_DELAY seconds or as soon as
+    the previous one fails, and the first to connect wins; the rest are
+    cancelled. Returns the connected non-blocking socket."""
+    loop = asyncio.get_running_loop()
+    by_family = collections.OrderedDict()
+    for family, _, proto, _, addr in infos:
+        by_family.setdefault(family, []).append((family, proto, addr))
+    order = [a for group in itertools.zip_longest(*by_family.values())
+             for a in group if a is not None]
+
+    async def attempt(family, proto, addr):
+        sock = socket.socket(family, socket.SOCK_STREAM, proto)
+        try:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, addr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def discard(task):
+        if not task.cancelled() and task.exception() is None:
+            task.result().close()
+
+    attempts = []
+    pending = set()
+    error = None
+    try:
+        for i in range(len(order) + 1):
+            if i < len(order):
+                task = loop.create_task(attempt(*order[i]))
+                attempts.append(task)
+                pending.add(task)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=HAPPY_DELAY if i < len(order) else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break               # too slow: start the next attempt too
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        task.result().close()   # connected in the same tick
+                if winner is not None:
+                    if attempts.index(winner):
+                        stats["connect_fallback"] += 1
+                    return winner.result()
+                if i < len(order):
+                    break               # one failed: start the next at once
+        raise error or OSError("no addresses to connect to")
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(discard)
+
+
+async def open_upstream(host, port, use_tls, ctx=None, dest=None, timings=None):
+    """Connect (and handshake) to an upstream, timing name resolution, the TCP
+    connect and the TLS handshake separately into `metrics[dest]` (and into
+    the `timings` dict, if given)."""
+    ctx = (ctx or client_ctx) if use_tls else None
+    t0 = time.monotonic()
+    infos = await resolver.resolve(host, port)
+    t1 = time.monotonic()
+    sock = await connect_happy(infos)
+    t2 = time.monotonic()
+    try:
+        keepalive(sock)
+        reader, writer = await asyncio.open_connection(
+            sock=sock, ssl=ctx, server_hostname=(host if ctx is not None else None))
+    except BaseException:
+        sock.close()
+        raise
+    lifecycle.track(writer, "upstream", "busy")
+    t3 = time.monotonic()
+    if dest is not None:
+        m = metrics[dest]
+        m.hist["dns"].observe(t1 - t0)
+        m.hist["connect"].observe(t2 - t1)
+        if ctx is not None:
+            m.hist["tls_handshake"].observe(t3 - t2)
+    if timings is not None:
+        timings.update(dns=round(t1 - t0, 4), connect=round(t2 - t1, 4),
+                       tls=round(t3 - t2, 4))
+    sslobj = writer.get_extra_info("ssl_object")
+    if sslobj is not None:
+        stats["tls_upstream_resumed" if sslobj.session_reused
+              else "tls_upstream_full"] += 1
+    return reader, writer
+
+
+class Upstream:
+    """One HTTP/1.1 connection to an upstream, reusable for requests that route
+    to the same key."""
+    __slots__ = ("key", "reader", "writer", "idle_since", "reused")
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = 0.0
+        self.reused = False
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class Pool:
+    """Idle keep-alive upstream connections, keyed by (dest, host, port, tls).
+
+    `dest` carries the pin (`aiolos[<acct>]` / `aiolos[lb]` / `anthropic`), so
+    a connection only ever goes back out for a request that routed to the very
+    same upstream and pin; routing itself stays per request."""
+
+    def __init__(self):
+        self._idle = {}
+
+    async def acquire(self, key):
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if (now - conn.idle_since < POOL_IDLE and not conn.reader.at_eof()
+                    and not conn.writer.is_closing()):
+                conn.reused = True
+                stats["pool_reused"] += 1
+                lifecycle.enter(conn.writer, "busy")
+                return conn
+            conn.close()
+        dest, host, port, use_tls = key
+        reader, writer = await open_upstream(host, port, use_tls, dest=dest)
+        stats["pool_opened"] += 1
+        return Upstream(key, reader, writer)
+
+    def idle(self, key):
+        return len(self._idle.get(key, ()))
+
+    def retain(self, keys):
+        """Close the idle connections of every key not in `keys` (upstreams a
+        reload routed away from). Ones busy now are reaped once idle."""
+        for key in [k for k in self._idle if k not in keys]:
+            for conn in self._idle.pop(key):
+                conn.close()
+
+    def shrink(self, n):
+        """Close up to `n` idle connections, longest idle first, of any key.
+        Returns how many were closed."""
+        idle = sorted(((conn.idle_since, id(conn), key, conn)
+                       for key, conns in self._idle.items() for conn in conns),
+                      key=lambda c: c[:2])[:n]
+        for _, _, key, conn in idle:
+            self._idle[key].remove(conn)
+            conn.close()
+        return len(idle)
+
+    def release(self, conn):
+        remember_session(conn.writer)
+        idle = self._idle.setdefault(conn.key, [])
+        if POOL_IDLE <= 0 or len(idle) >= POOL_MAX or conn.writer.is_closing():
+            conn.close()
+            return
+        conn.idle_since = time.monotonic()
+        idle.append(conn)
+        lifecycle.enter(conn.writer, "idle")
+
+    async def reap(self):
+        """Close connections idle longer than RC_POOL_IDLE (servers drop them
+        anyway; better we notice first than fail a request on a dead one)."""
+        while True:
+            await asyncio.sleep(max(POOL_IDLE / 2, 1))
+            cutoff = time.monotonic() - POOL_IDLE
+            for idle in self._idle.values():
+                for conn in [c for c in idle if c.idle_since < cutoff]:
+                    idle.remove(conn)
+                    conn.close()
 
-SOCK = os.environ.get("RC_SOCK")           # unix-socket mode (legacy)
-LISTEN_PORT = os.environ.get("RC_PORT")    # TCP mode on 127.0.0.1 (preload redirect)
-CERT = os.environ["RC_CERT"]
-KEY = os.environ["RC_KEY"]
-AIOLOS_URL = os.environ["RC_AIOLOS_URL"]
-# Empty/unset -> no-pin mode: forward inference to aiolos with no account header,
-# so aiolos load-balances across all accounts as it normally does.
-ACCOUNT_ID = os.environ.get("RC_ACCOUNT_ID") or ""
-DEBUG = bool(os.environ.get("RC_DEBUG"))
 
-ANTHROPIC_HOST = "api.anthropic.com"
-ANTHROPIC_PORT = 443
+pool = Pool()
 
-_au = urllib.parse.urlparse(AIOLOS_URL)
-AIOLOS_HOST = _au.hostname
-AIOLOS_TLS = _au.scheme == "https"
-AIOLOS_PORT = _au.port or (443 if AIOLOS_TLS else 80)
 
-server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-server_ctx.load_cert_chain(certfile=CERT, keyfile=KEY)
-client_ctx = ssl.create_default_context()
+def cache_control(headers):
+    """Cache-Control directives of a header list: {name: value or None}."""
+    out = {}
+    for k, v in headers:
+        if k.lower() == "cache-control":
+            for d in v.split(","):
+                name, _, val = d.strip().partition("=")
+                out[name.lower()] = val.strip('"') or None
+    return out
 
-HOP_BY_HOP = {
-    "host", "connection", "proxy-connection", "keep-alive",
-    "transfer-encoding", "upgrade", "te", "trailer",
-    # We re-frame the body (dechunk + buffer) and append our own
-    # Content-Length below, so the shim must own it exclusively. Forwarding
-    # the client's Content-Length too would emit a duplicate header, which
-    # RFC 9110 forbids and strict upstream parsers reject as smuggling.
-    "content-length",
-    # never let the client smuggle its own pin
-    "x-aiolos-account-id", "x-aiolos-force-account-strict",
-}
 
+def shareable(headers):
+    """Whether a response may also go to requests other than the one that
+    asked for it: not no-store or private, and setting no cookie."""
+    cc = cache_control(headers)
+    return not ("no-store" in cc or "private" in cc
+                or any(k.lower() == "set-cookie" for k, _ in headers))
 
-def log(msg):
-    if DEBUG:
-        sys.stderr.write(f"[shim] {msg}\n")
-        sys.stderr.flush()
 
+class CacheEntry:
+    __slots__ = ("status_line", "headers", "body", "vary", "stored", "expires", "size")
 
-def is_inference(path):
-    return path.split("?", 1)[0].startswith("/v1/messages")
 
+class ResponseCache:
+    """LRU cache of complete 200 responses to allowlisted control-plane GETs
+    (RC_CACHE), shared by every session in the process. Entries are keyed by
+    path (with query) and a digest of the request's credentials, so one login
+    never sees another's answers; a `Vary` response also has to match the
+    request headers it names. A response is kept for its `max-age`, capped at
+    RC_CACHE_TTL (or RC_CACHE_TTL if it gives none), and never if it says
+    no-store / no-cache, sets a cookie or varies on `*`. A request that says
+    no-cache / no-store goes upstream. Total size stays under RC_CACHE_MAX.
 
-def is_upgrade(headers):
-    # A real protocol upgrade (WebSocket): `Upgrade: <proto>` and/or
-    # `Connection: Upgrade`. Only these switch the connection to a raw tunnel.
-    for k, v in headers:
-        kl = k.lower()
-        if kl == "upgrade" and v.strip():
-            return True
-        if kl == "connection" and "upgrade" in v.lower():
-            return True
-    return False
+    Identical requests that arrive while one is already on its way upstream
+    wait for it and share its response (`inflight`), whether or not that
+    response may be kept, unless it is not shareable() (no-store, private or
+    setting a cookie): then they go upstream themselves. RC_CACHE_TTL=0
+    coalesces without caching."""
 
+    AUTH_HEADERS = ("authorization", "x-api-key", "cookie")
 
-async def read_headers(reader):
-    head = await reader.readuntil(b"\r\n\r\n")
-    lines = head.split(b"\r\n")
-    request_line = lines[0].decode("latin1")
-    headers = []
-    for ln in lines[1:]:
-        if not ln:
-            continue
-        k, _, v = ln.partition(b":")
-        headers.append((k.decode("latin1").strip(), v.decode("latin1").strip()))
-    return request_line, headers
-
-
-async def read_body(reader, headers):
-    clen = 0
-    chunked = False
-    expect_continue = False
-    for k, v in headers:
-        kl = k.lower()
-        if kl == "content-length":
+    def __init__(self, paths, max_bytes, ttl):
+        self.exact = {p for p in paths if not p.endswith("*")}
+        self.prefixes = tuple(p[:-1] for p in paths if p.endswith("*"))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()    # key -> CacheEntry, LRU first
+        self.size = 0
+        self.inflight = {}      # key -> Future of the CacheEntry (None if it failed)
+
+    def key(self, method, path, headers, has_body):
+        """The cache key for a request, or None if it is not cacheable."""
+        if method != "GET" or has_body:
+            return None
+        p = path.partition("?")[0]
+        if p not in self.exact and not p.startswith(self.prefixes):
+            return None
+        cc = cache_control(headers)
+        if "no-cache" in cc or "no-store" in cc:
+            stats["cache_bypass"] += 1
+            return None
+        h = hashlib.sha256()
+        for name in self.AUTH_HEADERS:
+            for v in headers.values(name):
+                h.update(f"{name}:{v}\n".encode("latin1"))
+        return path, h.digest()
+
+    def get(self, key, headers):
+        entry = self.entries.get(key)
+        if entry is not None and (entry.expires <= time.monotonic()
+                                  or entry.vary != vary_values(
+                                      headers, [n for n, _ in entry.vary])):
+            self._drop(key)
+            entry = None
+        if entry is None:
+            stats["cache_miss"] += 1
+            return None
+        self.entries.move_to_end(key)
+        stats["cache_hit"] += 1
+        return entry
+
+    async def join(self, key, headers):
+        """Wait for an identical request already in flight upstream and return
+        its response, or None if there is none or it failed."""
+        flight = self.inflight.get(key)
+        if flight is None:
+            return None
+        entry = await asyncio.shield(flight)
+        if entry is None or entry.vary is None or entry.vary != vary_values(
+                headers, [n for n, _ in entry.vary]):
+            return None
+        stats["cache_coalesced"] += 1
+        return entry
+
+    def put(self, key, req_headers, status_line, headers, body):
+        """Make an entry of a complete response and keep it if its headers
+        allow. Returns the entry either way, for the requests waiting on it."""
+        entry = CacheEntry()
+        entry.status_line = status_line
+        entry.headers = headers
+        entry.body = body
+        vary = [v.strip().lower() for k, val in headers if k.lower() == "vary"
+                for v in val.split(",") if v.strip()]
+        entry.vary = None if "*" in vary else vary_values(req_headers, vary)
+        entry.stored = time.monotonic()
+        entry.size = len(body) + sum(len(k) + len(v) + 4 for k, v in headers) + 256
+        cc = cache_control(headers)
+        if "no-store" in cc or "no-cache" in cc:
+            return entry
+        ttl = self.ttl
+        if "max-age" in cc:
             try:
-                clen = int(v)
-            except ValueError:
-                clen = 0
-        elif kl == "transfer-encoding" and "chunked" in v.lower():
-            chunked = True
-        elif kl == "expect" and "100-continue" in v.lower():
-            expect_continue = True
-    return clen, chunked, expect_continue
+                ttl = min(ttl, int(cc["max-age"]))
+            except (TypeError, ValueError):
+                return entry
+        if (ttl <= 0 or entry.vary is None or entry.size > self.max_bytes // 8
+                or any(k.lower() == "set-cookie" for k, _ in headers)):
+            return entry
+        entry.expires = entry.stored + ttl
+        self._drop(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        stats["cache_store"] += 1
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            stats["cache_evict"] += 1
+        return entry
 
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
 
-async def pump(src, dst):
+
+def vary_values(headers, names):
+    """The request's values for the header names a response varies on:
+    ((name, value), ...)."""
+    return tuple((n, ",".join(v for k, v in headers if k.lower() == n)) for n in names)
+
+
+class CacheFill:
+    """A cacheable request's response on its way to the client: the head and
+    body are collected as they are relayed, stored once the body is whole, and
+    handed to identical requests that arrived meanwhile (if this request is
+    the one in flight for its key). close() must always follow."""
+    __slots__ = ("key", "req_headers", "status_line", "headers", "body", "size", "flight")
+
+    def __init__(self, key, req_headers):
+        self.key = key
+        self.req_headers = req_headers
+        self.body = []
+        self.size = 0
+        self.flight = None
+        if key not in cache.inflight:
+            self.flight = cache.inflight[key] = asyncio.get_running_loop().create_future()
+
+    def begin(self, status, status_line, headers):
+        """Returns self if the response is worth collecting, else None."""
+        if status != 200:
+            return None
+        self.status_line = status_line
+        self.headers = [(k, v) for k, v in headers
+                        if k.lower() not in HOP_BY_HOP and k.lower() != "age"]
+        return self
+
+    def feed(self, data):
+        if self.body is not None:
+            self.size += len(data)
+            if self.size > cache.max_bytes // 8:
+                self.body = None    # too big to keep; stop collecting
+            else:
+                self.body.append(data)
+
+    def done(self):
+        if self.body is not None:
+            entry = cache.put(self.key, self.req_headers, self.status_line, self.headers,
+                              b"".join(self.body))
+            if self.flight is not None:
+                self.flight.set_result(entry if shareable(self.headers) else None)
+                self.close()
+
+    def close(self):
+        if self.flight is not None:
+            if not self.flight.done():
+                self.flight.set_result(None)    # waiters go upstream themselves
+            del cache.inflight[self.key]
+            self.flight = None
+
+
+cache = ResponseCache(CACHE_PATHS, CACHE_MAX, CACHE_TTL) if CACHE_PATHS else None
+
+
+async def relay_response(session, conn, cw, method, dest, head, rec,
+                         keep_client=False, fill=None):
+    """Relay one upstream response (whose first head has already been read) to
+    the client, honouring its framing (Content-Length, chunked, or
+    close-delimited as SSE may be) so we know where it ends.
+
+    Returns (upstream reusable, client connection kept). The client connection
+    is only kept if `keep_client` asks for it and the response is framed.
+    The final status and relayed body bytes are recorded on `rec`; a framed
+    body is also handed to `fill` (a CacheFill), if given."""
+    ur = conn.reader
+    while True:
+        headers = parse_head(head)
+        status_line = headers.start
+        session.log(f"    <- {dest}: {status_line}")
+        parts = status_line.split(" ", 2)
+        status = int(parts[1])
+        if not 100 <= status < 200:
+            break
+        if status != 100:       # we answered the client's Expect ourselves
+            cw.write(head)
+        head = await ur.readuntil(b"\r\n\r\n")
+    rec.status = status
+    if status in (429, 503, 529):
+        rec.retry_after = retry_after(headers.values("retry-after"))
+    shape = rec.shape
+    if shape is not None:
+        shape.response(headers)
+
+    clen, chunked = headers.clen, headers.chunked
+    if clen is not None and clen < 0:
+        raise ValueError(f"bad Content-Length from {dest}")
+    keep_alive = parts[0] == "HTTP/1.1" and not headers.close
+    out = [status_line]
+    out += [f"{k}: {v}" for k, v in headers.without(RESPONSE_DROP)]
+    framed = chunked or clen is not None or method == "HEAD" or status in (204, 304)
+    keep_client = keep_client and framed
+    if not keep_client:
+        out.append("Connection: close")
+    cw.write(("\r\n".join(out) + "\r\n\r\n").encode("latin1"))
+
+    if method == "HEAD" or status in (204, 304):
+        await cw.drain()
+        return keep_alive, keep_client
+    if headers.sse:
+        lifecycle.enter(cw, "stream")
+    watch = SSEWatch(rec, session.tokens) if headers.sse and 200 <= status < 300 else None
+    if fill is not None:
+        fill = fill.begin(status, status_line, headers)
     try:
-        while True:
-            b = await src.read(65536)
-            if not b:
-                break
-            dst.write(b)
-            await dst.drain()
-    except Exception:
-        pass
+        if chunked:
+            while True:
+                size_line = await ur.readuntil(b"\r\n")
+                cw.write(size_line)
+                size = int(size_line.strip().split(b";")[0] or b"0", 16)
+                if size == 0:
+                    while True:
+                        line = await ur.readuntil(b"\r\n")
+                        cw.write(line)
+                        if line == b"\r\n":
+                            break
+                    await cw.drain()
+                    break
+                rec.bytes_down += size
+                if shape is not None:
+                    shape.down(size)
+                payload = size
+                size += 2           # chunk data + CRLF
+                while size:
+                    data = await ur.read(min(size, 65536))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", size)
+                    size -= len(data)
+                    cw.write(data)
+                    if payload > 0:
+                        piece = data[:payload]          # the CRLF is framing
+                        payload -= len(data)
+                        if watch is not None:
+                            watch.feed(piece)
+                        if fill is not None:
+                            fill.feed(piece)
+                await cw.drain()
+            if fill is not None:
+                fill.done()
+        elif clen is not None:
+            while clen:
+                data = await ur.read(min(clen, 65536))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", clen)
+                clen -= len(data)
+                rec.bytes_down += len(data)
+                if shape is not None:
+                    shape.down(len(data))
+                cw.write(data)
+                if watch is not None:
+                    watch.feed(data)
+                if fill is not None:
+                    fill.feed(data)
+                await cw.drain()
+            if fill is not None:
+                fill.done()
+        else:
+            # close-delimited: runs until upstream EOF
+            if watch is not None:
+                while True:
+                    data = await ur.read(65536)
+                    if not data:
+                        break
+                    rec.bytes_down += len(data)
+                    if shape is not None:
+                        shape.down(len(data))
+                    cw.write(data)
+                    watch.feed(data)
+                    await cw.drain()
+            elif SPLICE and spliceable(ur):
+                rec.bytes_down += (await splice(None, cw, ur, conn.writer, duplex=False))[1]
+            else:
+                rec.bytes_down += await pump(ur, cw)
+            return False, False
+    finally:
+        if watch is not None:
+            watch.close()
+    return keep_alive, keep_client
 
 
-async def tunnel(cr, cw, ur, uw):
-    """Full-duplex byte relay between client and upstream. Closing one side's
-    writer on EOF tears down the peer half, so WebSocket upgrades, SSE, long-poll,
-    keep-alive and bidirectional streams all pass through transparently."""
-    async def half(src, dst):
+class H2Upstream:
+    """One multiplexed HTTP/2 connection to an upstream (RC_H2). Each request
+    for the same (dest, host, port) runs as its own stream on it; a reader task
+    demultiplexes frames into per-stream queues.
+
+    Flow control is end to end per stream: a stream's received DATA is only
+    acknowledged once it has been written (and drained) to its client, so a
+    slow client throttles its own stream, with at most H2_STREAM_WINDOW
+    buffered for it. The connection's window (H2_CONN_WINDOW) is credited as
+    soon as DATA arrives, so that stream never holds up the others."""
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(
+            client_side=True, header_encoding="latin1"))
+        self.conn.initiate_connection()
+        self.conn.update_settings(
+            {h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: H2_STREAM_WINDOW})
+        self.conn.increment_flow_control_window(
+            H2_CONN_WINDOW - self.conn.inbound_flow_control_window)
+        self.flush()
+        self.streams = {}
+        self.window = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.writer.write(data)
+
+    @property
+    def available(self):
+        return (not self.closed and self.conn.open_outbound_streams
+                < self.conn.remote_settings.max_concurrent_streams)
+
+    async def _read_loop(self):
         try:
             while True:
-                data = await src.read(65536)
+                data = await self.reader.read(65536)
                 if not data:
                     break
-                dst.write(data)
-                await dst.drain()
-        except Exception:
-            pass
+                credit = 0
+                for ev in self.conn.receive_data(data):
+                    if isinstance(ev, h2.events.DataReceived):
+                        credit += ev.flow_controlled_length
+                    self._dispatch(ev)
+                if credit:
+                    self.conn.increment_flow_control_window(credit)
+                self.flush()
+        except Exception as e:
+            log(f"h2 {self.key[0]}: {type(e).__name__}: {e}")
         finally:
+            self.closed = True
+            self.window.set()
+            for q in self.streams.values():
+                q.put_nowait(("reset", None))
+            remember_session(self.writer)
+            self.writer.close()
+            h2pool.discard(self)
+
+    def _dispatch(self, ev):
+        if isinstance(ev, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            self.window.set()
+        elif isinstance(ev, h2.events.ConnectionTerminated):
+            self.closed = True          # GOAWAY: finish open streams, start no more
+        q = self.streams.get(getattr(ev, "stream_id", None))
+        if q is None:
+            return
+        if isinstance(ev, h2.events.ResponseReceived):
+            q.put_nowait(("headers", ev.headers))
+        elif isinstance(ev, h2.events.DataReceived):
+            q.put_nowait(("data", ev))
+        elif isinstance(ev, h2.events.StreamEnded):
+            q.put_nowait(("end", None))
+        elif isinstance(ev, h2.events.StreamReset):
+            q.put_nowait(("reset", None))
+
+    def open_stream(self, headers, end_stream):
+        sid = self.conn.get_next_available_stream_id()
+        self.streams[sid] = q = asyncio.Queue()
+        self.conn.send_headers(sid, headers, end_stream=end_stream)
+        self.flush()
+        return sid, q
+
+    async def send_data(self, sid, data):
+        view = memoryview(data)
+        while view:
+            n = min(self.conn.local_flow_control_window(sid),
+                    self.conn.max_outbound_frame_size, len(view))
+            if n <= 0:
+                if self.closed:
+                    raise ConnectionError("h2 connection closed")
+                self.window.clear()
+                await self.window.wait()
+                continue
+            self.conn.send_data(sid, view[:n].tobytes())
+            view = view[n:]
+            self.flush()
+            await self.writer.drain()
+
+    def end_stream(self, sid):
+        self.conn.end_stream(sid)
+        self.flush()
+
+    def ack(self, sid, n):
+        """Credit stream `sid` with `n` bytes its client has taken (the
+        connection was credited when they arrived)."""
+        if n and not self.closed:
             try:
-                dst.close()
+                self.conn.increment_flow_control_window(n, stream_id=sid)
+            except (KeyError, h2.exceptions.StreamClosedError, h2.exceptions.ProtocolError):
+                return              # ended or reset meanwhile: nothing left to credit
+            self.flush()
+
+    def close_stream(self, sid, finished):
+        self.streams.pop(sid, None)
+        remember_session(self.writer)
+        if not finished and not self.closed:
+            try:
+                self.conn.reset_stream(sid)
+                self.flush()
             except Exception:
                 pass
-    await asyncio.gather(half(cr, uw), half(ur, cw))
+        if self.closed and not self.streams:
+            self.writer.close()
+
+    def retire(self):
+        """Start no more streams; close once the open ones are done."""
+        self.closed = True
+        if not self.streams:
+            self.writer.close()
+
+
+class H2Pool:
+    """HTTP/2 connections per (dest, host, port, tls): normally exactly one per
+    key, a second only once the server's concurrent-stream limit is reached.
+    An upstream that does not negotiate h2 via ALPN is remembered and served by
+    the HTTP/1.1 pool from then on."""
+
+    def __init__(self):
+        self._conns = {}
+        self._locks = collections.defaultdict(asyncio.Lock)
+        self.h1_only = set()
+
+    async def acquire(self, key, timings=None):
+        async with self._locks[key]:
+            for up in self._conns.get(key, ()):
+                if up.available:
+                    return up
+            dest, host, port, use_tls = key
+            reader, writer = await open_upstream(host, port, use_tls, h2_ctx, dest, timings)
+            if writer.get_extra_info("ssl_object").selected_alpn_protocol() != "h2":
+                log(f"    {key[0]} did not negotiate h2; using HTTP/1.1")
+                self.h1_only.add(key)
+                pool.release(Upstream(key, reader, writer))
+                return None
+            stats["h2_opened"] += 1
+            lifecycle.enter(writer, "h2")
+            up = H2Upstream(key, reader, writer)
+            self._conns.setdefault(key, []).append(up)
+            return up
+
+    def discard(self, up):
+        conns = self._conns.get(up.key)
+        if conns and up in conns:
+            conns.remove(up)
+
+    def retain(self, keys):
+        """Retire the connections of every key not in `keys` (see Pool.retain)."""
+        for key in [k for k in self._conns if k not in keys]:
+            for up in self._conns.pop(key):
+                up.retire()
+
+
+h2pool = H2Pool()
+
+
+async def prewarm(session, n=PREWARM):
+    """Top each of the session's upstreams (Anthropic and its aiolos pin, or
+    every pin of a set of accounts) up to `n` idle pooled connections, or one
+    h2 connection, all in parallel, so its first requests skip DNS, TCP and
+    TLS. Waits at most RC_PREWARM_WAIT; connections still opening then land
+    in the pool when they are done. Returns {dest: {"dns", "connect", "tls"
+    seconds}} of one new connection per upstream that finished in time."""
+    if n <= 0 or POOL_IDLE <= 0:
+        return {}
+    timings = {}
+
+    async def warm(key, h2=False):
+        dest, host, port, use_tls = key
+        t = {}
+        try:
+            if h2:
+                await h2pool.acquire(key, t)
+            else:
+                reader, writer = await open_upstream(host, port, use_tls, dest=dest,
+                                                     timings=t)
+                stats["pool_opened"] += 1
+                pool.release(Upstream(key, reader, writer))
+            stats["prewarmed"] += 1
+        except Exception as e:
+            stats["prewarm_failed"] += 1
+            log(f"prewarm {dest}: {type(e).__name__}: {e}")
+        if t:
+            timings.setdefault(dest, t)
+
+    tasks = []
+    room = lifecycle.room()
+    for host, port, use_tls, _, dest in session.routes():
+        key = (dest, host, port, use_tls)
+        h2 = H2 and use_tls and key not in h2pool.h1_only
+        want = 1 if h2 else n - pool.idle(key)
+        if room is not None:
+            if want > room:
+                stats["prewarm_skipped"] += want - room
+                want = room
+            room -= want
+        tasks += [asyncio.ensure_future(warm(key, h2)) for _ in range(want)]
+    if tasks:
+        await asyncio.wait(tasks, timeout=PREWARM_WAIT)
+    return timings
+
+
+def process_age():
+    """Seconds since this process started (Linux), else None."""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rpartition(")")[2].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Startup phase timings of this process (see main()); also in stats as
+# startup_s, the time from exec to ready.
+startup = {}
+
+
+async def h2_exchange(session, up, cr, cw, method, path, authority, fwd, body,
+                      clen, chunked, dest, keep_client, rec, fill=None, slot=None):
+    """Forward one HTTP/1.1 client request as an HTTP/2 stream and relay the
+    response back as HTTP/1.1 (chunked unless upstream sent a length). Returns
+    True if the client connection stays open. The body is also handed to
+    `fill` (a CacheFill), if given; `slot` (see Scheduler) is released once
+    the request is sent."""
+    hdrs = [(":method", method), (":scheme", "https"),
+            (":authority", authority), (":path", path)]
+    hdrs += [(k.lower(), v) for k, v in fwd]     # h2 field names are lowercase
+    if body is not None:
+        hdrs.append(("content-length", str(len(body))))
+    elif not chunked:
+        hdrs.append(("content-length", str(clen)))
+    sid, q = up.open_stream(hdrs, end_stream=(body == b""))
+    stats["h2_streams"] += 1
+    finished = False
+    watch = None
+    shape = rec.shape
+    try:
+        if body:
+            for piece in body_pieces(body):
+                await up.send_data(sid, piece)
+            rec.bytes_up = len(body)
+        if body is None:
+            stream = StreamedBody(cr, clen, chunked, rec, keep=0)   # h2 never resends
+            async for data in stream.read():
+                await up.send_data(sid, data)
+                rec.bytes_up = stream.size
+        if body != b"":
+            up.end_stream(sid)
+        if slot is not None:
+            slot.release()
+
+        while True:
+            kind, val = await q.get()
+            if kind != "headers":
+                raise ConnectionError(f"h2 stream {kind} before response")
+            rec.first_byte()
+            status = int(dict(val)[":status"])
+            if not 100 <= status < 200:
+                break
+        rec.status = status
+        if status in (429, 503, 529):
+            rec.retry_after = retry_after([v for k, v in val if k == "retry-after"])
+        if shape is not None:
+            shape.response(val)
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+        session.log(f"    <- {dest}: HTTP/2 {status} {reason}")
+        out = [f"HTTP/1.1 {status} {reason}"]
+        sized = False
+        for k, v in val:
+            if k.startswith(":"):
+                continue
+            sized = sized or k == "content-length"
+            out.append(f"{k}: {v}")
+        bodiless = method == "HEAD" or status in (204, 304)
+        chunk_out = not sized and not bodiless
+        if is_sse(val):
+            lifecycle.enter(cw, "stream")
+            if not bodiless and 200 <= status < 300:
+                watch = SSEWatch(rec, session.tokens)
+        if fill is not None:
+            fill = fill.begin(status, out[0], [(k, v) for k, v in val
+                                               if not k.startswith(":")])
+        if chunk_out:
+            out.append("Transfer-Encoding: chunked")
+        if not keep_client:
+            out.append("Connection: close")
+        cw.write(("\r\n".join(out) + "\r\n\r\n").encode("latin1"))
+        await cw.drain()
+
+        # The h2 connection is shared: the stream's progress is this client's.
+        life = lifecycle.of(cw)
+        while True:
+            kind, val = await q.get()
+            if kind == "data":
+                if life is not None:
+                    life.touch()
+                if val.data and not bodiless:
+                    rec.bytes_down += len(val.data)
+                    if shape is not None:
+                        shape.down(len(val.data))
+                    if chunk_out:
+                        cw.write(b"%x\r\n" % len(val.data))
+                        cw.write(val.data)
+                        cw.write(b"\r\n")
+                    else:
+                        cw.write(val.data)
+                    if watch is not None:
+                        watch.feed(val.data)
+                    if fill is not None:
+                        fill.feed(val.data)
+                    await cw.drain()
+                up.ack(sid, val.flow_controlled_length)
+            elif kind == "end":
+                finished = True
+                if fill is not None:
+                    fill.done()
+                break
+            elif kind == "reset":
+                raise ConnectionError("h2 stream reset")
+        if chunk_out:
+            cw.write(b"0\r\n\r\n")
+            await cw.drain()
+        return keep_client
+    finally:
+        if watch is not None:
+            watch.close()
+        up.close_stream(sid, finished)
+
+
+async def send_cached(cw, entry, keep_client, rec):
+    """Answer a request from a cache entry. Returns True if the client
+    connection stays open."""
+    out = [entry.status_line]
+    out += [f"{k}: {v}" for k, v in entry.headers]
+    out.append(f"Age: {int(time.monotonic() - entry.stored)}")
+    out.append(f"Content-Length: {len(entry.body)}")
+    if not keep_client:
+        out.append("Connection: close")
+    cw.write(("\r\n".join(out) + "\r\n\r\n").encode("latin1") + entry.body)
+    rec.first_byte()
+    rec.status = 200
+    rec.bytes_down = len(entry.body)
+    if rec.shape is not None:
+        rec.shape.response(entry.headers)
+        rec.shape.down(len(entry.body))
+    await cw.drain()
+    return keep_client
+
+
+async def handle(session, cr, cw):
+    life = lifecycle.track(cw, "client", "head", asyncio.current_task())
+    try:
+        if lifecycle.over_budget():
+            await shed(cr, cw)
+            return
+        while await serve_one(session, cr, cw):
+            lifecycle.enter(cw, "head")
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError):
+        pass
+    except asyncio.CancelledError:
+        if life.expired is None:
+            raise               # not one of our timeouts
+    except Exception as e:
+        session.log(f"error: {type(e).__name__}: {e}")
+    finally:
+        try:
+            cw.close()
+        except Exception:
+            pass
+
+
+async def shed(cr, cw):
+    """Over RC_FD_BUDGET: answer the connection's request with a 503 rather
+    than open an upstream connection for it."""
+    stats["shed"] += 1
+    log("over the fd budget; shedding a request")
+    await read_headers(cr)
+    cw.write(SHED)
+    await cw.drain()
 
 
-async def handle(cr, cw):
+async def serve_one(session, cr, cw):
+    """Read, route and answer one request on a client connection. Returns True
+    if the connection stays open for another request (RC_CLIENT_KEEPALIVE)."""
     upstream_w = None
+    rec = None
+    fill = None
+    body = None
+    slot = None
+    acct = None
+    life = lifecycle.of(cw)
     try:
-        request_line, headers = await read_headers(cr)
+        headers = await read_headers(cr)
+        start = time.monotonic()
+        lifecycle.enter(cw, "tunnel" if headers.upgrade else "request")
+        request_line = headers.start
         parts = request_line.split(" ")
         if len(parts) != 3:
-            return
+            return False
         method, path, ver = parts
 
-        # Route by REQUEST, not by connection. Every buffered response forces
+        # Route by REQUEST, not by connection. By default every response forces
         # `Connection: close`, so the client never pools a shim connection to carry
-        # a later request of a different class. Only a real WebSocket upgrade turns
-        # the connection into a raw bidirectional tunnel — after `101` it carries no
-        # further HTTP requests, so there is nothing to misroute. This keeps
-        # inference classified per-request (a pooled control connection can't smuggle
-        # a /v1/messages POST straight to Anthropic, off aiolos and off the pin)
-        # while still fixing the remote-control bridge upgrade that a header-stripping
-        # buffered proxy broke ("Transport recovery exhausted").
-        if is_upgrade(headers):
+        # a later request of a different class. With RC_CLIENT_KEEPALIVE the
+        # connection is reused, but each request on it comes back through here and
+        # is classified on its own, so the guarantee is the same. Only a real
+        # WebSocket upgrade turns the connection into a raw bidirectional tunnel —
+        # after `101` it carries no further HTTP requests, so there is nothing to
+        # misroute. This keeps inference classified per-request (a pooled control
+        # connection can't smuggle a /v1/messages POST straight to Anthropic, off
+        # aiolos and off the pin) while still fixing the remote-control bridge
+        # upgrade that a header-stripping buffered proxy broke ("Transport recovery
+        # exhausted"). Upstream connections are pooled, but only per (dest, host,
+        # port): a pooled aiolos connection carries inference for the same pin and
+        # nothing else.
+        if headers.upgrade:
             out = [request_line]
-            for k, v in headers:
-                # Preserve Upgrade/Connection etc; only drop Host (rewritten) and
-                # the aiolos pin guards (never let a client smuggle them upstream).
-                if k.lower() in ("host", "x-aiolos-account-id",
-                                 "x-aiolos-force-account-strict"):
-                    continue
-                out.append(f"{k}: {v}")
-            out.append(f"Host: {ANTHROPIC_HOST}")
+            # Preserve Upgrade/Connection etc; only drop Host (rewritten) and
+            # the aiolos pin guards (never let a client smuggle them upstream).
+            out += [f"{k}: {v}" for k, v in headers.without(UPGRADE_DROP)]
+            out.append(f"Host: {host_header(ANTHROPIC_HOST, ANTHROPIC_PORT)}")
             head = ("\r\n".join(out) + "\r\n\r\n").encode("latin1")
 
-            log(f"{method} {path} -> anthropic (upgrade tunnel)")
-            ur, uw = await asyncio.open_connection(
-                ANTHROPIC_HOST, ANTHROPIC_PORT,
-                ssl=client_ctx, server_hostname=ANTHROPIC_HOST)
+            session.log(f"{method} {path} -> anthropic (upgrade tunnel)")
+            rec = Exchange("upgrade", start, session.name, method, path, headers)
+            rec.conn = "new"
+            slot = await lifecycle.queued(
+                cw, scheduler.acquire("upgrade", "upgrade", session.name))
+            rec.wait = slot.wait
+            ur, uw = await open_upstream(ANTHROPIC_HOST, ANTHROPIC_PORT, True,
+                                         dest="upgrade")
             upstream_w = uw
+            lifecycle.pair(cw, uw)
             uw.write(head)          # request head; frames flow via the tunnel
             await uw.drain()
-            await tunnel(cr, cw, ur, uw)
-            return
+            slot.release()
+            rec.bytes_up, rec.bytes_down = await tunnel(cr, cw, ur, uw, rec)
+            return False
 
-        # --- buffered per-request: inference -> aiolos (+pin); else -> Anthropic ---
-        clen, chunked, expect_continue = await read_body(cr, headers)
-        if expect_continue:
+        # --- per-request: inference -> aiolos (+pin); else -> Anthropic ---
+        # Routing needs only the request head, so in streaming mode the upstream
+        # is opened at once and the body forwarded as it arrives.
+        clen, chunked = max(headers.clen or 0, 0), headers.chunked
+        if headers.expect:
             cw.write(b"HTTP/1.1 100 Continue\r\n\r\n")
             await cw.drain()
 
-        body = b""
-        if chunked:
-            while True:
-                size_line = await cr.readuntil(b"\r\n")
-                size = int(size_line.strip().split(b";")[0] or b"0", 16)
-                if size == 0:
-                    await cr.readuntil(b"\r\n")
-                    break
-                body += await cr.readexactly(size)
-                await cr.readexactly(2)
-        elif clen:
-            body = await cr.readexactly(clen)
-
-        if is_inference(path):
-            host, port, use_tls = AIOLOS_HOST, AIOLOS_PORT, AIOLOS_TLS
-            if ACCOUNT_ID:
-                extra = [("x-aiolos-account-id", ACCOUNT_ID),
-                         ("x-aiolos-force-account-strict", "true")]
-                dest = "aiolos[" + ACCOUNT_ID + "]"
-            else:
-                extra = []            # no pin -> aiolos load-balances
-                dest = "aiolos[lb]"
-        else:
-            host, port, use_tls = ANTHROPIC_HOST, ANTHROPIC_PORT, True
-            extra = []
-            dest = "anthropic"
+        body = None
+        if not STREAM_BODY:
+            body = await read_full_body(cr, clen, chunked)
+
+        host, port, use_tls, extra, dest = session.route(path)
+        keep_client = CLIENT_KEEPALIVE and ver == "HTTP/1.1" and not headers.close
+        if cache is not None and dest == "anthropic":
+            ckey = cache.key(method, path, headers, bool(chunked or clen))
+            if ckey is not None:
+                entry, via = cache.get(ckey, headers), "cache"
+                if entry is None:
+                    entry, via = await cache.join(ckey, headers), "coalesced"
+                if entry is not None:
+                    session.log(f"{method} {path} -> {via}")
+                    rec = Exchange(via, start, session.name, method, path, headers)
+                    return await send_cached(cw, entry, keep_client, rec)
+                fill = CacheFill(ckey, headers)
+        session.log(f"{method} {path} -> {dest}")
+        rec = Exchange(dest, start, session.name, method, path, headers)
+        if rec.shape is not None and body:
+            rec.shape.up(len(body))     # read whole before routing (RC_STREAM_BODY=0)
+        acct = accounts.get(dest[7:-1]) if dest.startswith("aiolos[") else None
+        if acct is not None:
+            acct.begin()
+        slot = await lifecycle.queued(cw, scheduler.acquire(
+            "control" if dest == "anthropic" else "inference", dest, session.name))
+        rec.wait = slot.wait
 
-        log(f"{method} {path} -> {dest}")
+        fwd = headers.without(HOP_BY_HOP_REQUEST)
+        fwd += extra
+        if body is None and not chunked and not clen:
+            body = b""          # nothing to stream; lets a stale retry replay it
+        key = (dest, host, port, use_tls)
+
+        if H2 and use_tls and key not in h2pool.h1_only:
+            up = await h2pool.acquire(key)
+            if up is not None:
+                rec.conn = "h2"
+                return await h2_exchange(session, up, cr, cw, method, path,
+                                         host_header(host, port), fwd, body,
+                                         clen, chunked, dest, keep_client, rec, fill,
+                                         slot)
 
         out = [f"{method} {path} {ver}"]
-        for k, v in headers:
-            if k.lower() in HOP_BY_HOP or k.lower() == "expect":
-                continue
-            out.append(f"{k}: {v}")
-        hosthdr = host if port in (443, 80) else f"{host}:{port}"
-        out.append(f"Host: {hosthdr}")
-        for k, v in extra:
-            out.append(f"{k}: {v}")
-        out.append(f"Content-Length: {len(body)}")
-        out.append("Connection: close")
-        req_bytes = ("\r\n".join(out) + "\r\n\r\n").encode("latin1") + body
-
-        ur, uw = await asyncio.open_connection(
-            host, port,
-            ssl=(client_ctx if use_tls else None),
-            server_hostname=(host if use_tls else None),
-        )
-        upstream_w = uw
-        uw.write(req_bytes)
-        await uw.drain()
+        out += [f"{k}: {v}" for k, v in fwd]
+        out.append(f"Host: {host_header(host, port)}")
+        # Exactly one framing header, always ours (the client's were stripped).
+        if body is not None:
+            out.append(f"Content-Length: {len(body)}")
+        elif chunked:
+            out.append("Transfer-Encoding: chunked")
+        else:
+            out.append(f"Content-Length: {clen}")
+        if POOL_IDLE <= 0:
+            out.append("Connection: close")
+        req_head = ("\r\n".join(out) + "\r\n\r\n").encode("latin1")
 
-        # Relay response until upstream closes (Connection: close). Handles
-        # Content-Length, chunked, and SSE streaming uniformly. Peek the first
-        # chunk to log the upstream status line under RC_DEBUG (no bodies) —
-        # this is what makes a failed remote-control bridge init diagnosable.
-        first = await ur.read(65536)
-        if first:
-            if DEBUG:
-                try:
-                    status_line = first.split(b"\r\n", 1)[0].decode("latin1", "replace")
-                    log(f"    <- {dest}: {status_line}")
-                except Exception:
-                    pass
-            cw.write(first)
-            await cw.drain()
-        await pump(ur, cw)
-    except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError):
+        # A pooled connection the server has since dropped fails before any
+        # response byte. The request is then sent again on another only if it
+        # cannot have reached the server whole (sending it failed) or sending
+        # it twice does no harm (IDEMPOTENT): a POST the server may have read
+        # in full is never repeated. Its body must be buffered or still
+        # replayable (see StreamedBody).
+        stream = None if body is not None else StreamedBody(cr, clen, chunked, rec)
+        while True:
+            conn = await pool.acquire(key)
+            upstream_w = conn.writer
+            lifecycle.pair(cw, conn.writer)
+            rec.conn = "pooled" if conn.reused else "new"
+            sent = False
+            try:
+                conn.writer.write(req_head)
+                if body is not None:
+                    await write_body(conn.writer, body)
+                    rec.bytes_up = len(body)
+                else:
+                    rec.bytes_up = await stream.send(conn.writer)
+                sent = True
+                slot.release()      # the send is done; the wait for a reply is not capped
+                resp_head = await conn.reader.readuntil(b"\r\n\r\n")
+                rec.first_byte()
+                break
+            except (asyncio.IncompleteReadError, ConnectionError):
+                conn.close()
+                if not (conn.reused and (not sent or method in IDEMPOTENT)
+                        and (stream is None or stream.replayable)):
+                    raise
+                session.log(f"    stale pooled connection to {dest}; retrying")
+
+        reusable, kept = await relay_response(
+            session, conn, cw, method, dest, resp_head, rec, keep_client, fill)
+        if reusable:
+            upstream_w = None
+            pool.release(conn)
+        return kept
+    except BaseException as e:
+        if rec is not None:
+            rec.error = (life and life.timeout()) or e
+        raise
+    finally:
+        lifecycle.pair(cw, None)
+        release_body(body)
+        if slot is not None:
+            slot.release()
+        if fill is not None:
+            fill.close()
+        if rec is not None:
+            rec.finish()
+            if acct is not None:
+                acct.end(rec)
+            if rec.events:
+                session.log(f"    <- {rec.dest}: {rec.events} events; {rec.timings()}")
+        try:
+            if upstream_w is not None:
+                remember_session(upstream_w)
+                upstream_w.close()
+        except Exception:
+            pass
+
+
+def stats_snapshot():
+    tls = server_ctx.session_stats()
+    out = dict(sorted(stats.items()))
+    out.update(tls_client_resumed=tls["hits"], tls_client_full=tls["accept"] - tls["hits"],
+               tls_upstream_sessions=len(ResumingContext.sessions))
+    if DAEMON_SOCK:
+        out["sessions"] = len(sessions)
+    out["loop"] = "uvloop" if UVLOOP else "asyncio"
+    if WORKER is not None:
+        out["worker"] = WORKER
+    if "ready" in startup:
+        out["startup_s"] = startup["ready"]
+    if not STREAM_BODY:
+        out["body_mem"] = body_budget.used
+    for cls in Scheduler.CLASSES:
+        out[f"sched_{cls}_queued"] = scheduler.queued[cls]
+    out["conns"] = len(lifecycle.tracked)
+    for (side, state), n in lifecycle.counts().items():
+        out[f"conns_{side}_{state}"] = n
+    if cache is not None:
+        looked_up = stats["cache_hit"] + stats["cache_miss"]
+        out.update(cache_entries=len(cache.entries), cache_bytes=cache.size,
+                   cache_hit_rate=round(stats["cache_hit"] / looked_up, 3) if looked_up else 0)
+    return out
+
+
+def usage_snapshot():
+    """Model token usage so far, per destination (so per pinned account) and
+    per session: {"accounts": {dest: {kind: n}}, "sessions": {name: {kind: n}}}."""
+    return {"accounts": {dest: dict(sorted(m.tokens.items()))
+                         for dest, m in sorted(metrics.items()) if m.tokens},
+            "sessions": {name: dict(sorted(c.items()))
+                         for name, c in sorted(session_tokens.items()) if c}}
+
+
+def dump_stats():
+    sys.stderr.write(f"[shim] stats {json.dumps(stats_snapshot())}\n")
+    sys.stderr.flush()
+
+
+def dump_trace():
+    sys.stderr.write("".join(f"[shim] trace {json.dumps(r)}\n" for r in trace.records()))
+    sys.stderr.flush()
+
+
+def render_metrics():
+    """Prometheus text exposition of `metrics`, followed by the `stats`
+    counters as untyped samples."""
+    out = []
+    rows = sorted(metrics.items())
+
+    def lbl(dest):
+        return 'dest="' + dest.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    out.append("# TYPE rc_requests_total counter")
+    for dest, m in rows:
+        for code, n in sorted(m.requests.items()):
+            out.append(f'rc_requests_total{{{lbl(dest)},code="{code}"}} {n}')
+    out.append("# TYPE rc_errors_total counter")
+    for dest, m in rows:
+        for cls, n in sorted(m.errors.items()):
+            out.append(f'rc_errors_total{{{lbl(dest)},class="{cls}"}} {n}')
+    out.append("# TYPE rc_body_bytes_total counter")
+    for dest, m in rows:
+        out.append(f'rc_body_bytes_total{{{lbl(dest)},direction="up"}} {m.bytes_up}')
+        out.append(f'rc_body_bytes_total{{{lbl(dest)},direction="down"}} {m.bytes_down}')
+    out.append("# TYPE rc_tokens_total counter")
+    for dest, m in rows:
+        for kind, n in sorted(m.tokens.items()):
+            out.append(f'rc_tokens_total{{{lbl(dest)},kind="{kind}"}} {n}')
+    out.append("# TYPE rc_inflight gauge")
+    for dest, m in rows:
+        out.append(f"rc_inflight{{{lbl(dest)}}} {m.inflight}")
+    now = time.monotonic()
+    out.append("# TYPE rc_account_ttfb_seconds gauge")
+    for _, a in sorted(accounts.items()):
+        if a.ttfb is not None:
+            out.append(f"rc_account_ttfb_seconds{{{lbl(a.dest)}}} {a.ttfb:.4f}")
+    out.append("# TYPE rc_account_state gauge")
+    for _, a in sorted(accounts.items()):
+        out.append(f'rc_account_state{{{lbl(a.dest)},state="{a.state(now)}"}} 1')
+    out.append("# TYPE rc_conns gauge")
+    for (side, state), n in lifecycle.counts().items():
+        out.append(f'rc_conns{{side="{side}",state="{state}"}} {n}')
+    out.append("# TYPE rc_sched_queued gauge")
+    for cls in Scheduler.CLASSES:
+        out.append(f'rc_sched_queued{{class="{cls}"}} {scheduler.queued[cls]}')
+    out.append("# TYPE rc_sched_wait_seconds histogram")
+    for cls in Scheduler.CLASSES:
+        h = scheduler.waits[cls]
+        total = 0
+        for le, n in zip(BUCKETS + ("+Inf",), h.counts):
+            total += n
+            out.append(f'rc_sched_wait_seconds_bucket{{class="{cls}",le="{le}"}} {total}')
+        out.append(f'rc_sched_wait_seconds_sum{{class="{cls}"}} {h.sum:.6f}')
+        out.append(f'rc_sched_wait_seconds_count{{class="{cls}"}} {total}')
+    for name in DestMetrics.HISTOGRAMS:
+        metric = f"rc_{name}_seconds"
+        out.append(f"# TYPE {metric} histogram")
+        for dest, m in rows:
+            h = m.hist[name]
+            total = 0
+            for le, n in zip(BUCKETS + ("+Inf",), h.counts):
+                total += n
+                out.append(f'{metric}_bucket{{{lbl(dest)},le="{le}"}} {total}')
+            out.append(f"{metric}_sum{{{lbl(dest)}}} {h.sum:.6f}")
+            out.append(f"{metric}_count{{{lbl(dest)}}} {total}")
+    for k, v in stats_snapshot().items():
+        if isinstance(v, (int, float)):
+            out.append(f"rc_{k} {v}")
+    return "\n".join(out) + "\n"
+
+
+async def serve_metrics(cr, cw):
+    """RC_METRICS socket: answers one HTTP GET per connection, e.g.
+    `curl --unix-socket $RC_METRICS http://shim/metrics`. `/stats` returns the
+    SIGUSR1 counters as JSON, `/usage` the token usage (usage_snapshot()),
+    `/trace[?n=N]` the trace ring (the last N records) as NDJSON; any other
+    path the Prometheus text."""
+    try:
+        path = ((await read_headers(cr)).start.split(" ") + ["", ""])[1]
+        if path.startswith("/trace"):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            n = int((query.get("n") or ["0"])[0] or 0)
+            body = "".join(json.dumps(r) + "\n" for r in trace.records(n))
+            ctype = "application/x-ndjson"
+        elif path.startswith("/stats"):
+            body, ctype = json.dumps(stats_snapshot()) + "\n", "application/json"
+        elif path.startswith("/usage"):
+            body, ctype = json.dumps(usage_snapshot()) + "\n", "application/json"
+        else:
+            body, ctype = render_metrics(), "text/plain; version=0.0.4"
+        body = body.encode()
+        cw.write(f"HTTP/1.1 200 OK\r\nContent-Type: {ctype}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+                 .encode() + body)
+        await cw.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError,
+            ValueError):
         pass
-    except Exception as e:
-        log(f"error: {type(e).__name__}: {e}")
     finally:
-        for w in (upstream_w, cw):
+        cw.close()
+
+
+# --- shared daemon (RC_DAEMON) ---
+
+sessions = {}                   # listener port -> Session
+
+
+async def open_session(req):
+    session = Session(req["aiolos_url"], req.get("account_id"),
+                      name=str(req.get("pid") or ""), logfile=req.get("log"),
+                      debug=bool(req.get("debug")))
+    resolver.prefetch(session.aiolos_host, session.aiolos_port)
+    try:
+        session.server = await asyncio.start_server(
+            functools.partial(handle, session), "127.0.0.1", 0, ssl=server_ctx)
+    except Exception:
+        session.close()
+        raise
+    port = session.server.sockets[0].getsockname()[1]
+    sessions[port] = session
+    session.log(f"listening 127.0.0.1:{port} (shared daemon)  {session.describe()}")
+    t0 = time.monotonic()
+    upstreams = await prewarm(session)     # a no-op when the pools are warm already
+    session.log(f"warm in {time.monotonic() - t0:.3f}s: {json.dumps(upstreams)}")
+    log(f"session {session.name} opened on :{port}")
+    if req.get("pid"):
+        asyncio.get_running_loop().create_task(watch_owner(port, int(req["pid"])))
+    return port
+
+
+def close_session(port):
+    session = sessions.pop(port, None)
+    if session is not None:
+        log(f"session {session.name} on :{port} closed")
+        session.close()
+
+
+async def watch_owner(port, pid):
+    """Close a session once the launcher that registered it is gone, even if it
+    died without saying so (the standalone shim dies with its launcher too)."""
+    while port in sessions:
+        await asyncio.sleep(2)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            close_session(port)
+        except PermissionError:
+            pass
+
+
+async def serve_control(cr, cw):
+    """Daemon control socket: one JSON request per line, one JSON reply each.
+
+      {"op": "open", "aiolos_url": U, "account_id": A, "log": PATH,
+       "debug": bool, "pid": LAUNCHER_PID}               -> {"port": N}
+      {"op": "close", "port": N}                          -> {}
+      {"op": "list"}                                      -> {"sessions": [...]}
+      {"op": "reload", "port": N, "aiolos_url": U, "account_id": A}  -> {}
+
+`reload` re-routes session N (fields left out keep their value) and takes up
+rotated certs, as reload() describes; without a port, just the certs (as
+SIGHUP does).
+
+    A bad request only ever fails its own reply; other sessions are untouched."""
+    try:
+        while True:
+            line = await cr.readline()
+            if not line:
+                break
             try:
-                if w is not None:
-                    w.close()
-            except Exception:
-                pass
+                req = json.loads(line)
+                op = req.get("op")
+                if op == "open":
+                    reply = {"port": await open_session(req)}
+                elif op == "close":
+                    close_session(int(req["port"]))
+                    reply = {}
+                elif op == "list":
+                    reply = {"sessions": [
+                        {"port": port, "pid": sess.name, "mode": sess.mode()}
+                        for port, sess in sessions.items()]}
+                elif op == "reload":
+                    sess = sessions[int(req["port"])] if "port" in req else None
+                    reload(sess, sess and (req.get("aiolos_url") or sess.aiolos_url,
+                                           req.get("account_id", sess.account_id)))
+                    reply = {}
+                else:
+                    reply = {"error": f"unknown op {op!r}"}
+            except Exception as e:
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            cw.write(json.dumps(reply).encode() + b"\n")
+            await cw.drain()
+    except (ConnectionError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        cw.close()
 
 
-async def main():
-    if LISTEN_PORT is not None:
+async def run_daemon():
+    if os.path.exists(DAEMON_SOCK):
+        os.unlink(DAEMON_SOCK)      # stale; the launcher only starts us under a lock
+    server = await asyncio.start_unix_server(serve_control, path=DAEMON_SOCK)
+    os.chmod(DAEMON_SOCK, 0o600)
+    log(f"daemon listening {DAEMON_SOCK}  rest->{ANTHROPIC_HOST}")
+    idle_since = time.monotonic()
+    async with server:
+        while True:
+            await asyncio.sleep(5)
+            if sessions:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > DAEMON_LINGER:
+                log("no sessions left; exiting")
+                break
+    for path in (DAEMON_SOCK, METRICS_SOCK):
+        try:
+            if path:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+async def watch_supervisor(ppid):
+    """A worker outlives a supervisor that was killed outright; leave too."""
+    while os.getppid() == ppid:
+        await asyncio.sleep(2)
+    log(f"worker {WORKER}: supervisor gone; exiting")
+    os._exit(0)
+
+
+def write_portfile(port):
+    """Report the bound port to RC_PORTFILE, whole or not at all: the launcher
+    takes a non-empty portfile to mean the shim is ready."""
+    portfile = os.environ.get("RC_PORTFILE")
+    if portfile:
+        with open(portfile + ".tmp", "w") as f:
+            f.write(str(port))
+        os.replace(portfile + ".tmp", portfile)
+
+
+def report_startup(boot, t_main, t_listen, upstreams):
+    """One `startup {...}` line on stderr: where the time to ready went, from
+    exec (interpreter, imports, certs) through binding the listener to the
+    warm upstream connections (see prewarm())."""
+    now = time.monotonic()
+    startup.update(boot=boot and round(boot, 3), listen=round(t_listen - t_main, 4),
+                   warm=round(now - t_listen, 4), upstreams=upstreams)
+    startup["ready"] = round((boot or 0) + now - t_main, 3)
+    sys.stderr.write(f"[shim] startup {json.dumps(startup)}\n")
+    sys.stderr.flush()
+
+
+def routing_config():
+    """(aiolos URL, account id) of a standalone shim: RC_AIOLOS_URL and
+    RC_ACCOUNT_ID, unless RC_CONFIG has lines setting them."""
+    conf = {k: os.environ.get(k) for k in ("RC_AIOLOS_URL", "RC_ACCOUNT_ID")}
+    if CONFIG_FILE:
+        with open(CONFIG_FILE) as f:
+            for line in f:
+                k, sep, v = line.strip().partition("=")
+                if sep and k in conf:
+                    conf[k] = v.strip().strip("'\"")
+    return conf["RC_AIOLOS_URL"], conf["RC_ACCOUNT_ID"]
+
+
+def prune_routes(live):
+    """Let go of the pooled connections and account state of upstreams none
+    of the `live` sessions routes to any more; the rest stay warm."""
+    keys = {(dest, host, port, tls) for s in live for host, port, tls, _, dest in s.routes()}
+    pool.retain(keys)
+    h2pool.retain(keys)
+    ids = {a.id for s in live if s.accounts for a in s.accounts.members}
+    for i in [i for i in accounts if i not in ids]:
+        del accounts[i]
+
+
+def reload(session=None, route=None):
+    """Take up rotated certs and, given `route` (aiolos URL, account id), new
+    routing for `session`, without a restart. Everything is loaded and checked
+    before any of it is used, so a bad cert or URL raises and changes nothing.
+    Requests in flight (SSE streams, tunnels) finish on the old config; new
+    connections and requests take the new one. Connections to upstreams that
+    are still routed to stay pooled, and new ones are warmed (prewarm())."""
+    fresh = load_tls()
+    if route is not None:
+        session.configure(*route)
+    use_tls(fresh)
+    stats["reloads"] += 1
+    if route is not None:
+        prune_routes(list(sessions.values()) or [session])
+        asyncio.ensure_future(prewarm(session))
+
+
+def on_sighup(session):
+    """SIGHUP: reload() the certs, and a standalone shim's RC_CONFIG too."""
+    try:
+        reload(session, routing_config() if session is not None else None)
+    except Exception as e:
+        stats["reload_failed"] += 1
+        sys.stderr.write(f"[shim] reload failed, config unchanged: {type(e).__name__}: {e}\n")
+    else:
+        mode = f" ({session.mode()})" if session is not None else ""
+        sys.stderr.write(f"[shim] reloaded{mode}\n")
+    sys.stderr.flush()
+
+
+async def main(listener=None, ready=None):
+    """Serve until killed. Reports readiness (RC_PORTFILE; for a worker, see
+    run_workers(), a byte on the `ready` pipe fd it is handed along with its
+    `listener` socket) only once listening with warm upstream connections."""
+    t_main = time.monotonic()
+    boot = process_age()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, dump_stats)
+    loop.add_signal_handler(signal.SIGUSR2, dump_trace)
+    loop.add_signal_handler(signal.SIGHUP, on_sighup, None)
+    if os.environ.get("RC_UVLOOP") == "1" and not UVLOOP:
+        log("RC_UVLOOP=1 but uvloop is not installed; using the asyncio loop")
+    loop.create_task(pool.reap())
+    loop.create_task(lifecycle.watch())
+    if trace.path:
+        loop.create_task(trace.flush_loop())
+    if capture.path:
+        loop.create_task(capture.flush_loop())
+    resolver.prefetch(ANTHROPIC_HOST, ANTHROPIC_PORT)
+    metrics_sock = METRICS_SOCK
+    if WORKER is not None:
+        loop.create_task(watch_supervisor(os.getppid()))
+        root, ext = os.path.splitext(METRICS_SOCK or "")
+        metrics_sock = METRICS_SOCK and f"{root}.{WORKER}{ext}"
+    if metrics_sock:
+        if os.path.exists(metrics_sock):
+            os.unlink(metrics_sock)     # stale, from a shim that was killed
+        await asyncio.start_unix_server(serve_metrics, path=metrics_sock)
+        os.chmod(metrics_sock, 0o600)
+    if DAEMON_SOCK:
+        await run_daemon()
+        return
+    # Workers count as one session: the supervisor's, which the launcher knows.
+    session = Session(*routing_config(),
+                      name=str(os.getpid() if WORKER is None else os.getppid()))
+    loop.add_signal_handler(signal.SIGHUP, on_sighup, session)
+    resolver.prefetch(session.aiolos_host, session.aiolos_port)
+    handler = functools.partial(handle, session)
+    if listener is not None:
+        if listener.family == socket.AF_UNIX:
+            server = await asyncio.start_unix_server(handler, sock=listener, ssl=server_ctx)
+        else:
+            server = await asyncio.start_server(handler, sock=listener, ssl=server_ctx)
+        name = listener.getsockname()
+        where = (name if isinstance(name, str) else "%s:%d" % name) + f" (worker {WORKER})"
+    elif LISTEN_PORT is not None:
         # int(LISTEN_PORT) may be 0 -> the OS assigns a free ephemeral port; we
         # report the actual bound port to RC_PORTFILE so the launcher can point
         # this session's LD_PRELOAD at it (one shim per session, no fixed port).
         server = await asyncio.start_server(
-            handle, "127.0.0.1", int(LISTEN_PORT), ssl=server_ctx)
-        actual_port = server.sockets[0].getsockname()[1]
-        where = f"127.0.0.1:{actual_port}"
-        portfile = os.environ.get("RC_PORTFILE")
-        if portfile:
-            with open(portfile, "w") as f:
-                f.write(str(actual_port))
+            handler, "127.0.0.1", int(LISTEN_PORT), ssl=server_ctx)
+        where = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
     else:
-        server = await asyncio.start_unix_server(handle, path=SOCK, ssl=server_ctx)
+        server = await asyncio.start_unix_server(handler, path=SOCK, ssl=server_ctx)
         where = SOCK
-    acct = ACCOUNT_ID if ACCOUNT_ID else "(load-balanced)"
-    log(f"listening {where}  inference->aiolos({AIOLOS_HOST}:{AIOLOS_PORT}) acct={acct}  rest->{ANTHROPIC_HOST}")
+    session.log(f"listening {where}  {session.describe()}")
+    t_listen = time.monotonic()
+    upstreams = await prewarm(session)
+    if ready is not None:
+        os.write(ready, b".")
+        os.close(ready)
+    elif WORKER is None and LISTEN_PORT is not None:
+        write_portfile(server.sockets[0].getsockname()[1])
+    report_startup(boot, t_main, t_listen, upstreams)
     async with server:
         await server.serve_forever()
 
 
-if __name__ == "__main__":
+def reuseport_listener(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(128)
+    return sock
+
+
+def run_workers(n):
+    """RC_WORKERS=N: terminate TLS for the one listener in N forked worker
+    processes (so on up to N cores), restarting any that die.
+
+    For RC_PORT every worker listens on a socket of its own, bound with
+    SO_REUSEPORT to a port reserved here, and the kernel spreads connections
+    across them; RC_PORTFILE gets that one port, from here only, once each
+    worker has said it is ready. If any died first, the workers are stopped
+    and 1 returned, with no portfile written. An RC_SOCK unix socket is bound
+    and listened on here and inherited. The supervisor runs no event loop (so
+    forking is safe) and forwards SIGUSR1, SIGUSR2 and SIGHUP; SIGTERM stops
+    it and its workers."""
+    hold = shared = None
+    if LISTEN_PORT is not None:
+        # Bound but never listening: keeps the port ours between worker
+        # restarts without taking any connections itself.
+        hold = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        hold.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        hold.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        hold.bind(("127.0.0.1", int(LISTEN_PORT)))
+        port = hold.getsockname()[1]
+        where = f"127.0.0.1:{port}"
+    else:
+        if os.path.exists(SOCK):
+            os.unlink(SOCK)
+        shared = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        shared.bind(SOCK)
+        shared.listen(128)
+        where = SOCK
+    children = {}               # pid -> (worker number, started)
+
+    def spawn(i, ready=None):
+        pid = os.fork()
+        if pid:
+            children[pid] = (i, time.monotonic())
+            return
+        global WORKER
+        WORKER = i
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)   # until main() handles them
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            listener = shared if shared is not None else reuseport_listener(port)
+            (uvloop.run if UVLOOP else asyncio.run)(main(listener, ready))
+            code = 0
+        except KeyboardInterrupt:
+            code = 0
+        except BaseException as e:
+            log(f"worker {i}: {type(e).__name__}: {e}")
+        finally:
+            os._exit(code)
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for sig in (signal.SIGUSR1, signal.SIGUSR2, signal.SIGHUP):
+        signal.signal(sig, lambda signum, _: [os.kill(pid, signum)
+                                              for pid in list(children)])
+    backoff = [0.0] * n
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
+        ready_r, ready_w = os.pipe()
+        for i in range(n):
+            spawn(i, ready_w)
+        os.close(ready_w)
+        listening = 0           # one byte per worker that listens; EOF once all
+        while os.read(ready_r, 1):      # have either done that or died
+            listening += 1
+        os.close(ready_r)
+        if listening < n:
+            sys.stderr.write(f"[shim] only {listening} of {n} workers started\n")
+            return 1
+        if hold is not None:
+            write_portfile(port)
+        log(f"listening {where} with {n} workers")
+        while True:
+            pid, status = os.wait()
+            if pid not in children:
+                continue
+            i, started = children.pop(pid)
+            log(f"worker {i} (pid {pid}) exited with {os.waitstatus_to_exitcode(status)}; "
+                "restarting")
+            # One that keeps dying at once (bad config) is retried ever slower.
+            if time.monotonic() - started < 5:
+                backoff[i] = min(backoff[i] * 2 or 0.5, 30)
+                time.sleep(backoff[i])
+            else:
+                backoff[i] = 0.0
+            spawn(i)
+    except (SystemExit, KeyboardInterrupt):
         pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    if WORKERS > 1 and not DAEMON_SOCK:
+        sys.exit(run_workers(WORKERS))
+    else:
+        try:
+            (uvloop.run if UVLOOP else asyncio.run)(main())
+        except KeyboardInterrupt:
+            pass
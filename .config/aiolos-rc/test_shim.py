@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""aiolos-rc shim tests, fully offline: `python3 -m unittest test_shim` here.
+
+Unit tests import shim.py in process (with throwaway certs from bench.py);
+end-to-end ones run it against bench.py's local TLS stand-ins.
+"""
+import asyncio
+import json
+import os
+import shutil
+import socket
+import ssl
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench  # noqa: E402
+
+shim = None
+_tmp = None
+
+
+def setUpModule():
+    global shim, _tmp
+    _tmp = tempfile.mkdtemp(prefix="aiolos-rc-test.")
+    certs = bench.make_certs(_tmp)
+    os.environ.update(RC_CERT=certs["cert"], RC_KEY=certs["key"])
+    import shim as module
+    shim = module
+
+
+def tearDownModule():
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_total_never_holds_control_or_upgrade(self):
+        async def run():
+            sched = shim.Scheduler({"inference": 0, "control": 0, "upgrade": 0, "total": 4})
+            uploads = [await sched.acquire("inference", f"aiolos[{i}]", "bulk")
+                       for i in range(4)]
+            queued = asyncio.ensure_future(sched.acquire("inference", "aiolos[x]", "bulk"))
+            await asyncio.sleep(0)
+            self.assertFalse(queued.done())
+            control = await asyncio.wait_for(
+                sched.acquire("control", "anthropic", "heartbeat"), 0.1)
+            upgrade = await asyncio.wait_for(
+                sched.acquire("upgrade", "upgrade", "heartbeat"), 0.1)
+            self.assertEqual((control.wait, upgrade.wait), (0.0, 0.0))
+            control.release()
+            upgrade.release()
+            self.assertFalse(queued.done())     # their slots were never total's
+            uploads[0].release()
+            (await asyncio.wait_for(queued, 0.1)).release()
+            for slot in uploads[1:]:
+                slot.release()
+            self.assertEqual(sched.total, 0)
+        asyncio.run(run())
+
+
+class AccountTest(unittest.TestCase):
+
+    def end(self, acct, status, error=None, client_error=False):
+        acct.begin()
+        acct.end(mock.Mock(status=status, error=error, client_error=client_error,
+                           retry_after=None, ttfb=0.1))
+
+    def test_throttling_is_held_off_but_never_opens_the_breaker(self):
+        acct = shim.Account("a")
+        for status in (503, 529, 429, 503, 503):
+            self.end(acct, status)
+        self.assertEqual((acct.fails, acct.holds), (0, 5))
+        self.assertEqual(acct.state(time.monotonic()), "held")
+
+    def test_other_failures_open_the_breaker(self):
+        acct = shim.Account("a")
+        for status, error in ((500, None), (None, ConnectionResetError()), (502, None)):
+            self.end(acct, status, error)
+        self.assertEqual(acct.state(time.monotonic()), "open")
+
+    def test_client_hanging_up_mid_upload_is_not_a_failure(self):
+        async def upload():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"x" * 100)
+            reader.feed_eof()       # 100 of the 1000 bytes promised
+            rec = mock.Mock(shape=None, client_error=False)
+            with self.assertRaises(asyncio.IncompleteReadError):
+                async for _ in shim.StreamedBody(reader, 1000, False, rec).read():
+                    pass
+            return rec
+        acct = shim.Account("a")
+        for _ in range(shim.BREAKER_FAILS + 1):
+            rec = asyncio.run(upload())
+            self.assertTrue(rec.client_error)
+            self.end(acct, None, asyncio.IncompleteReadError(b"", 900), rec.client_error)
+        self.assertEqual((acct.fails, acct.state(time.monotonic())), (0, "ok"))
+
+
+def sse(kind, data):
+    return b"event: %s\ndata: %s\n\n" % (kind, json.dumps(data).encode())
+
+
+def usage(kind, **usage):
+    if kind == b"message_start":
+        return sse(kind, {"type": "message_start", "message": {"usage": usage}})
+    return sse(kind, {"type": "message_delta", "usage": usage})
+
+
+DELTA = sse(b"content_block_delta", {"type": "content_block_delta", "delta": {"text": "hi"}})
+STOP = sse(b"message_stop", {"type": "message_stop"})
+
+
+class SSEWatchTest(unittest.TestCase):
+
+    def watch(self):
+        self.dest = f"aiolos[{self.id()}]"
+        self.session = shim.collections.Counter()
+        rec = shim.Exchange(self.dest, time.monotonic())
+        return rec, shim.SSEWatch(rec, self.session)
+
+    def feed(self, watch, stream, step):
+        return sum(watch.feed(stream[i:i + step]) for i in range(0, len(stream), step))
+
+    def test_boundaries_lf_and_crlf_in_any_split(self):
+        stream = (usage(b"message_start", input_tokens=10, output_tokens=1)
+                  + DELTA * 3 + usage(b"message_delta", output_tokens=7) + STOP)
+        for crlf in (False, True):
+            for step in (1, 2, 3, 7, len(stream)):
+                with self.subTest(crlf=crlf, step=step):
+                    rec, watch = self.watch()
+                    data = stream.replace(b"\n", b"\r\n") if crlf else stream
+                    self.assertEqual(self.feed(watch, data, step), 6)
+                    self.assertEqual(rec.events, 6)
+                    self.assertEqual(watch.buf, b"")
+                    self.assertEqual(rec.tokens, {"input": 10, "output": 7})
+                    self.assertEqual(self.session, {"input": 10, "output": 7})
+
+    def test_ttft_is_the_first_content_delta(self):
+        rec, watch = self.watch()
+        watch.feed(usage(b"message_start", input_tokens=1))
+        self.assertIsNone(rec.ttft)
+        watch.feed(DELTA)
+        ttft = rec.ttft
+        self.assertIsNotNone(ttft)
+        watch.feed(DELTA)
+        self.assertEqual(rec.ttft, ttft)
+
+    def test_only_increases_of_running_totals_count(self):
+        rec, watch = self.watch()
+        for event in (usage(b"message_start", input_tokens=10, output_tokens=1,
+                            cache_read_input_tokens=4),
+                      usage(b"message_delta", output_tokens=5),
+                      usage(b"message_delta", output_tokens=5, input_tokens=10),
+                      usage(b"message_delta", output_tokens=3, cache_read_input_tokens=2),
+                      usage(b"message_delta", output_tokens=9)):
+            watch.feed(event)
+        expect = {"input": 10, "output": 9, "cache_read": 4}
+        self.assertEqual(rec.tokens, expect)
+        self.assertEqual(self.session, expect)
+        self.assertEqual(dict(shim.metrics[self.dest].tokens), expect)
+
+    def test_long_events_are_counted_but_not_kept(self):
+        rec, watch = self.watch()
+        big = sse(b"content_block_delta", {"delta": {"text": "x" * 100000}})
+        self.assertEqual(self.feed(watch, big, 4096), 1)
+        self.assertEqual(rec.events, 1)
+        self.assertIsNotNone(rec.ttft)      # typed from its head, before that was dropped
+        watch.feed(big[:50000])
+        self.assertLessEqual(len(watch.buf), 1024)
+
+    def test_usage_is_read_up_to_64k_and_dropped_past_it(self):
+        rec, watch = self.watch()
+        padded = usage(b"message_delta", output_tokens=5, pad="x" * 30000)
+        self.assertEqual(self.feed(watch, padded, 4096), 1)
+        self.assertEqual(rec.tokens, {"output": 5})
+        huge = usage(b"message_delta", output_tokens=50, pad="x" * 70000)
+        self.assertEqual(self.feed(watch, huge[:-2], 4096), 0)
+        self.assertLessEqual(len(watch.buf), 1024)
+        self.assertEqual(watch.feed(huge[-2:]), 1)
+        self.assertEqual(rec.tokens, {"output": 5})
+        self.assertEqual(rec.events, 2)
+
+
+class CacheTest(unittest.TestCase):
+
+    def coalesce(self, resp_headers):
+        """What a request that joined a fill gets once the response is done."""
+        async def run():
+            cache = shim.ResponseCache(["/api/features"], 1 << 20, 60)
+            with mock.patch.object(shim, "cache", cache):
+                fill = shim.CacheFill("key", [])
+                waiter = asyncio.ensure_future(cache.join("key", []))
+                await asyncio.sleep(0)
+                fill.begin(200, "HTTP/1.1 200 OK", resp_headers)
+                fill.feed(b"{}")
+                fill.done()
+                fill.close()
+                self.assertEqual(cache.inflight, {})
+                return await waiter
+        return asyncio.run(run())
+
+    def test_waiters_share_a_response_that_is_not_kept(self):
+        entry = self.coalesce([("Cache-Control", "no-cache")])
+        self.assertEqual(entry.body, b"{}")
+
+    def test_waiters_go_upstream_for_a_private_response(self):
+        for headers in ([("Cache-Control", "no-store")], [("Cache-Control", "private")],
+                        [("Set-Cookie", "session=1")]):
+            with self.subTest(headers=headers):
+                self.assertIsNone(self.coalesce(headers))
+
+
+class SpliceTest(unittest.TestCase):
+
+    def test_stream_readers_are_spliceable(self):
+        async def run():
+            return shim.spliceable(asyncio.StreamReader(), None)
+        self.assertTrue(asyncio.run(run()))     # fails loudly if asyncio drops _buffer
+
+    def test_a_reader_without_its_buffer_falls_back(self):
+        self.assertFalse(shim.spliceable(mock.Mock(spec=["read", "at_eof"])))
+
+
+class FakeTransport:
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+
+class FakeConn:
+    def __init__(self, idle_since):
+        self.idle_since = idle_since
+        self.transport = FakeTransport()
+
+    def close(self):
+        self.transport.closing = True
+
+
+class LifecycleTest(unittest.TestCase):
+
+    def test_over_budget_closes_only_the_excess_idle_oldest_first(self):
+        pool, life = shim.Pool(), shim.Lifecycle()
+        conns = {"a": [FakeConn(3), FakeConn(1)], "b": [FakeConn(2), FakeConn(4)]}
+        pool._idle = {k: list(v) for k, v in conns.items()}
+        for conn in conns["a"] + conns["b"]:
+            life.tracked[conn.transport] = shim.Tracked("upstream", "idle", conn.transport)
+        busy = FakeTransport()
+        life.tracked[busy] = shim.Tracked("client", "request", busy)
+        with mock.patch.object(shim, "pool", pool), mock.patch.object(shim, "FD_BUDGET", 3):
+            self.assertFalse(life.over_budget())
+            self.assertEqual(life.room(), 0)
+        closed = sorted(c.idle_since for v in conns.values() for c in v if c.transport.closing)
+        self.assertEqual(closed, [1, 2])
+        self.assertEqual({k: [c.idle_since for c in v] for k, v in pool._idle.items()},
+                         {"a": [3], "b": [4]})
+
+    def test_queued_request_only_has_the_total_timeout(self):
+        life, transport = shim.Lifecycle(), FakeTransport()
+        t = life.tracked[transport] = shim.Tracked("client", "request", transport)
+        now = t.since + shim.TIMEOUTS["idle"] + 1
+        self.assertEqual(life.overdue(t, now), "idle")
+        t.state = "queued"
+        self.assertIsNone(life.overdue(t, now))
+        self.assertEqual(life.overdue(t, t.since + shim.TIMEOUTS["total"] + 1), "total")
+
+    def test_queued_resumes_state_with_idle_time_reset(self):
+        async def run():
+            life, transport = shim.Lifecycle(), FakeTransport()
+            writer = mock.Mock(transport=transport)
+            t = life.tracked[transport] = shim.Tracked("client", "request", transport)
+            t.last -= 100
+            wait = asyncio.get_running_loop().create_future()
+            queued = asyncio.ensure_future(life.queued(writer, wait))
+            await asyncio.sleep(0)
+            self.assertEqual(t.state, "queued")
+            wait.set_result("slot")
+            self.assertEqual(await queued, "slot")
+            self.assertEqual(t.state, "request")
+            self.assertIsNone(life.overdue(t, time.monotonic()))
+        asyncio.run(run())
+
+
+def seen(rig, request):
+    """How many times the stand-ins read `request` ("METHOD /path") in full."""
+    n = 0
+    for port in (rig.aiolos_port, rig.anthropic_port):
+        client = bench.Client(port, rig.certs["ca"])
+        n += json.loads(client.call("GET", "/seen")[1]).get(request, 0)
+        client.close()
+    return n
+
+
+def post(rig):
+    """A streamed POST through the shim: its status, or None if the shim hung
+    up without one (as it does when the upstream fails)."""
+    client = rig.client()
+    try:
+        client.request("POST", "/v1/messages", encode_chunked=True,
+                       body=iter([b"x" * 1000] * 5))
+        resp = client.getresponse()
+        resp.read()
+        return resp.status
+    except ConnectionError:
+        return None
+    finally:
+        client.close()
+
+
+class StalePoolTest(unittest.TestCase):
+
+    def post_after_idle(self, **env):
+        """The stand-in closes keep-alive connections idle for 0.3 s, so the
+        pooled ones are dead by each POST and it must go out on a fresh one."""
+        with bench.Rig(standin=["--idle-close", "0.3"], **env) as rig:
+            statuses = []
+            for _ in range(3):
+                time.sleep(0.5)
+                statuses.append(post(rig))
+            self.assertEqual(statuses, [200] * 3)
+            self.assertEqual(seen(rig, "POST /v1/messages"), 3)
+
+    def test_streamed_body(self):
+        self.post_after_idle()
+
+    def test_buffered_body(self):
+        self.post_after_idle(RC_STREAM_BODY="0")
+
+    def test_post_read_in_full_is_never_sent_twice(self):
+        with bench.Rig(standin=["--drop-posts"]) as rig:
+            self.assertEqual([post(rig) for _ in range(2)], [None, None])
+            self.assertGreater(rig.stats().get("pool_reused", 0), 0)
+            self.assertEqual(seen(rig, "POST /v1/messages"), 2)
+
+
+@unittest.skipIf(bench.h2 is None, "needs the h2 package")
+class H2FlowTest(unittest.TestCase):
+
+    def test_a_client_not_reading_stalls_only_its_own_stream(self):
+        with bench.Rig(RC_H2="1") as rig:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 16)   # no autotuning
+            sock.connect(("127.0.0.1", rig.port))
+            stuck = ssl.create_default_context(cafile=rig.certs["ca"]).wrap_socket(
+                sock, server_hostname=bench.HOST)
+            stuck.sendall(b"GET /api/big?size=30000000 HTTP/1.1\r\n"
+                          b"Host: api.anthropic.com\r\n\r\n")
+            time.sleep(1)           # the big answer backs up behind the unread socket
+            client = rig.client()
+            client.connect()
+            client.sock.settimeout(5)
+            t0 = time.monotonic()
+            self.assertEqual(client.call("GET", "/api/small")[0], 200)
+            self.assertLess(time.monotonic() - t0, 1)
+            client.close()
+            stuck.close()
+            self.assertGreater(rig.stats().get("h2_streams", 0), 1)
+
+
+class WorkersTest(unittest.TestCase):
+
+    def workers(self, rig):
+        pid = rig.shim.pid
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return set(f.read().split())
+
+    def test_no_portfile_unless_every_worker_starts(self):
+        rig = bench.Rig(RC_WORKERS="2", RC_METRICS="/nonexistent/metrics.sock")
+        try:
+            with self.assertRaises(RuntimeError):
+                rig.__enter__()
+            self.assertEqual(rig.shim.wait(5), 1)
+            self.assertFalse(os.path.exists(os.path.join(rig.tmp, "port")))
+        finally:
+            rig.__exit__(None, None, None)
+
+    def test_only_the_supervisor_writes_the_portfile(self):
+        with bench.Rig(RC_WORKERS="2") as rig:
+            portfile = os.path.join(rig.tmp, "port")
+            os.unlink(portfile)
+            before = self.workers(rig)
+            os.kill(int(min(before)), 9)
+            for _ in range(100):
+                time.sleep(0.05)
+                now = self.workers(rig)
+                if len(now) == 2 and now != before:
+                    break
+            self.assertEqual(len(now - before), 1)
+            time.sleep(1)       # the new worker is listening, warm and ready by now
+            client = rig.client()
+            client.request("GET", "/v1/models")
+            self.assertEqual(client.getresponse().status, 200)
+            self.assertFalse(os.path.exists(portfile))
+
+
+if __name__ == "__main__":
+    unittest.main()